@@ -2,133 +2,229 @@ from pathlib import Path
 import pandas as pd
 import numpy as np
 
+from excel_utils import StreamingWorkbook, sheet_chunks
+from session_db import store_events
+from force_analysis import force_samples, save_force
+
 # these are the items listed in the output of the Arduino code. If you make changes to the Arduino code, adjust this accordingly.
 key_list = ['Time', 'Force', '# of Licks', 'Trial Number', 'Port', 'Cue', 'Lever Press', 'Syncs', 'Servos', 'Reward']
 
 # Parse log information from Arduino into multiple columns
-def parse_data(path: Path):
-    # Import data
-    data = pd.read_excel(path, sheet_name = None)
-
-    # Create ExcelWriter for output file
+# With `chunk_rows`, the log is read and written in blocks of rows instead of being loaded at once
+# `path` is either an Excel log or a folder of binary logs (one <mouse>.bin file per animal, see binary_log.py)
+def parse_data(path: Path, chunk_rows: int | None = None):
+    # Create streaming workbook for output file
     dir_tree = list(path.parts[:-1])
     dir_tree[0] = 'parsed_data'
     output_dir = Path(*dir_tree)
     output_dir.mkdir(parents = True, exist_ok = True)
     file_name = output_dir / f'{path.stem}.xlsx'
-    writer = pd.ExcelWriter(file_name, engine = 'xlsxwriter')
-    
-    # This is based on the way we organized the data. For each output file we have one file per animal (with animal ID on first sheet) and one sheet per test/day
-    for frame_name in data:
-        # Skip first sheet with mouse ID
-        if 'Animal ID' in data[frame_name].columns:
-            data[frame_name].to_excel(writer, sheet_name = frame_name, index = False)
-        else:
-            # Create formatted frame for dictionary
-            keys = key_list.copy()
-            parsed_data = {}
-            for key in keys:
-                parsed_data.setdefault(key, [])
-            
-            # Parse each row of raw data
-            if not data[frame_name].empty:
-                raw_data = data[frame_name].iloc[:, 0].to_list()
-                latest_trial_num = 0
-                for row in raw_data:
-                    # Split string into individual components
-                    row_parts = row.split(',')
-                    
-                    # Extract time (in ms) if exists
-                    if 'ms' in row_parts[-1]:
-                        data_time = int(row_parts[-1].split('=')[-1].rstrip())
-                        
-                        # Check if new row needs to be added for time
-                        if len(parsed_data['Time']) > 0:
-                            if parsed_data['Time'][-1] != data_time:
-                                # If more rows exist, fill in blank strings for unfilled columns
-                                for key in keys:
-                                    parsed_data[key].append('')
-                                keys = key_list.copy()
-                                parsed_data['Time'].append(data_time)
-                                keys.remove('Time')
-                        else:
-                            parsed_data['Time'].append(data_time)
-                            keys.remove('Time')
-                        row_parts.pop(-1)
+
+    # Force trace of each animal, also saved as compact arrays next to the parsed log (see force_analysis.py)
+    traces = {}
+    if path.is_dir():
+        parse_binary(path, file_name, traces)
+    else:
+        # This is based on the way we organized the data. For each output file we have one file per animal (with animal ID on first sheet) and one sheet per test/day
+        with pd.ExcelFile(path) as xls, StreamingWorkbook(file_name) as workbook:
+            for frame_name in xls.sheet_names:
+                if chunk_rows is None:
+                    parse_sheet(path, frame_name, xls.parse(frame_name), workbook, traces)
+                else:
+                    parse_sheet_chunks(path, frame_name, xls, workbook, chunk_rows, traces)
+    if 'Force' in log_columns(path):
+        save_force(file_name, traces)
+
+# Output columns of a parsed log (phase 1 has no lever)
+def log_columns(path: Path):
+    columns = key_list.copy()
+    if 'phase 1' in path.parts:
+        columns.remove('Force')
+        columns.remove('Lever Press')
+    return columns
+
+# Parser state carried from one log row to the next: the row being filled (one row per time stamp),
+# the keys still free in that row and the latest trial number
+class LogParser:
+    def __init__(self, path: Path):
+        self.keys = key_list.copy()
+        self.parsed_data = {}
+        for key in self.keys:
+            self.parsed_data.setdefault(key, [])
+        self.latest_trial_num = 0
+        self.start_time = None
+        self.columns = log_columns(path)
+
+    # Parse each row of raw data
+    def feed(self, raw_data: list):
+        for row in raw_data:
+            # Split string into individual components
+            row_parts = row.split(',')
+
+            # Extract time (in ms) if exists
+            if 'ms' in row_parts[-1]:
+                data_time = int(row_parts[-1].split('=')[-1].rstrip())
+
+                # Check if new row needs to be added for time
+                if len(self.parsed_data['Time']) > 0:
+                    if self.parsed_data['Time'][-1] != data_time:
+                        # If more rows exist, fill in blank strings for unfilled columns
+                        for key in self.keys:
+                            self.parsed_data[key].append('')
+                        self.keys = key_list.copy()
+                        self.parsed_data['Time'].append(data_time)
+                        self.keys.remove('Time')
+                else:
+                    self.parsed_data['Time'].append(data_time)
+                    self.keys.remove('Time')
+                row_parts.pop(-1)
+            else:
+                if 'bout' not in row:
+                    continue
+
+            # Parse other parts of row
+            for part in row_parts:
+                if part == 'syncOut': # Sync notifications
+                    if 'Syncs' in self.keys:
+                        self.parsed_data['Syncs'].append('TRUE')
+                        self.keys.remove('Syncs')
+                elif 'g' in part:
+                    force = np.round(float(part.split('=')[-1].rstrip()), 2)
+                    self.parsed_data['Force'].append(force)
+                    self.keys.remove('Force')
+                elif 'trialNum' in part: # Trial number
+                    self.latest_trial_num = int(part.split('=')[-1].rstrip())
+                    if 'Trial Number' in self.keys:
+                        self.parsed_data['Trial Number'].append(self.latest_trial_num)
+                        self.keys.remove('Trial Number')
+                elif 'port' in part: # Port number
+                    port = int(part.split('=')[-1].rstrip())
+                    if 'Port' in self.keys:
+                        self.parsed_data['Port'].append(port)
+                        self.keys.remove('Port')
+                elif 'cue' in part: # Cue triggers
+                    cue_status = part[3:]
+                    if 'Cue' in self.keys:
+                        self.parsed_data['Cue'].append(cue_status)
+                        self.keys.remove('Cue')
+                    if 'Trial Number' in self.keys:
+                        self.parsed_data['Trial Number'].append(self.latest_trial_num)
+                        self.keys.remove('Trial Number')
+                elif part == 'levPress': # Lever Press
+                    if 'Lever Press' in self.keys:
+                        self.parsed_data['Lever Press'].append(1)
+                        self.keys.remove('Lever Press')
+                elif part == 'moveServo': # Servo motion
+                    if 'Servos' in self.keys:
+                        self.parsed_data['Servos'].append('TRUE')
+                        self.keys.remove('Servos')
+                elif 'lick' in part: # Spout licks
+                    if 'bout' in part:
+                        num_licks = int(part.split(' ')[0])
+                        self.parsed_data['# of Licks'][-1] = num_licks
                     else:
-                        if 'bout' not in row:
-                            continue
-                    
-                    # Parse other parts of row
-                    for part in row_parts:
-                        if part == 'syncOut': # Sync notifications
-                            if 'Syncs' in keys:
-                                parsed_data['Syncs'].append('TRUE')
-                                keys.remove('Syncs')
-                        elif 'g' in part:
-                            force = np.round(float(part.split('=')[-1].rstrip()), 2)
-                            parsed_data['Force'].append(force)
-                            keys.remove('Force')
-                        elif 'trialNum' in part: # Trial number
-                            latest_trial_num = int(part.split('=')[-1].rstrip())
-                            if 'Trial Number' in keys:
-                                parsed_data['Trial Number'].append(latest_trial_num)
-                                keys.remove('Trial Number')
-                        elif 'port' in part: # Port number
-                            port = int(part.split('=')[-1].rstrip())
-                            if 'Port' in keys:
-                                parsed_data['Port'].append(port)
-                                keys.remove('Port')
-                        elif 'cue' in part: # Cue triggers
-                            cue_status = part[3:]
-                            if 'Cue' in keys:
-                                parsed_data['Cue'].append(cue_status)
-                                keys.remove('Cue')
-                            if 'Trial Number' in keys:
-                                parsed_data['Trial Number'].append(latest_trial_num)
-                                keys.remove('Trial Number')
-                        elif part == 'levPress': # Lever Press
-                            if 'Lever Press' in keys:
-                                parsed_data['Lever Press'].append(1)
-                                keys.remove('Lever Press')
-                        elif part == 'moveServo': # Servo motion
-                            if 'Servos' in keys:
-                                parsed_data['Servos'].append('TRUE')
-                                keys.remove('Servos')
-                        elif 'lick' in part: # Spout licks
-                            if 'bout' in part:
-                                num_licks = int(part.split(' ')[0])
-                                parsed_data['# of Licks'][-1] = num_licks
-                            else:
-                                parsed_data['# of Licks'].append(1)
-                                keys.remove('# of Licks')
-                        elif part == 'REWARD': # Reward notification
-                            parsed_data['Reward'].append('TRUE')
-                            keys.remove('Reward')
-            
-            # Add blank values for pending keys (if any)
-            for key in keys:
-                parsed_data[key].append('')
-
-            # Create parsed DataFrame
-            parsed_frame = pd.DataFrame(parsed_data)
-            if 'phase 1' in file_name.parts:
-                parsed_frame.drop(columns = ['Force', 'Lever Press'], inplace = True)
-
-            # Convert time scale from milliseconds to seconds and offset start to 0
-            parsed_frame['Time'] /= 1000
-            parsed_frame['Time'] -= parsed_frame['Time'][0]
-            
-            # Export parsed DataFrame
-            parsed_frame.to_excel(writer, sheet_name = frame_name, index = False)
-    
-    # Close excel writer
-    writer.close()
+                        self.parsed_data['# of Licks'].append(1)
+                        self.keys.remove('# of Licks')
+                elif part == 'REWARD': # Reward notification
+                    self.parsed_data['Reward'].append('TRUE')
+                    self.keys.remove('Reward')
+
+    # Remove and return the first `num_rows` parsed rows, with time offset to start at 0 and converted from milliseconds to seconds
+    # (the offset is taken in integer milliseconds, so each time is the closest float to its value in seconds)
+    def take(self, num_rows: int):
+        rows = {}
+        for key in self.columns:
+            rows[key] = self.parsed_data[key][:num_rows]
+        for key in key_list:
+            del self.parsed_data[key][:num_rows]
+        time = np.asarray(rows['Time'], dtype = np.int64)
+        if self.start_time is None and len(time) > 0:
+            self.start_time = time[0]
+        rows['Time'] = (time - (self.start_time or 0)) / 1000
+        return rows
+
+    # Rows that can no longer change: all but the row being filled and the one before it
+    # (a lick bout line updates the lick count of the latest row with a lick)
+    def take_complete(self):
+        return self.take(max(len(self.parsed_data['Time']) - 2, 0))
+
+    # Close the row being filled and return all remaining rows
+    def finish(self):
+        # Add blank values for pending keys (if any)
+        for key in self.keys:
+            self.parsed_data[key].append('')
+        return self.take(len(self.parsed_data['Time']))
+
+# Parse one sheet of an Arduino log file and write it to the output workbook
+def parse_sheet(path: Path, frame_name: str, raw_frame: pd.DataFrame, workbook: StreamingWorkbook, traces: dict):
+    # Skip first sheet with mouse ID
+    if 'Animal ID' in raw_frame.columns:
+        workbook.write_frame(frame_name, raw_frame, index = False)
+    else:
+        parser = LogParser(path)
+        if not raw_frame.empty:
+            parser.feed(raw_frame.iloc[:, 0].to_list())
+        parsed_data = parser.finish()
+
+        # Export parsed columns directly, without building a DataFrame
+        workbook.write_columns(frame_name, parsed_data)
+        store_events(path, frame_name, parsed_data)
+        if 'Force' in parsed_data:
+            traces[frame_name] = force_samples(parsed_data)
+
+# Parse one sheet of an Arduino log file in blocks of `chunk_rows` log rows, writing parsed rows as soon as they are complete
+# Gives the same output as parse_sheet while only one block of the log is in memory
+def parse_sheet_chunks(path: Path, frame_name: str, xls: pd.ExcelFile, workbook: StreamingWorkbook, chunk_rows: int, traces: dict):
+    parser = LogParser(path)
+    sheet = None
+    force = []
+    for header, rows in sheet_chunks(xls, frame_name, chunk_rows):
+        # Copy first sheet with mouse ID
+        if 'Animal ID' in header:
+            sheet = sheet or workbook.open_sheet(frame_name, header)
+            sheet.write_rows(rows)
+            continue
+
+        if sheet is None:
+            sheet = workbook.open_sheet(frame_name, parser.columns)
+        parser.feed([x[0] for x in rows])
+        parsed_data = parser.take_complete()
+        store_events(path, frame_name, parsed_data, append = sheet.row > 1)
+        sheet.write_columns(parsed_data)
+        if 'Force' in parsed_data:
+            force.append(force_samples(parsed_data))
+
+    if sheet is not None and 'Animal ID' in header:
+        return
+    parsed_data = parser.finish()
+    if sheet is None:
+        sheet = workbook.open_sheet(frame_name, parser.columns)
+    store_events(path, frame_name, parsed_data, append = sheet.row > 1)
+    sheet.write_columns(parsed_data)
+    if 'Force' in parsed_data:
+        force.append(force_samples(parsed_data))
+        traces[frame_name] = tuple(np.concatenate(x) for x in zip(*force))
+
+# Parse a folder of binary logs into the same workbook layout as an Excel log (animal IDs on the first sheet, one sheet per animal)
+# Binary logs are compact enough (14 bytes per event) to be decoded at once
+def parse_binary(path: Path, file_name: Path, traces: dict):
+    import binary_log
+
+    files = sorted(path.glob('*.bin'))
+    columns = log_columns(path)
+    with StreamingWorkbook(file_name) as workbook:
+        workbook.write_columns('IDs', {'Animal ID': [x.stem for x in files]})
+        for file in files:
+            parsed_data = binary_log.event_table(binary_log.read_log(file), columns)
+            workbook.write_columns(file.stem, parsed_data)
+            store_events(path, file.stem, parsed_data)
+            if 'Force' in parsed_data:
+                traces[file.stem] = force_samples(parsed_data)
 
 # Parse multiple files at once
 def main(folder: Path):
-    # Get list of files
-    files = folder.glob('*.xlsx')
+    # Get list of files (Excel logs and folders of binary logs)
+    files = list(folder.glob('*.xlsx')) + [x for x in folder.iterdir() if x.is_dir() and any(x.glob('*.bin'))]
 
     # For each file
     for file in files:
@@ -136,6 +232,11 @@ def main(folder: Path):
         parse_data(file)
         print(f"Completed parsing for {file.stem}")
 
-folders = [x for x in Path('original_data').iterdir() if x.is_dir()]
-for folder in folders:
-    main(folder)
\ No newline at end of file
+# Parse all Arduino logs in the original_data/ folder
+def process_all():
+    folders = [x for x in Path('original_data').iterdir() if x.is_dir()]
+    for folder in folders:
+        main(folder)
+
+if __name__ == "__main__":
+    process_all()
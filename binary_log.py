@@ -0,0 +1,189 @@
+from pathlib import Path
+import numpy as np
+
+from arduino_log_parse import key_list
+
+# Binary event records written by logEvent() in phase1/2/3.ino when binaryLog = 1
+# 14 bytes, little-endian: sync byte, event code, trial number (or licks in bout), time (ms), value (force or ITI), port, checksum
+sync_byte = 0xA5
+record_dtype = np.dtype([
+    ('sync', 'u1'),
+    ('code', 'u1'),
+    ('trial', '<u2'),
+    ('ms', '<u4'),
+    ('value', '<f4'),
+    ('port', 'u1'),
+    ('checksum', 'u1'),
+])
+record_size = record_dtype.itemsize
+
+# Event codes (must match the log* constants in the .ino files)
+event_codes = {
+    'session': 1,
+    'end': 2,
+    'trial': 3,
+    'iti': 4,
+    'cueOn': 5,
+    'cueOff': 6,
+    'servo': 7,
+    'levPress': 8,
+    'force': 9,
+    'lick': 10,
+    'bout': 11,
+    'reward': 12,
+    'sync': 13,
+}
+
+# Events that print a trial number and a port in the text log
+trial_events = ['trial', 'iti', 'servo', 'lick', 'reward']
+port_events = ['trial', 'iti', 'cueOn', 'cueOff', 'servo', 'lick', 'reward']
+
+# Checksum of each record (sum of all other bytes modulo 256)
+def checksum(data: np.ndarray):
+    return (data[..., :record_size - 1].astype(np.uint32).sum(axis=-1) & 0xFF).astype(np.uint8)
+
+# Pack events into records (e.g. to simulate a session); all arguments are arrays of the same length
+def encode(code: np.ndarray, ms: np.ndarray, trial: np.ndarray | int = 0, port: np.ndarray | int = 0, value: np.ndarray | float = 0):
+    records = np.zeros(np.shape(code), dtype=record_dtype)
+    records['sync'] = sync_byte
+    records['code'] = code
+    records['trial'] = trial
+    records['ms'] = ms
+    records['value'] = value
+    records['port'] = port
+    records['checksum'] = checksum(records.view(np.uint8).reshape(-1, record_size))
+    return records.tobytes()
+
+# Find the records in a byte stream, skipping text (e.g. the header lines printed in setup) and corrupted bytes
+# Records are read back to back from each valid record; after a bad record the stream is resynchronized
+# at the next offset holding a sync byte, a known event code and a matching checksum
+def read_records(buffer: bytes | np.ndarray):
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    if data.shape[0] < record_size:
+        return np.zeros(0, dtype=record_dtype)
+
+    # Fast path: a clean stream of whole records
+    if data.shape[0] % record_size == 0:
+        records = data.reshape(-1, record_size)
+        if (records[:, 0] == sync_byte).all() and (checksum(records) == records[:, -1]).all() \
+                and np.isin(records[:, 1], list(event_codes.values())).all():
+            return data.view(record_dtype).copy()
+
+    # Valid record starts at every byte offset
+    windows = np.lib.stride_tricks.sliding_window_view(data, record_size)
+    valid = (windows[:, 0] == sync_byte) & np.isin(windows[:, 1], list(event_codes.values()))
+    candidates = np.flatnonzero(valid)
+    valid[candidates] = checksum(windows[candidates]) == windows[candidates, -1]
+    candidates = np.flatnonzero(valid)
+
+    offsets = []
+    position = 0
+    while True:
+        i = np.searchsorted(candidates, position)
+        if i == candidates.shape[0]:
+            break
+        start = candidates[i]
+        run = valid[start::record_size]
+        length = run.shape[0] if run.all() else np.argmin(run)
+        offsets.append(start + record_size * np.arange(length))
+        position = start + record_size * length
+
+    offsets = np.concatenate(offsets) if len(offsets) > 0 else np.zeros(0, dtype=int)
+    skipped = data.shape[0] - record_size * offsets.shape[0]
+    if skipped > 0:
+        print(f"WARNING: Skipped {skipped} bytes of text or corrupted records in binary log.")
+    return windows[offsets].copy().view(record_dtype)[:, 0]
+
+# Decode records into the same columns as the text parser (arduino_log_parse.LogParser)
+# One row per run of records with the same time stamp; within a row, the first event of each kind is kept.
+# Cues take the latest trial number logged before them, and a lick bout record sets the lick count of the latest row
+# (the current row if it already has a lick, otherwise the row before it)
+def event_table(records: np.ndarray, columns: list[str] = key_list):
+    code = records['code']
+    is_event = code != event_codes['bout']
+    events = records[is_event]
+    position = np.flatnonzero(is_event)
+    ms = events['ms'].astype(np.int64)
+
+    # Rows
+    new_row = np.ones(events.shape[0], dtype=bool)
+    new_row[1:] = ms[1:] != ms[:-1]
+    row = np.cumsum(new_row) - 1
+    num_rows = int(new_row.sum())
+    table = {key: np.full(num_rows, '', dtype=object) for key in key_list}
+
+    # First event of each kind in each row
+    def fill(key: str, mask: np.ndarray, values):
+        rows, first = np.unique(row[mask], return_index=True)
+        values = np.broadcast_to(np.asarray(values, dtype=object), mask.shape)[mask]
+        table[key][rows] = values[first]
+
+    def has(*names):
+        return np.isin(events['code'], [event_codes[x] for x in names])
+
+    # Trial number: logged by trial events, cues repeat the latest one (0 before any)
+    with_trial = has(*trial_events)
+    trial_position = np.flatnonzero(with_trial)
+    latest = np.searchsorted(trial_position, np.arange(events.shape[0]), side='left') - 1
+    trial_number = np.where(with_trial, events['trial'], np.where(latest >= 0, events['trial'][trial_position[np.clip(latest, 0, None)]], 0))
+    fill('Trial Number', with_trial | has('cueOn', 'cueOff'), trial_number.astype(int))
+    fill('Port', has(*port_events), events['port'].astype(int))
+    fill('Cue', has('cueOn', 'cueOff'), np.where(has('cueOn'), 'On', 'Off'))
+    fill('Lever Press', has('levPress'), 1)
+    fill('Servos', has('servo'), 'TRUE')
+    fill('Syncs', has('sync'), 'TRUE')
+    fill('Force', has('force'), np.round(events['value'].astype(float), 2))
+    fill('# of Licks', has('lick'), 1)
+    fill('Reward', has('reward'), 'TRUE')
+
+    # Lick bouts update the lick count of the latest row
+    bouts = np.flatnonzero(~is_event)
+    before = np.searchsorted(position, bouts) - 1
+    bouts, before = bouts[before >= 0], before[before >= 0]
+    licks = np.flatnonzero(has('lick'))
+    latest_lick = np.searchsorted(licks, before, side='right') - 1
+    lick_row = np.where(latest_lick >= 0, row[licks[np.clip(latest_lick, 0, None)]] if licks.shape[0] > 0 else -1, -1)
+    target = np.where(lick_row == row[before], row[before], row[before] - 1)
+    keep = target >= 0
+    table['# of Licks'][target[keep]] = records['trial'][bouts[keep]].astype(int)
+
+    # Time in seconds from the first row
+    time = ms[new_row]
+    table['Time'] = (time - time[0]) / 1000 if num_rows > 0 else time.astype(float)
+    return {key: table[key] for key in columns}
+
+# Render records as the text lines the sketches print when binaryLog = 0
+def text_lines(records: np.ndarray):
+    names = {y: x for x, y in event_codes.items()}
+    lines = []
+    for x in records:
+        name, ms, trial, port = names.get(int(x['code'])), int(x['ms']), int(x['trial']), int(x['port'])
+        if name == 'session':
+            lines.append(f"START SESSION, ms={ms}")
+        elif name == 'end':
+            lines.append(f"END SESSION, numTrials={trial}, ms={ms}")
+        elif name == 'trial':
+            lines.append(f"trialNum={trial}, port={port}, ms={ms}")
+        elif name == 'iti':
+            lines.append(f"iti={int(x['value'])}, trialNum={trial}, port={port}, ms={ms}")
+        elif name in ['cueOn', 'cueOff']:
+            lines.append(f"{name}, port={port}, ms={ms}")
+        elif name == 'servo':
+            lines.append(f"moveServo, trialNum={trial}, port={port}, ms={ms}")
+        elif name == 'levPress':
+            lines.append(f"levPress, ms={ms}")
+        elif name == 'force':
+            lines.append(f"g={float(x['value']):.2f}, ms={ms}")
+        elif name == 'lick':
+            lines.append(f"lick, trialNum={trial}, port={port}, ms={ms}")
+        elif name == 'bout':
+            lines.append(f"{trial} licks in bout")
+        elif name == 'reward':
+            lines.append(f"REWARD, trialNum={trial}, port={port}, ms={ms}")
+        elif name == 'sync':
+            lines.append(f"syncOut, ms={ms}")
+    return lines
+
+# Read a binary log file
+def read_log(path: Path):
+    return read_records(np.fromfile(path, dtype=np.uint8))
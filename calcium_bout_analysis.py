@@ -1,140 +1,261 @@
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
 import numpy as np
-from scipy import signal, optimize
 import pandas as pd
 
 from phase_utils import filter_range
+from calcium_utils import channel, filtered_channel, lowpass_filter, pad_windows, fit_exp_batch, load_session, bout_index, BoutViews
+from excel_utils import StreamingWorkbook, WorkbookReader, read_sheet, sheet_names, replace_sheets
+from resampling import compare_metrics
+from session_db import store_bout_metrics
 
 # Set which time column to use: 'Time' or 'Original_Time'
 time_column = 'Original_Time'  # Or 'Original_Time' if preferred
 
-# Compute AUC on calcium data for bout
-def bout_auc(bout_calcium_data: np.ndarray, time: np.ndarray):
-    # Apply low-pass filter to smooth data
-    elapsed_time = time[-1] - time[0]
-    sr = int(bout_calcium_data.shape[0] / elapsed_time)
-    b, a = signal.butter(2, 2, fs=sr)
-    bout_calcium_filtered = signal.filtfilt(b, a, bout_calcium_data)
+# Bout metrics compared between rewarding and non-rewarding bouts across the cohort
+comparison_metrics = ['AUC Metric', 'Pre-Bout Calcium Slope', 'Pre-Bout Calcium ExpRate', 'Max Calcium']
 
+# Trapezoid rule (renamed from trapz in NumPy 2)
+trapezoid = np.trapezoid if hasattr(np, 'trapezoid') else np.trapz
+
+# Compute AUC on (pre-filtered) calcium data for bout
+def bout_auc(bout_calcium_filtered: np.ndarray):
     # Adjust filtered data to minimum point in bout and compute AUC
-    bout_calcium_filtered -= bout_calcium_filtered.min()
-    auc = np.trapz(bout_calcium_filtered, dx=1)
+    bout_calcium_adjusted = bout_calcium_filtered - bout_calcium_filtered.min()
+    auc = trapezoid(bout_calcium_adjusted, dx=1)
     return auc
 
-# Compute pre-bout calcium slope
-def bout_slope(bout_calcium: pd.DataFrame):
-    # Extract data for the first 0.5 seconds
-    pre_bout_calcium = bout_calcium[bout_calcium.index <= 0.5]
+# Find the end of the pre-bout window (first 0.5 seconds of the exported bout data)
+def pre_bout_end(time: np.ndarray):
+    return np.searchsorted(time, time[0] + 0.5, side='right')
 
-    # Check if pre_bout_calcium contains data
-    if pre_bout_calcium.empty:
+# Compute pre-bout calcium slope
+def bout_slope(pre_bout_calcium: np.ndarray, pre_bout_time: np.ndarray):
+    # Check if pre-bout window contains data
+    if pre_bout_calcium.shape[0] == 0:
         return np.nan
 
     # Calculate slope if data exists
-    pre_bout_rise = pre_bout_calcium['AIN01'].iloc[-1] - pre_bout_calcium['AIN01'].iloc[0]
-    pre_bout_rate = pre_bout_calcium.index[-1] - pre_bout_calcium.index[0]
+    pre_bout_rise = pre_bout_calcium[-1] - pre_bout_calcium[0]
+    pre_bout_rate = pre_bout_time[-1] - pre_bout_time[0]
     return pre_bout_rise / pre_bout_rate
 
-# Simple function to model an exponential curve
-def exp_curve(t, A, B, C):
-    return A * np.exp(B * t) + C
-
-# Compute pre-bout calcium exponential rise/decay rate
-def bout_exprate(bout_calcium: pd.DataFrame):
-    # Extract data for the first 0.5 seconds
-    pre_bout_calcium = bout_calcium[bout_calcium.index <= 0.5]
+# Compute pre-bout calcium exponential rise/decay rate for many bouts at once
+# Bouts that are missing or fail to fit are returned as NaN
+def bout_exprates(pre_bout_calcium: list[np.ndarray], pre_bout_time: list[np.ndarray]):
+    times = [x - x[0] if x.shape[0] > 0 else x for x in pre_bout_time]
 
-    # Check if pre_bout_calcium contains data
-    if pre_bout_calcium.empty:
-        return np.nan
+    # Perform exponential curve fitting on all pre-bout windows together
+    t, mask = pad_windows(times)
+    y, _ = pad_windows(pre_bout_calcium)
+    params = fit_exp_batch(t, y, mask)
+    return params[:, 1]
 
-    # Perform exponential curve fitting
-    t = pre_bout_calcium.index.to_numpy()
-    t -= t[0]
-    y = pre_bout_calcium['AIN01'].to_numpy()
-    params, _ = optimize.curve_fit(exp_curve, t, y, maxfev=10000)
-    A, B, C = params
-    return B
+# Compute pre-bout calcium exponential rise/decay rate
+def bout_exprate(pre_bout_calcium: np.ndarray, pre_bout_time: np.ndarray):
+    return bout_exprates([pre_bout_calcium], [pre_bout_time])[0]
 
 # Compute adjusted max calcium based on first value
 def bout_max(bout_calcium_data: np.ndarray):
     bout_calcium_adjusted = bout_calcium_data - bout_calcium_data[0]
     return bout_calcium_adjusted.max()
 
-# Compute various metrics on calcium bout     
-def main(arduino_stats: Path, sheet: str, calcium_bout_file: Path):
+# Compute various metrics on calcium bouts of one mouse
+# Returns the Bouts table with the metric columns added, or None if there are no bouts
+def bout_metrics(mouse_stats: pd.DataFrame, sheet: str, calcium_file: Path, channel: str = channel):
+    # Import the session calcium trace and locate each bout (±0.5 seconds) in it
+    session = load_session(calcium_file, time_column)
+    bouts = BoutViews(bout_index(sheet, mouse_stats, session.time), session)
+
+    # Check if calcium data for bouts exists
+    if len(bouts) == 0 or len(session) == 0:
+        print(f"No bout data found for {sheet}. Skipping.")
+        return None  # Skip if no bouts are available
+
+    # For each bout
+    metrics = {
+        'AUC Metric': [], 
+        'Pre-Bout Calcium Slope': [], 
+        'Pre-Bout Calcium ExpRate': [],
+        'Max Calcium': []
+    }
+    pre_bout_calcium = []
+    pre_bout_time = []
+    for bout in bouts:
+        # Retrieve corresponding calcium data for bout (views into the session trace)
+        bout_time = bouts.time(bout)
+        if bout_time.shape[0] == 0:
+            # If bout calcium data is missing, append NaNs for each metric
+            metrics['AUC Metric'].append(np.nan)
+            metrics['Pre-Bout Calcium Slope'].append(np.nan)
+            metrics['Max Calcium'].append(np.nan)
+            pre_bout_calcium.append(np.empty(0))
+            pre_bout_time.append(np.empty(0))
+            continue
+
+        bout_calcium_data = bouts.data(bout, channel)
+
+        # Use the session-filtered trace if available (older exports need filtering here)
+        if bouts.has(filtered_channel(channel)):
+            bout_calcium_filtered = bouts.data(bout, filtered_channel(channel))
+        else:
+            bout_calcium_filtered = lowpass_filter(bout_calcium_data, bout_time)
+
+        # Compute metrics
+        pre_end = pre_bout_end(bout_time)
+        metrics['AUC Metric'].append(bout_auc(bout_calcium_filtered))
+        metrics['Pre-Bout Calcium Slope'].append(bout_slope(bout_calcium_data[:pre_end], bout_time[:pre_end]))
+        metrics['Max Calcium'].append(bout_max(bout_calcium_data))
+        pre_bout_calcium.append(bout_calcium_data[:pre_end])
+        pre_bout_time.append(bout_time[:pre_end])
+
+    # Fit the pre-bout exponential rate for all bouts in one batch
+    metrics['Pre-Bout Calcium ExpRate'] = bout_exprates(pre_bout_calcium, pre_bout_time)
+    
+    # Create new data frame with updated metrics
+    metrics_frame = pd.DataFrame(metrics, index=mouse_stats.index)
+    mouse_stats = mouse_stats.copy()
+    mouse_stats[metrics_frame.columns] = metrics_frame
+    return mouse_stats
+
+# Worker wrapper so that a failing mouse does not stop the rest of the batch
+def analyze_mouse(mouse_stats: pd.DataFrame, sheet: str, calcium_file: Path):
     try:
-        # Import mouse stats and calcium bout-specific data
-        mouse_stats = pd.read_excel(arduino_stats, sheet_name=f'{sheet} Bouts')
-        calcium_data = pd.read_excel(calcium_bout_file, sheet_name=None, index_col=time_column)
-
-        # Check if calcium data for bouts exists
-        if f'Bout 1' not in calcium_data.keys():
-            print(f"No bout data found for {sheet}. Skipping.")
-            return  # Skip if no bouts are available
-
-        # For each bout
-        metrics = {
-            'AUC Metric': [], 
-            'Pre-Bout Calcium Slope': [], 
-            'Pre-Bout Calcium ExpRate': [],
-            'Max Calcium': []
-        }
-        for index, bout in mouse_stats.iterrows():
-            # Retrieve corresponding calcium data for bout
-            bout_calcium = calcium_data.get(f'Bout {index + 1}')
-            if bout_calcium is None or bout_calcium.empty:
-                # If bout calcium data is missing, append NaNs for each metric
-                metrics['AUC Metric'].append(np.nan)
-                metrics['Pre-Bout Calcium Slope'].append(np.nan)
-                metrics['Pre-Bout Calcium ExpRate'].append(np.nan)
-                metrics['Max Calcium'].append(np.nan)
-                continue
+        return bout_metrics(mouse_stats, sheet, calcium_file)
+    except Exception as e:
+        print(f"Error occurred while processing {sheet}: {e}")
+        return None
 
-            bout_calcium_data = bout_calcium['AIN01'].to_numpy()
-            bout_time = bout_calcium.index.to_numpy()
-
-            # Compute metrics
-            metrics['AUC Metric'].append(bout_auc(bout_calcium_data, bout_time))
-            metrics['Pre-Bout Calcium Slope'].append(bout_slope(bout_calcium))
-            metrics['Pre-Bout Calcium ExpRate'].append(bout_exprate(bout_calcium))
-            metrics['Max Calcium'].append(bout_max(bout_calcium_data))
-        
-        # Create new data frame with updated metrics
-        metrics_frame = pd.DataFrame(metrics, index=mouse_stats.index)
-        mouse_stats[metrics_frame.columns] = metrics_frame
-        
-        # Attempt to write to Excel
-        with pd.ExcelWriter(arduino_stats, mode='a', engine='openpyxl', if_sheet_exists='replace') as writer:
-            mouse_stats.to_excel(writer, sheet_name=f'{sheet} Bouts', index=False)
+# Replace the Bouts sheets of a stats workbook, rewriting it only once
+def update_stats(arduino_stats: Path, bout_frames: dict[str, pd.DataFrame]):
+    if len(bout_frames) == 0:
+        return
+    replace_sheets(arduino_stats, {f'{sheet} Bouts': mouse_stats for sheet, mouse_stats in bout_frames.items()}, index=False)
+    for sheet, mouse_stats in bout_frames.items():
+        store_bout_metrics(arduino_stats, sheet, mouse_stats)
 
+# Compute various metrics on calcium bout of a single mouse and update its stats workbook
+def main(arduino_stats: Path, sheet: str, calcium_file: Path):
+    try:
+        mouse_stats = read_sheet(arduino_stats, f'{sheet} Bouts')
+        mouse_stats = bout_metrics(mouse_stats, sheet, calcium_file)
+        if mouse_stats is not None:
+            update_stats(arduino_stats, {sheet: mouse_stats})
     except Exception as e:
         print(f"Error occurred while processing {sheet}: {e}")
 
-# Path to the directories containing the Arduino and calcium data
-arduino_dir = Path('parsed_data')
-arduino_stats_dir = Path('stats')
-calcium_dir = Path('stats')  # Updated to point to bout-specific calcium files
-
-# Iterate through each phase folder in the Arduino data directory
-for phase_folder in arduino_dir.glob('phase *'):
-    phase = phase_folder.name.split()[-1]
-
-    # Iterate through each Arduino file in the phase folder
-    for arduino_file in phase_folder.glob('phase*.xlsx'):
-        # Load the Excel file to get the sheet names (mouse IDs)
-        with pd.ExcelFile(arduino_file) as xls:
-            sheets = xls.sheet_names
-
-        # Iterate through each sheet name (mouse ID) in the Arduino file
-        for sheet in sheets:
-            # Construct the path to the bout-specific calcium file
-            calcium_bout_file = calcium_dir / f'phase {phase}' / f'{sheet}_bouts.xlsx'
-            
-            # Check if the bout file exists before processing
-            if calcium_bout_file.exists():
-                arduino_stats_file = arduino_stats_dir / f'phase {phase}' / f'{arduino_file.stem}-reward.xlsx'
-                print(f"Processing Arduino file: {arduino_stats_file}, Sheet: {sheet}, Calcium file: {calcium_bout_file}")
-                main(arduino_stats_file, sheet, calcium_bout_file)
-            else:
-                print(f"Calcium bout file not found for {sheet} in phase {phase}. Skipping.")
+# Analyzed bouts of all mice and days in a phase stats folder, with Day and Mouse columns
+def cohort_bouts(stats_folder: Path):
+    frames = []
+    for stats_file in sorted(stats_folder.glob('*-reward.xlsx')):
+        with WorkbookReader(stats_file) as workbook:
+            for sheet in workbook.sheet_names:
+                if not sheet.endswith(' Bouts'):
+                    continue
+                bouts = workbook.parse(sheet)
+                if all(x in bouts.columns for x in comparison_metrics):
+                    bouts.insert(0, 'Day', stats_file.stem.removesuffix('-reward'))
+                    bouts.insert(1, 'Mouse', sheet.removesuffix(' Bouts'))
+                    frames.append(bouts)
+    return pd.concat(frames, ignore_index=True) if len(frames) > 0 else pd.DataFrame()
+
+# Compare the metrics of rewarding and non-rewarding bouts of a phase, pooled over the cohort and for each mouse
+# (bootstrap confidence interval of the mean difference and permutation p-value, see resampling.py)
+# Writes stats/phase N/bout_comparison.xlsx
+def cohort_comparison(stats_folder: Path, executor: ProcessPoolExecutor | None = None):
+    bouts = cohort_bouts(stats_folder)
+    if bouts.empty:
+        return
+    groups = [('All', bouts)] + list(bouts.groupby('Mouse', sort=True))
+    comparisons = []
+    for mouse, mouse_bouts in groups:
+        rewarding = mouse_bouts['Rewarding'].astype(bool)
+        comparison = compare_metrics(mouse_bouts[rewarding], mouse_bouts[~rewarding], comparison_metrics, ('Rewarding', 'Non-Rewarding'), executor)
+        comparison.insert(0, 'Mouse', mouse)
+        comparisons.append(comparison)
+    with StreamingWorkbook(stats_folder / 'bout_comparison.xlsx') as workbook:
+        workbook.write_frame('Rewarding vs Non-Rewarding', pd.concat(comparisons, ignore_index=True), index=False)
+    print(f"Compared rewarding and non-rewarding bouts in {stats_folder}")
+
+# Find (stats workbook, mouse ID, calcium file) jobs, grouped by stats workbook
+def find_jobs(arduino_dir: Path, arduino_stats_dir: Path, calcium_dir: Path):
+    jobs = {}
+
+    # Iterate through each phase folder in the Arduino data directory
+    for phase_folder in arduino_dir.glob('phase *'):
+        phase = phase_folder.name.split()[-1]
+
+        # Iterate through each Arduino file in the phase folder
+        for arduino_file in phase_folder.glob('phase*.xlsx'):
+            # Get the sheet names (mouse IDs) without parsing the sheets
+            sheets = sheet_names(arduino_file)
+
+            # Iterate through each sheet name (mouse ID) in the Arduino file
+            arduino_stats_file = arduino_stats_dir / f'phase {phase}' / f'{arduino_file.stem}-reward.xlsx'
+            for sheet in sheets:
+                # Construct the path to the parsed calcium file
+                calcium_file = calcium_dir / f'phase {phase}' / f'{sheet}.xlsx'
+                
+                # Check if the calcium file exists before processing
+                if calcium_file.exists():
+                    jobs.setdefault(arduino_stats_file, []).append((sheet, calcium_file))
+                else:
+                    print(f"Calcium file not found for {sheet} in phase {phase}. Skipping.")
+
+    return jobs
+
+# Compute bout metrics for all mice in a process pool and write each stats workbook once
+def process_all(workers: int | None = None):
+    # Path to the directories containing the Arduino and calcium data
+    arduino_dir = Path('parsed_data')
+    arduino_stats_dir = Path('stats')
+    calcium_dir = Path('parsed_data')
+
+    jobs = find_jobs(arduino_dir, arduino_stats_dir, calcium_dir)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {}
+        for arduino_stats_file, mice in jobs.items():
+            # Open the workbook once and parse only the Bouts sheets of the mice with calcium data
+            try:
+                workbook = WorkbookReader(arduino_stats_file)
+            except Exception as e:
+                print(f"Error reading {arduino_stats_file}: {e}")
+                continue
+
+            with workbook:
+                bout_sheets = {sheet: workbook.parse(f'{sheet} Bouts') for sheet, _ in mice if f'{sheet} Bouts' in workbook}
+            for sheet, calcium_file in mice:
+                mouse_stats = bout_sheets.get(sheet)
+                if mouse_stats is None:
+                    print(f"Worksheet '{sheet} Bouts' not found in {arduino_stats_file}. Skipping.")
+                    continue
+                print(f"Processing Arduino file: {arduino_stats_file}, Sheet: {sheet}, Calcium file: {calcium_file}")
+                future = executor.submit(analyze_mouse, mouse_stats, sheet, calcium_file)
+                futures[future] = (arduino_stats_file, sheet)
+
+        # Merge the updated Bouts tables in memory per stats workbook
+        results = {}
+        for future in as_completed(futures):
+            arduino_stats_file, sheet = futures[future]
+            mouse_stats = future.result()
+            if mouse_stats is not None:
+                results.setdefault(arduino_stats_file, {})[sheet] = mouse_stats
+
+    # Write each stats workbook exactly once
+    for arduino_stats_file, bout_frames in results.items():
+        try:
+            update_stats(arduino_stats_file, bout_frames)
+            print(f"Updated {len(bout_frames)} Bouts sheets in {arduino_stats_file}")
+        except Exception as e:
+            print(f"Error writing {arduino_stats_file}: {e}")
+
+    # Cohort comparison of each phase, with the resampling replicates spread over a process pool
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for stats_folder in sorted(arduino_stats_dir.glob('phase *')):
+            try:
+                cohort_comparison(stats_folder, executor)
+            except Exception as e:
+                print(f"Error comparing bouts in {stats_folder}: {e}")
+
+if __name__ == "__main__":
+    process_all()
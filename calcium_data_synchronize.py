@@ -1,38 +1,76 @@
 from pathlib import Path
+import tempfile
 import pandas as pd
 import numpy as np
 
+from calcium_utils import channel, channel_aliases, filtered_channel, derived_channels, isosbestic_dff, lowpass_filter, lowpass_filter_chunks, spool_session, channel_summary
+from excel_utils import StreamingWorkbook, replace_sheets, sheet_chunks, read_sheet, sheet_names
+
 # Helper function to find the closest index
 def find_closest_index(data, target):
     closest_index = data.index.get_indexer([target], method='nearest')[0]
     return data.index[closest_index]
 
+# Sample nearest to a target time in a sorted time array (same rule as find_closest_index, ties go to the later sample)
+def nearest_sample(time: np.ndarray, target: float):
+    right = np.searchsorted(time, target, side='left')
+    if right == 0:
+        return 0
+    if right == time.shape[0]:
+        return right - 1
+    return right - 1 if target - time[right - 1] < time[right] - target else right
+
+# Linear interpolation of (xp, fp) at x, reading only the part of xp and fp around x (e.g. from memory-mapped arrays)
+def interp_window(x: np.ndarray, xp: np.ndarray, fp: np.ndarray):
+    if x.shape[0] == 0:
+        return np.empty(0)
+    low = max(np.searchsorted(xp, x.min(), side='left') - 1, 0)
+    high = min(np.searchsorted(xp, x.max(), side='right') + 1, xp.shape[0])
+    return np.interp(x, xp[low:high], fp[low:high])
+
 # Synchronize Arduino and calcium timelines and split calcium data by experiment trials
-def main(arduino: Path, sheet: str, calcium: Path):
+# Every recorded channel is kept, derived dF/F channels are added (see calcium_utils.isosbestic_channels) and each
+# channel is low-pass filtered once; the Calcium column of the Arduino log is the analysed `channel`
+# With `chunk_rows`, the session is processed in blocks of rows instead of being loaded at once (see main_chunks)
+# The Arduino sheet with the Calcium column replaces the one in the parsed log, or is written to `arduino_output` instead
+# (e.g. by the work queue, which merges the sheets of all mice into the parsed log afterwards, see work_queue.py)
+# Errors are printed and the sheet is skipped, unless `raise_errors` is set (the pipeline and the work queue record failed units)
+def main(arduino: Path, sheet: str, calcium: Path, chunk_rows: int | None = None, arduino_output: Path | None = None, raise_errors: bool = False):
     try:
+        if chunk_rows is not None:
+            main_chunks(arduino, sheet, calcium, chunk_rows, arduino_output)
+            return
+
         # Import Arduino log and calcium trace data
-        arduino_data = pd.read_excel(arduino, index_col='Time', sheet_name=sheet)
-        calcium_data = pd.read_csv(calcium, index_col='Time')
+        arduino_data = read_sheet(arduino, sheet, index_col='Time')
+        calcium_data = pd.read_csv(calcium, index_col='Time').rename(columns=channel_aliases)
+
+        # Add the derived dF/F channels, then low-pass filter each full session trace once and keep it next to the raw signal
+        for name, (signal, control) in derived_channels(list(calcium_data.columns)).items():
+            calcium_data[name] = isosbestic_dff(calcium_data[signal].to_numpy(), calcium_data[control].to_numpy())
+        channels = list(calcium_data.columns)
+        for name in channels:
+            calcium_data[filtered_channel(name)] = lowpass_filter(calcium_data[name].to_numpy(), calcium_data.index.to_numpy())
 
         # Downsample calcium data using interpolation to match the length of Arduino data
         arduino_indices = arduino_data.index.values
         calcium_indices = calcium_data.index.values
-        downsampled_calcium = np.interp(arduino_indices, calcium_indices, calcium_data['AIN01'])
+        downsampled_calcium = np.interp(arduino_indices, calcium_indices, calcium_data[channel])
 
         # Append the downsampled calcium data as a new column in Arduino data
         arduino_data['Calcium'] = downsampled_calcium
 
-        # Save the updated Arduino data with downsampled calcium
-        with pd.ExcelWriter(arduino, engine='openpyxl', mode='a', if_sheet_exists='overlay') as writer:
-            arduino_data.to_excel(writer, sheet_name=sheet)
+        # Save the updated Arduino data with downsampled calcium (the workbook is rewritten, not appended to)
+        replace_sheets(arduino_output or arduino, {sheet: arduino_data})
 
-        # Create Excel file for calcium data
+        # Create streaming Excel file for calcium data
         dir_tree = list(calcium.parts)
         dir_tree[0] = 'parsed_data'
         new_calcium = Path(*dir_tree).with_suffix('.xlsx')
-        writer = pd.ExcelWriter(new_calcium)
+        workbook = StreamingWorkbook(new_calcium)
 
-        # Split calcium data by trial based on cue time
+        # Split calcium data by trial based on cue time, keeping the sample range of each trial for the summary
+        trials = {}
         cues = arduino_data['Cue'].dropna()
         cue_on = cues[cues == 'On']
         for i in range(cue_on.shape[0]):
@@ -47,7 +85,8 @@ def main(arduino: Path, sheet: str, calcium: Path):
                 pre_trial_data.index = pre_trial_data.index - pre_trial_data.index[0]  # Reset time to start at 0
                 pre_trial_data.reset_index(inplace=True)
                 pre_trial_data.rename(columns={'Time': 'Time'}, inplace=True)
-                pre_trial_data.to_excel(writer, sheet_name='Pre-Trial', index=False)
+                workbook.write_frame('Pre-Trial', pre_trial_data, index=False)
+                trials['Pre-Trial'] = (0, calcium_data.index.get_loc(start) + 1)
 
             # Save data for each trial with both 'Time' and 'Original_Time' columns
             trial_data = calcium_data.loc[start:end].copy()
@@ -55,13 +94,90 @@ def main(arduino: Path, sheet: str, calcium: Path):
             trial_data.index = trial_data.index - trial_data.index[0]  # Reset time to start at 0
             trial_data.reset_index(inplace=True)
             trial_data.rename(columns={'Time': 'Time'}, inplace=True)
-            trial_data.to_excel(writer, sheet_name=f'Trial {i + 1}', index=False)
+            workbook.write_frame(f'Trial {i + 1}', trial_data, index=False)
+            trials[f'Trial {i + 1}'] = (calcium_data.index.get_loc(start), calcium_data.index.get_loc(end) + 1)
+
+        # Save per-trial and per-session summary of each channel (min, max, mean, std, samples, sampling rate)
+        summary = channel_summary(calcium_data.index.to_numpy(), {x: calcium_data[x].to_numpy() for x in channels}, trials)
+        workbook.write_frame('Summary', summary)
 
-        writer.close()
+        workbook.close()
 
     except Exception as e:
+        if raise_errors:
+            raise
         print(f"Error processing sheet '{sheet}' in file '{arduino}': {e}")
 
+# Out-of-core version of main, with the same output
+# The calcium recording is spooled to memory-mapped files and filtered block by block; the parsed log is
+# streamed through in blocks while the downsampled calcium column is added, keeping only the cue onsets;
+# each trial sheet is then written block by block from the memory-mapped recording
+def main_chunks(arduino: Path, sheet: str, calcium: Path, chunk_rows: int, arduino_output: Path | None = None):
+    dir_tree = list(calcium.parts)
+    dir_tree[0] = 'parsed_data'
+    new_calcium = Path(*dir_tree).with_suffix('.xlsx')
+
+    with tempfile.TemporaryDirectory(dir=new_calcium.parent) as spool:
+        # Import calcium trace data, add the derived dF/F channels and low-pass filter each full session trace
+        session = spool_session(calcium, Path(spool), chunk_rows)
+        for i, (name, (signal, control)) in enumerate(derived_channels(list(session.channels)).items()):
+            derived = np.memmap(Path(spool) / f'derived{i}.bin', dtype=float, mode='w+', shape=session.time.shape)
+            session.channels[name] = isosbestic_dff(session.channels[signal], session.channels[control], derived, chunk_rows)
+        channels = list(session.channels)
+        for i, name in enumerate(channels):
+            filtered = np.memmap(Path(spool) / f'filtered{i}.bin', dtype=float, mode='w+', shape=session.time.shape)
+            session.channels[filtered_channel(name)] = lowpass_filter_chunks(session.channels[name], session.time, filtered, chunk_rows)
+
+        # Copy the Arduino log with the calcium trace interpolated at each row, keeping the cue onsets and last time stamp
+        cue_on = []
+        last_time = []
+        def write_arduino(workbook: StreamingWorkbook, name: str):
+            writer = None
+            for header, rows in sheet_chunks(arduino, name, chunk_rows):
+                time_column = header.index('Time')
+                names = [x for x in header if x != 'Time']
+                if 'Calcium' not in names:
+                    names.append('Calcium')
+                if writer is None:
+                    writer = workbook.open_sheet(name, names, 'Time', index=True)
+                if len(rows) == 0:
+                    continue
+                columns = {x: [row[i] for row in rows] for i, x in enumerate(header) if x != 'Time'}
+                time = np.array([row[time_column] for row in rows], dtype=float)
+                columns['Calcium'] = interp_window(time, session.time, session.channels[channel])
+                writer.write_columns(columns, time)
+                if 'Cue' in columns:
+                    cue_on.extend(time[[x == 'On' for x in columns['Cue']]])
+                last_time[:] = [time[-1]]
+        replace_sheets(arduino_output or arduino, {sheet: write_arduino})
+
+        # Split calcium data by trial based on cue time, writing each trial in blocks
+        trials = {}
+        def write_trial(workbook: StreamingWorkbook, name: str, start: int, end: int):
+            names = ['Time'] + list(session.channels) + ['Original_Time']
+            writer = workbook.open_sheet(name, names)
+            for i in range(start, end + 1, chunk_rows):
+                block = slice(i, min(i + chunk_rows, end + 1))
+                columns = {'Time': session.time[block] - session.time[start], 'Original_Time': session.time[block]}
+                columns.update({x: y[block] for x, y in session.channels.items()})
+                writer.write_columns(columns)
+            trials[name] = (start, end + 1)
+
+        with StreamingWorkbook(new_calcium) as workbook:
+            for i in range(len(cue_on)):
+                # Find the closest sample for each cue
+                start = nearest_sample(session.time, cue_on[i])
+                end = nearest_sample(session.time, last_time[0] if i == len(cue_on) - 1 else cue_on[i + 1])
+
+                # Save pre-trial and trial calcium data with both 'Time' and 'Original_Time' columns
+                if i == 0:
+                    write_trial(workbook, 'Pre-Trial', 0, start)
+                write_trial(workbook, f'Trial {i + 1}', start, end)
+
+            # Save per-trial and per-session summary of each channel (min, max, mean, std, samples, sampling rate)
+            summary = channel_summary(session.time, {x: session.channels[x] for x in channels}, trials, chunk_rows)
+            workbook.write_frame('Summary', summary)
+
 # Main function to process Arduino files
 def process_all():
     arduino_dir = Path('parsed_data')
@@ -77,9 +193,8 @@ def process_all():
                 # Extract the day from the Arduino filename
                 day = arduino_file.stem.split()[-1]
 
-                # Load the Excel file to get the sheet names (mouse IDs)
-                with pd.ExcelFile(arduino_file) as xls:
-                    sheets = xls.sheet_names
+                # Get the sheet names (mouse IDs) without parsing the sheets
+                sheets = sheet_names(arduino_file)
 
                 # Iterate through each sheet name (mouse ID) in the Arduino file
                 for sheet in sheets:
@@ -0,0 +1,110 @@
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from calcium_utils import channel, load_session, event_windows, peth_summary
+from excel_utils import StreamingWorkbook, read_sheet, sheet_names
+from phase_engine import events, seconds, reward_split, press_window_mask, press_reward_mask
+from phase_stats import phase1_spec, phase2_spec, phase3_spec
+
+# Peri-event window (seconds before and after each event)
+pre = 2
+post = 5
+
+# Offsets (s) of the baseline each window is shifted by before averaging (None for raw calcium)
+baseline = (-2, -0.5)
+
+# Task spec of each phase (reward rule of the 'reward' mode and press window)
+phase_specs = {'phase 1': phase1_spec, 'phase 2': phase2_spec, 'phase 3': phase3_spec}
+
+# Event times (ms) of each PETH category in a parsed log:
+# all licks, licks split like phase_utils.lick_reward_split (rewards printed with a press are ignored in phase 3, as in the stats),
+# licks split like phase_utils.lick_press_split (within the press window after the latest press) and lever presses
+def event_categories(arduino_data: pd.DataFrame, spec: dict):
+    lick_times, _ = events(arduino_data, '# of Licks')
+    press_times, _ = events(arduino_data, 'Lever Press')
+    reward_times, _ = events(arduino_data, 'Reward')
+    if spec['reward']['reward'] == 'reward_without_press':
+        reward_times = reward_times[~press_reward_mask(press_times, reward_times)]
+    _, not_rewarded = reward_split(reward_times, lick_times)
+
+    categories = {
+        'Licks': lick_times,
+        'Rewarded Licks': lick_times[~not_rewarded],
+        'Non-Rewarded Licks': lick_times[not_rewarded],
+    }
+    if spec['presses'] is not None:
+        after_press = press_window_mask(press_times, lick_times, spec.get('press_window', 5))
+        categories['Licks after Press'] = lick_times[after_press]
+        categories['Licks without Press'] = lick_times[~after_press]
+        categories['Presses'] = press_times
+    return categories
+
+# Peri-event matrices of one session, as {category: (event times (s), matrix)} with the shared window offsets (s)
+def peth_matrices(categories: dict, time: np.ndarray, trace: np.ndarray, pre: float = pre, post: float = post):
+    offsets = np.zeros(0)
+    matrices = {}
+    for name, ms in categories.items():
+        times = seconds(ms)
+        offsets, matrix = event_windows(time, trace, times, pre, post)
+        matrices[name] = (times, matrix)
+    return offsets, matrices
+
+# Compute the lick- and press-locked calcium responses of one mouse
+# Writes the mean, SEM and event counts to an Excel file and the heatmap-ready matrices (events x samples) to an .npz file next to it
+def main(arduino: Path, sheet: str, calcium: Path, output_file: Path, channel: str = channel):
+    try:
+        arduino_data = read_sheet(arduino, sheet, index_col='Time')
+        try:
+            session = load_session(calcium)
+        except FileNotFoundError:
+            print(f"Calcium data file '{calcium}' not found. Skipping this file.")
+            return
+        if channel not in session.channels:
+            print(f"No {channel} channel in {calcium}. Skipping this file.")
+            return
+
+        categories = event_categories(arduino_data, phase_specs[arduino.parent.name])
+        offsets, matrices = peth_matrices(categories, session.time, session.channels[channel])
+
+        mean = {}
+        sem = {}
+        counts = {}
+        for name, (times, matrix) in matrices.items():
+            mean[name], sem[name], _ = peth_summary(offsets, matrix, baseline)
+            counts[name] = int(np.isfinite(matrix).any(axis=1).sum())
+
+        index = pd.Index(np.round(offsets, 6), name='Time')
+        with StreamingWorkbook(output_file) as workbook:
+            workbook.write_frame('Mean', pd.DataFrame(mean, index=index))
+            workbook.write_frame('SEM', pd.DataFrame(sem, index=index))
+            workbook.write_frame('Events', pd.DataFrame({'Category': list(counts), '# of Events': list(counts.values())}), index=False)
+
+        arrays = {'offsets': offsets}
+        for name, (times, matrix) in matrices.items():
+            arrays[f'{name}/times'] = times
+            arrays[f'{name}/matrix'] = matrix
+        np.savez(output_file.with_suffix('.npz'), **arrays)
+
+    except Exception as e:
+        print(f"An error occurred while processing {sheet} in {arduino}: {e}. Skipping this sheet.")
+
+# Compute the PETHs of every mouse with calcium data
+def process_all():
+    arduino = Path('parsed_data')
+    arduino_stats = Path('stats')
+    calcium = Path('parsed_data')
+
+    for phase_folder in arduino.glob('phase *'):
+        phase = phase_folder.name.split()[-1]
+        for arduino_file in phase_folder.glob('phase*.xlsx'):
+            for sheet in sheet_names(arduino_file):
+                calcium_file = calcium / f'phase {phase}' / f'{sheet}.xlsx'
+                if calcium_file.exists():
+                    output_file = arduino_stats / f'phase {phase}' / f'{sheet}_peth.xlsx'
+                    output_file.parent.mkdir(parents=True, exist_ok=True)
+                    print(f"Processing Arduino file: {arduino_file}, Sheet: {sheet}, Calcium file: {calcium_file}")
+                    main(arduino_file, sheet, calcium_file, output_file)
+
+if __name__ == "__main__":
+    process_all()
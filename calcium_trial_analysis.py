@@ -1,8 +1,10 @@
+import re
 import pandas as pd
 import numpy as np
-from scipy.integrate import simps
 from pathlib import Path
-from scipy.stats import linregress
+from concurrent.futures import ProcessPoolExecutor
+
+from resampling import compare_metrics
 
 # Define the root directory containing all phase folders
 root_dir = Path('trials')
@@ -10,8 +12,16 @@ root_dir = Path('trials')
 # Set the fixed peak index for 0 seconds (244th value in the series)
 peak_index = 244
 
+# Trial metrics summarized per file and compared between rewarding and non-rewarding trials
+metric_columns = ['Amplitude', 'AUC', 'Rate of Increase', 'Decay', 'Amplitude (Z-Score)', 'Amplitude (Normalized)']
+
+# Labels in the trial file names marking rewarding and non-rewarding trials (e.g. 'day5_rewarding.xlsx' and 'day5_nonrewarding.xlsx')
+trial_groups = ('rewarding', 'nonrewarding')
+
 # Function to calculate metrics for a given file
 def calculate_metrics(file_path, output_dir):
+    from scipy.integrate import simpson
+
     # Load the Excel file
     df = pd.read_excel(file_path)
 
@@ -38,7 +48,7 @@ def calculate_metrics(file_path, output_dir):
         amplitude = calcium_trace[peak_index]
 
         # Calculate AUC (using Simpson's rule for numerical integration from 0 to 8 seconds)
-        auc = simps(calcium_trace[peak_index:], time[peak_index:])
+        auc = simpson(calcium_trace[peak_index:], x=time[peak_index:])
 
         # Calculate rate of increase (slope between the range from -2 seconds to 0 seconds)
         pre_peak_calcium = calcium_trace[:peak_index]
@@ -80,6 +90,8 @@ def calculate_metrics(file_path, output_dir):
 
 # Function to analyze each metrics file and compute the required values
 def analyze_metrics_file(file_path):
+    from scipy.stats import linregress
+
     # Load the metrics file
     df = pd.read_excel(file_path)
 
@@ -111,7 +123,7 @@ def analyze_metrics_file(file_path):
     # Compute rate of change (slope) for each metric using linear regression over trials
     trials = np.arange(1, len(df) + 1)  # Trial numbers (1, 2, 3, ...)
     
-    for metric in ['Amplitude', 'AUC', 'Rate of Increase', 'Decay', 'Amplitude (Z-Score)', 'Amplitude (Normalized)']:
+    for metric in metric_columns:
         # Drop NaN values for this metric
         valid_trials = ~np.isnan(df[metric])
         if valid_trials.sum() > 1:  # Only perform regression if more than one valid data point
@@ -122,24 +134,60 @@ def analyze_metrics_file(file_path):
 
     return results
 
-# Process each phase folder
-for phase in ['phase 1', 'phase 2', 'phase 3']:
-    input_dir = root_dir / phase
-    output_dir = root_dir / f'metrics_output_{phase}'
-    output_dir.mkdir(parents=True, exist_ok=True)
+# Pair the rewarding and non-rewarding metrics files of a folder by the rest of their name
+# Returns {name: {group: file}} for the names with both groups
+def group_pairs(files: list[Path], groups: tuple[str, str] = trial_groups):
+    pairs = {}
+    for file in files:
+        # Longest label first, since 'rewarding' is part of 'nonrewarding'
+        for group in sorted(groups, key=len, reverse=True):
+            pattern = re.compile(f'[-_ ]?{group}', re.IGNORECASE)
+            if pattern.search(file.stem):
+                pairs.setdefault(pattern.sub('', file.stem, count=1), {})[group] = file
+                break
+    return {name: files for name, files in pairs.items() if len(files) == len(groups)}
+
+# Compare each metric between the rewarding and non-rewarding trials of every file pair
+# with a bootstrap confidence interval of the mean difference and a permutation p-value
+def compare_metrics_files(files: list[Path], executor: ProcessPoolExecutor | None = None, groups: tuple[str, str] = trial_groups):
+    comparisons = []
+    for name, pair in group_pairs(files, groups).items():
+        a, b = (pd.read_excel(pair[x]) for x in groups)
+        comparison = compare_metrics(a, b, metric_columns, ('Rewarding', 'Non-Rewarding'), executor)
+        comparison.insert(0, 'File', name.removesuffix('_metrics'))
+        comparisons.append(comparison)
+    return pd.concat(comparisons, ignore_index=True) if len(comparisons) > 0 else pd.DataFrame()
+
+# Compute and summarize trial metrics for each phase folder
+def process_all(workers: int | None = None):
+    for phase in ['phase 1', 'phase 2', 'phase 3']:
+        input_dir = root_dir / phase
+        output_dir = root_dir / f'metrics_output_{phase}'
+        output_dir.mkdir(parents=True, exist_ok=True)
     
-    # Process each Excel file in the input directory
-    for file in input_dir.glob('*.xlsx'):
-        calculate_metrics(file, output_dir)
-
-    # Summarize all metrics files in the output directory for the current phase
-    summary_data = []
-    for file in output_dir.glob('*.xlsx'):
-        file_summary = analyze_metrics_file(file)
-        summary_data.append(file_summary)
-
-    # Convert the summary data to a DataFrame and save it as an Excel file
-    summary_output_file = root_dir / f'metrics_summary_{phase}.xlsx'
-    summary_df = pd.DataFrame(summary_data)
-    summary_df.to_excel(summary_output_file, index=False)
-    print(f"Summary of metrics for {phase} saved to {summary_output_file}")
+        # Process each Excel file in the input directory
+        for file in input_dir.glob('*.xlsx'):
+            calculate_metrics(file, output_dir)
+
+        # Summarize all metrics files in the output directory for the current phase
+        summary_data = []
+        for file in output_dir.glob('*.xlsx'):
+            file_summary = analyze_metrics_file(file)
+            summary_data.append(file_summary)
+
+        # Convert the summary data to a DataFrame and save it as an Excel file
+        summary_output_file = root_dir / f'metrics_summary_{phase}.xlsx'
+        summary_df = pd.DataFrame(summary_data)
+        summary_df.to_excel(summary_output_file, index=False)
+        print(f"Summary of metrics for {phase} saved to {summary_output_file}")
+
+        # Rewarding vs non-rewarding trials, with the resampling replicates spread over a process pool
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            comparison_df = compare_metrics_files(list(output_dir.glob('*_metrics.xlsx')), executor)
+        if not comparison_df.empty:
+            comparison_output_file = root_dir / f'metrics_comparison_{phase}.xlsx'
+            comparison_df.to_excel(comparison_output_file, index=False)
+            print(f"Rewarding vs non-rewarding comparison for {phase} saved to {comparison_output_file}")
+
+if __name__ == "__main__":
+    process_all()
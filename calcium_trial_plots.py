@@ -1,52 +1,71 @@
 from pathlib import Path
 import numpy as np
-from scipy import stats
 import pandas as pd
-import matplotlib.pyplot as plt
 
-from phase_utils import filter_range, lick_reward_split
+from phase_utils import filter_range
+from phase_engine import events, time_ms, seconds, reward_split, press_reward_mask
+from calcium_utils import GroupedAccumulator, load_summary, channel
+from excel_utils import WorkbookReader, read_sheet, sheet_names
+
+# Output preset for trial plots (see plot_utils.render_presets, e.g. 'draft' for fast iteration)
+render_preset = 'publication'
+
+# How trial plots are written: 'files' (one file per trial), 'pdf' (one multi-page PDF per mouse)
+# or 'contact' (tiled contact-sheet PNGs with a contact_index.csv)
+output_mode = 'files'
 
 # Basic line plot of each trial
 # Includes markings for cue period, lever press, and licks
-def trial_plot(arduino: Path, sheet: str, calcium: Path):
+def trial_plot(arduino: Path, sheet: str, calcium: Path, preset: str = render_preset, workers: int | None = None, mode: str = output_mode, channel: str = channel):
+    from plot_utils import render_changed_trials
+
     try:
         # Import Arduino log and calcium trace data
-        arduino_data = pd.read_excel(arduino, index_col='Time', sheet_name=sheet)
-        calcium_data = pd.read_excel(calcium, index_col='Time', sheet_name=None)
-
-        # Get number of trials in data
-        cues = arduino_data['Cue'].dropna()
-        cue_on = cues[cues == 'On']
-        cue_off = cues[cues == 'Off']
+        arduino_data = read_sheet(arduino, sheet, index_col='Time')
+        with WorkbookReader(calcium) as workbook:
+            trial_sheets = [x for x in workbook.sheet_names if x != 'Summary']
+            calcium_data = {x: workbook.parse(x, index_col='Original_Time') for x in trial_sheets}
+            summary = load_summary(workbook, channel)
+
+        # Get number of trials in data (event times in ms)
+        cue_times, cue_values = events(arduino_data, 'Cue')
+        cue_on = cue_times[cue_values == 'On']
+        cue_off = cue_times[cue_values == 'Off']
         num_trials = cue_on.shape[0]
 
         # Get licks and rewards
-        licks = arduino_data['# of Licks'].dropna()
-        rewards = arduino_data['Reward'].dropna()
+        lick_times, _ = events(arduino_data, '# of Licks')
+        reward_times, _ = events(arduino_data, 'Reward')
 
-        # Get lever press data if Phase 3
+        # Get lever press data if Phase 3 (rewards printed with a press are ignored)
         if 'phase 3' in arduino.stem:
-            presses = arduino_data['Lever Press'].dropna()
-            press_reward = [x for x in rewards.index if np.min(np.abs(presses.index - x)) < 0.005]
-            rewards = rewards.loc[rewards.index.difference(press_reward)]
+            press_times, _ = events(arduino_data, 'Lever Press')
+            reward_times = reward_times[~press_reward_mask(press_times, reward_times)]
 
         # Split licks into rewarding/non-rewarding
-        licks_rewarded, licks_not_rewarded = lick_reward_split(rewards, licks)
+        _, not_rewarded = reward_split(reward_times, lick_times)
+        licks_rewarded = lick_times[~not_rewarded]
+        licks_not_rewarded = lick_times[not_rewarded]
 
         # Set up output directories
         dir_tree = '/'.join(arduino.parts[1:-1])
         output_dir = Path(f'plots/{dir_tree}/{calcium.stem}/trials')
         output_dir.mkdir(parents=True, exist_ok=True)
 
-        # Get maximum point in calcium data
-        max_calcium = np.max([calcium_data[trial]['AIN01'].max() for trial in calcium_data])
+        # Get maximum point in calcium data (from the summary index when available)
+        if summary is not None:
+            max_calcium = summary.loc['Session', 'Max']
+        else:
+            max_calcium = np.max([calcium_data[trial][channel].max() for trial in calcium_data])
 
-        # For each trial
+        # Collect the data of each trial for the renderer
+        trials = []
         for trial in range(num_trials):
             try:
                 # Mark cue on and cue off times
-                cue_on_time = cue_on.index[trial]
-                cue_off_time = cue_off.index[trial]
+                cue_on_time = cue_on[trial]
+                cue_off_time = cue_off[trial]
+                cue_on_seconds = seconds(cue_on_time)
 
                 # Retrieve calcium data and adjust index
                 calcium_trial = calcium_data[f'Trial {trial + 1}']
@@ -54,9 +73,9 @@ def trial_plot(arduino: Path, sheet: str, calcium: Path):
                 # If past the first trial
                 if trial > 0:
                     prev_trial = calcium_data[f'Trial {trial}']
-                    trial_twosec = filter_range(prev_trial, [cue_on_time - 2, cue_on_time])
+                    trial_twosec = filter_range(prev_trial, [cue_on_seconds - 2, cue_on_seconds])
                     calcium_trial = pd.concat((trial_twosec, calcium_trial))
-                    data_start = cue_on_time - 2
+                    data_start = cue_on_time - 2000
                     axis_start = -2
                     tick_start = -2
                 else:
@@ -66,62 +85,91 @@ def trial_plot(arduino: Path, sheet: str, calcium: Path):
 
                 # Mark end range of plot based on trial duration
                 if trial + 1 < num_trials:
-                    data_end = cue_on.index[trial + 1]
-                    axis_end = data_end - cue_on_time
+                    data_end = cue_on[trial + 1]
                 else:
-                    data_end = arduino_data.index[-1]
-                    axis_end = data_end - cue_on_time
+                    data_end = time_ms(arduino_data.index[-1:])[0]
+                axis_end = float(seconds(data_end - cue_on_time))
 
                 # Extract rewarded and non-rewarded licks
-                licks_rewarded_trial = filter_range(licks_rewarded, [data_start, data_end])
-                licks_not_rewarded_trial = filter_range(licks_not_rewarded, [data_start, data_end])
-
-                # Create plot
-                plt.figure()
-                plt.plot(calcium_trial.index - cue_on_time, calcium_trial['AIN01'], color='#218BFF')
-                plt.axvline(0, color='#000000', linestyle='--', label='Cue Start')
-                plt.axvspan(0, cue_off_time - cue_on_time, alpha=0.2, color='#218BFF', label='Cue On')
+                licks_rewarded_trial = licks_rewarded[(licks_rewarded >= data_start) & (licks_rewarded <= data_end)]
+                licks_not_rewarded_trial = licks_not_rewarded[(licks_not_rewarded >= data_start) & (licks_not_rewarded <= data_end)]
 
                 # Phase 3 specific - mark lever press time
+                press_cue = None
                 if 'phase 3' in arduino.stem:
-                    press_cue = filter_range(presses, [cue_on_time, data_end])
-                    if not press_cue.empty:
-                        first_press = press_cue.index[0]
-                        last_press = press_cue.index[-1]
-                        plt.axvline(press_cue.index - cue_on_time, color='#FF0000', linestyle='--', label='Lever Press')
-                        plt.axvspan(first_press - cue_on_time, last_press - cue_on_time + 5, alpha=0.2, color='#4B0092', label='Lever Press Time')
-
-                # Mark licks
-                plt.scatter(licks_rewarded_trial.index - cue_on_time, np.ones(licks_rewarded_trial.shape[0]) * max_calcium + 0.5, marker='|', color='#DD7815', label='Rewarding Licks')
-                plt.scatter(licks_not_rewarded_trial.index - cue_on_time, np.ones(licks_not_rewarded_trial.shape[0]) * max_calcium + 0.5, marker='|', color='#000000', label='Non-Rewarding Licks')
-
-                plt.xlabel('Time (s)')
-                plt.ylabel(r"$\Delta F/F$")
-                plt.xlim(axis_start, axis_end)
-                plt.xticks(np.arange(tick_start, axis_end, 2))
-                plt.ylim(top=max_calcium + 1)
-                plt.legend(loc='lower center', bbox_to_anchor=(0.5, 1.0), ncol=3)
-                plt.tight_layout()
-                plt.savefig(output_dir / f'trial{trial + 1}.png', dpi=600)
-                plt.close()
+                    press_cue = seconds(press_times[(press_times >= cue_on_time) & (press_times <= data_end)] - cue_on_time)
+
+                trials.append({
+                    'trial': trial + 1,
+                    'output': output_dir / f'trial{trial + 1}.png',
+                    'time': (calcium_trial.index - cue_on_seconds).to_numpy(dtype=float),
+                    'calcium': calcium_trial[channel].to_numpy(dtype=float),
+                    'cue_off': float(seconds(cue_off_time - cue_on_time)),
+                    'presses': press_cue,
+                    'licks_rewarded': seconds(licks_rewarded_trial - cue_on_time),
+                    'licks_not_rewarded': seconds(licks_not_rewarded_trial - cue_on_time),
+                    'max_calcium': max_calcium,
+                    'axis_start': axis_start,
+                    'axis_end': axis_end,
+                    'tick_start': tick_start
+                })
             except Exception as e:
                 print(f"Error processing trial {trial + 1}: {e}")
+
+        # Render changed trials in parallel, reusing one figure per worker
+        render_changed_trials(trials, output_dir, preset, workers, mode)
     except Exception as e:
         print(f"Error processing sheet {sheet}: {e}")
 
+# Accumulate average traces for rewarding/non-rewarding trials of one mouse
+# Trials are read and added one at a time; they are also added to the cohort accumulator if given
+def trial_average_traces(arduino_stats: Path, sheet: str, calcium: Path, cohort: GroupedAccumulator | None = None, group: tuple = (), channel: str = channel):
+    # Import statistics
+    mouse_stats = read_sheet(arduino_stats, f'{sheet} Trial Stats')
+
+    mouse_stats = mouse_stats.set_index(mouse_stats.columns[0])
+    if 'Trial 0' in mouse_stats.index:
+        mouse_stats = mouse_stats.drop('Trial 0')
+    mouse_stats = mouse_stats.drop('Trial 1')
+    rewarding_trials = mouse_stats.dropna().index
+    non_rewarding_trials = mouse_stats.index.difference(rewarding_trials)
+
+    # Stream rewarding and non-rewarding trials into separate accumulators
+    accumulator = GroupedAccumulator()
+    trial_split = {'rewarding': rewarding_trials, 'nonrewarding': non_rewarding_trials}
+    with WorkbookReader(calcium) as workbook:
+        for figure_name, split in trial_split.items():
+            for trial in split:
+                if trial not in workbook:
+                    print(f"{trial} not found in calcium data for {sheet}. Skipping.")
+                    continue
+                trial_calcium = workbook.parse(trial, index_col='Time')
+                time = trial_calcium.index.to_numpy(dtype=float)
+                trace = trial_calcium[channel].to_numpy(dtype=float)
+                accumulator.add((figure_name,), time, trace)
+                if cohort is not None:
+                    cohort.add(group + (figure_name,), time, trace)
+
+    return accumulator
+
+# Plot an average trace with its SEM band
+def average_plot(time: np.ndarray, calcium_mean: np.ndarray, calcium_sem: np.ndarray, output: Path):
+    import matplotlib.pyplot as plt
+
+    plt.figure()
+    plt.plot(time, calcium_mean, color='#218BFF')
+    plt.fill_between(time, calcium_mean - calcium_sem, calcium_mean + calcium_sem, color='#218BFF', alpha=0.2)
+    plt.xlabel('Time (s)')
+    plt.ylabel(r"$\Delta F/F$")
+    plt.xticks(np.arange(0, time[-1], 2))
+    plt.tight_layout()
+    plt.savefig(output, dpi=600)
+    plt.close()
+
 # Compute average plot for rewarding/non-rewarding trials
-def trial_average_plot(arduino_stats: Path, sheet: str, calcium: Path):
+def trial_average_plot(arduino_stats: Path, sheet: str, calcium: Path, cohort: GroupedAccumulator | None = None, group: tuple = (), channel: str = channel):
     try:
-        # Import statistics and calcium data
-        mouse_stats = pd.read_excel(arduino_stats, sheet_name=f'{sheet} Trial Stats')
-        calcium_data = pd.read_excel(calcium, sheet_name=None, index_col='Time')
-
-        mouse_stats = mouse_stats.set_index(mouse_stats.columns[0])
-        if 'Trial 0' in mouse_stats.index:
-            mouse_stats = mouse_stats.drop('Trial 0')
-        mouse_stats = mouse_stats.drop('Trial 1')
-        rewarding_trials = mouse_stats.dropna().index
-        non_rewarding_trials = mouse_stats.index.difference(rewarding_trials)
+        accumulator = trial_average_traces(arduino_stats, sheet, calcium, cohort, group, channel)
 
         # Set up output directories
         dir_tree = '/'.join(arduino_stats.parts[1:-1])
@@ -129,57 +177,50 @@ def trial_average_plot(arduino_stats: Path, sheet: str, calcium: Path):
         output_dir.mkdir(parents=True, exist_ok=True)
         
         # Plot rewarding and non-rewarding trials separately
-        trial_split = [rewarding_trials, non_rewarding_trials]
-        for index, split in enumerate(trial_split):
+        for (figure_name,), (time, calcium_mean, calcium_sem) in accumulator.results().items():
             try:
-                if split.shape[0] == 0:
-                    continue
-
-                calcium_trials = [calcium_data[x]['AIN01'].to_numpy() for x in split]
-                lengths = [x.shape[0] for x in calcium_trials]
-                min_index = np.argmin(lengths)
-                min_length = np.min(lengths)
-                calcium_trials = [x[:min_length] for x in calcium_trials]
-
-                calcium_mean = np.mean(calcium_trials, axis=0)
-                calcium_sem = stats.sem(calcium_trials, axis=0)
-
-                time = calcium_data[split[min_index]].index
-                time -= time[0]
-                time /= 1000
-
-                figure_name = 'rewarding' if index == 0 else 'nonrewarding'
-                plt.figure()
-                plt.plot(time, calcium_mean, color='#218BFF')
-                plt.fill_between(time, calcium_mean - calcium_sem, calcium_mean + calcium_sem, color='#218BFF', alpha=0.2)
-                plt.xlabel('Time (s)')
-                plt.ylabel(r"$\Delta F/F$")
-                plt.xticks(np.arange(0, time[-1], 2))
-                plt.tight_layout()
-                plt.savefig(output_dir / f'trials-average-{figure_name}.png', dpi=600)
-                plt.close()
+                average_plot(time, calcium_mean, calcium_sem, output_dir / f'trials-average-{figure_name}.png')
             except Exception as e:
                 print(f"Error processing {figure_name} trials: {e}")
     except Exception as e:
         print(f"Error processing sheet {sheet} averages: {e}")
 
-# Main processing loop
-arduino = Path('parsed_data')
-arduino_stats = Path('stats')
-calcium = Path('parsed_data')
-
-for phase_folder in arduino.glob('phase *'):
-    phase = phase_folder.name.split()[-1]
-
-    for arduino_file in phase_folder.glob('phase*.xlsx'):
-        with pd.ExcelFile(arduino_file) as xls:
-            sheets = xls.sheet_names
-
-        for sheet in sheets:
-            calcium_file = calcium / f'phase {phase}' / f'{sheet}.xlsx'
+# Plot cohort-wide average traces, one plot per group
+def cohort_average_plot(cohort: GroupedAccumulator, output_dir: Path):
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for key, (time, calcium_mean, calcium_sem) in cohort.results().items():
+        try:
+            average_plot(time, calcium_mean, calcium_sem, output_dir / f"cohort-average-{'-'.join(key)}.png")
+        except Exception as e:
+            print(f"Error processing cohort average {key}: {e}")
+
+# Group cohort-wide averages by any of 'phase', 'day' and 'mouse' (rewarding/non-rewarding is always split)
+cohort_groups = ['phase']
+
+# Plot trials and average traces of every mouse with calcium data, then the cohort averages
+def process_all():
+    arduino = Path('parsed_data')
+    arduino_stats = Path('stats')
+    calcium = Path('parsed_data')
+    cohort = GroupedAccumulator()
+
+    for phase_folder in arduino.glob('phase *'):
+        phase = phase_folder.name.split()[-1]
+
+        for arduino_file in phase_folder.glob('phase*.xlsx'):
+            for sheet in sheet_names(arduino_file):
+                calcium_file = calcium / f'phase {phase}' / f'{sheet}.xlsx'
             
-            if calcium_file.exists():
-                arduino_stats_file = arduino_stats / f'phase {phase}' / f'{arduino_file.stem}-reward.xlsx'
-                print(f"Processing Arduino file: {arduino_stats_file}, Sheet: {sheet}, Calcium file: {calcium_file}")
-                trial_plot(arduino_file, sheet, calcium_file)
-                trial_average_plot(arduino_stats_file, sheet, calcium_file)
+                if calcium_file.exists():
+                    arduino_stats_file = arduino_stats / f'phase {phase}' / f'{arduino_file.stem}-reward.xlsx'
+                    print(f"Processing Arduino file: {arduino_stats_file}, Sheet: {sheet}, Calcium file: {calcium_file}")
+                    labels = {'phase': f'phase {phase}', 'day': arduino_file.stem, 'mouse': sheet}
+                    group = tuple(labels[x] for x in cohort_groups)
+                    trial_plot(arduino_file, sheet, calcium_file)
+                    trial_average_plot(arduino_stats_file, sheet, calcium_file, cohort, group)
+
+    if len(cohort.groups) > 0:
+        cohort_average_plot(cohort, Path('plots'))
+
+if __name__ == "__main__":
+    process_all()
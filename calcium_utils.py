@@ -0,0 +1,515 @@
+from functools import lru_cache
+from pathlib import Path
+import os
+import warnings
+import numpy as np
+import pandas as pd
+
+from excel_utils import WorkbookReader
+
+# Calcium channel used by the trial, bout and PETH analyses: a recorded Doric column (e.g. 'AIN01') or a derived channel (e.g. 'dFF')
+# Every channel is stored by the synchronization, so switching channels needs no recomputation
+# Set the OPERANT_CALCIUM_CHANNEL environment variable (or `pipeline.py --channel`) to analyse another channel
+channel = os.environ.get('OPERANT_CALCIUM_CHANNEL', 'AIN01')
+
+# Column names of older recordings and the current name they are read as (the old Doric system writes 'Values')
+channel_aliases = {'Values': 'AIN01'}
+
+# Derived dF/F channels added by the synchronization when both channels are recorded: name -> (signal, isosbestic control)
+# e.g. a 465 nm signal on AIN01 and a 405 nm control on AIN02
+isosbestic_channels = {'dFF': ('AIN01', 'AIN02')}
+
+# Name of the low-pass filtered copy of a channel stored next to it
+def filtered_channel(name: str):
+    return f'{name} Filtered'
+
+# Estimate the sampling rate (Hz) of a trace from its time stamps
+def sampling_rate(time: np.ndarray):
+    elapsed_time = time[-1] - time[0]
+    return int(round((time.shape[0] - 1) / elapsed_time))
+
+# Design the smoothing low-pass filter once per sampling rate
+@lru_cache(maxsize=None)
+def lowpass_sos(sr: int, cutoff: float = 2, order: int = 2):
+    from scipy import signal
+    return signal.butter(order, cutoff, fs=sr, output='sos')
+
+# Apply zero-phase low-pass filter to a full calcium trace
+def lowpass_filter(calcium_data: np.ndarray, time: np.ndarray, cutoff: float = 2):
+    from scipy import signal
+    sos = lowpass_sos(sampling_rate(time), cutoff)
+    return signal.sosfiltfilt(sos, calcium_data)
+
+# Zero-phase low-pass filter of a trace too long to filter in memory, written to `out` (e.g. a memory-mapped array)
+# Runs the same passes as lowpass_filter (scipy.signal.sosfiltfilt with odd padding) in blocks of `chunk_rows` samples,
+# carrying the filter state from one block to the next, so the result is identical
+def lowpass_filter_chunks(calcium_data: np.ndarray, time: np.ndarray, out: np.ndarray, chunk_rows: int, cutoff: float = 2):
+    from scipy import signal
+    sos = lowpass_sos(sampling_rate(time), cutoff)
+    num_samples = calcium_data.shape[0]
+    edge = 3 * (2 * sos.shape[0] + 1 - min((sos[:, 2] == 0).sum(), (sos[:, 5] == 0).sum()))
+    if num_samples <= edge:
+        out[:] = lowpass_filter(np.asarray(calcium_data), np.asarray(time), cutoff)
+        return out
+    left = 2 * calcium_data[0] - np.asarray(calcium_data[edge:0:-1])
+    right = 2 * calcium_data[-1] - np.asarray(calcium_data[-2:-(edge + 2):-1])
+    zi = signal.sosfilt_zi(sos)
+
+    # Forward pass over the left padding, the trace and the right padding
+    _, z = signal.sosfilt(sos, left, zi=zi * left[0])
+    for start in range(0, num_samples, chunk_rows):
+        out[start:start + chunk_rows], z = signal.sosfilt(sos, calcium_data[start:start + chunk_rows], zi=z)
+    right, _ = signal.sosfilt(sos, right, zi=z)
+
+    # Backward pass, starting from the end of the right padding
+    _, z = signal.sosfilt(sos, right[::-1], zi=zi * right[-1])
+    for end in range(num_samples, 0, -chunk_rows):
+        start = max(end - chunk_rows, 0)
+        block, z = signal.sosfilt(sos, out[start:end][::-1], zi=z)
+        out[start:end] = block[::-1]
+    return out
+
+# Number of samples summed at a time by isosbestic_fit (fixed, so in-memory and memory-mapped traces give the same fit)
+fit_block_size = 2 ** 16
+
+# Least-squares fit of the isosbestic control to the signal (signal ~ slope * control + intercept)
+# The sums are accumulated in blocks (e.g. from memory-mapped arrays), relative to the first sample
+def isosbestic_fit(signal: np.ndarray, control: np.ndarray):
+    num_samples = signal.shape[0]
+    step = fit_block_size
+    x0, y0 = float(control[0]), float(signal[0])
+    sums = np.zeros(4)
+    for start in range(0, num_samples, step):
+        x = np.asarray(control[start:start + step], dtype=float) - x0
+        y = np.asarray(signal[start:start + step], dtype=float) - y0
+        sums += [x.sum(), y.sum(), x @ x, x @ y]
+    sx, sy, sxx, sxy = sums
+    slope = (num_samples * sxy - sx * sy) / (num_samples * sxx - sx * sx)
+    intercept = y0 + (sy - slope * sx) / num_samples - slope * x0
+    return slope, intercept
+
+# Motion-corrected dF/F of a signal: (signal - fitted control) / fitted control, with the control fitted once per session
+# Written to `out` if given (e.g. a memory-mapped array), `chunk_rows` samples at a time
+def isosbestic_dff(signal: np.ndarray, control: np.ndarray, out: np.ndarray | None = None, chunk_rows: int | None = None):
+    slope, intercept = isosbestic_fit(signal, control)
+    out = np.empty(signal.shape[0]) if out is None else out
+    step = chunk_rows or max(signal.shape[0], 1)
+    for start in range(0, signal.shape[0], step):
+        fitted = slope * np.asarray(control[start:start + step], dtype=float) + intercept
+        out[start:start + step] = (np.asarray(signal[start:start + step], dtype=float) - fitted) / fitted
+    return out
+
+# Derived dF/F channels that can be computed from the recorded channels
+def derived_channels(recorded: list[str]):
+    return {x: y for x, y in isosbestic_channels.items() if y[0] in recorded and y[1] in recorded and x not in recorded}
+
+# Simple function to model an exponential curve
+def exp_curve(t, A, B, C):
+    return A * np.exp(B * t) + C
+
+# Pack variable-length windows into a zero-padded matrix with a validity mask
+def pad_windows(windows: list[np.ndarray]):
+    lengths = np.array([len(x) for x in windows], dtype=int)
+    width = lengths.max() if lengths.shape[0] > 0 else 0
+    mask = np.arange(width) < lengths[:, None]
+    padded = np.zeros(mask.shape)
+    if mask.any():
+        padded[mask] = np.concatenate([np.asarray(x, dtype=float) for x in windows])
+    return padded, mask
+
+# Solve a batch of small linear systems, returning NaN for singular ones
+def batch_solve(a: np.ndarray, b: np.ndarray):
+    det = np.linalg.det(a)
+    singular = ~np.isfinite(det) | (np.abs(det) < 1e-300)
+    a = a.copy()
+    a[singular] = np.eye(a.shape[-1])
+    x = np.linalg.solve(a, b[..., None])[..., 0]
+    x[singular] = np.nan
+    return x
+
+# Initial estimate of A*exp(B*t) + C for many windows at once
+# Uses the integral equation y = a + B*S(t) + D*t, where S is the running integral of y,
+# followed by a linear least-squares solve for A and C given B
+def exp_initial_estimate(t: np.ndarray, y: np.ndarray, mask: np.ndarray):
+    # Running trapezoid integral of each window (padding contributes nothing)
+    dt = np.diff(t, axis=1) * (mask[:, 1:] & mask[:, :-1])
+    area = 0.5 * (y[:, 1:] + y[:, :-1]) * dt
+    s = np.concatenate((np.zeros((t.shape[0], 1)), np.cumsum(area, axis=1)), axis=1)
+
+    # Regress y on [1, S, t] to recover the rate B
+    design = np.stack((np.ones_like(t), s, t), axis=-1) * mask[..., None]
+    gram = np.einsum('nmi,nmj->nij', design, design)
+    moment = np.einsum('nmi,nm->ni', design, y * mask)
+    B = batch_solve(gram, moment)[:, 1]
+
+    # Given B, the model is linear in A and C
+    e = np.exp(B[:, None] * t) * mask
+    design = np.stack((e, mask.astype(float)), axis=-1)
+    gram = np.einsum('nmi,nmj->nij', design, design)
+    moment = np.einsum('nmi,nm->ni', design, y * mask)
+    A, C = batch_solve(gram, moment).T
+    return np.stack((A, B, C), axis=1)
+
+# Fit A*exp(B*t) + C to many windows at once with a damped Gauss-Newton refinement
+# Windows are given as padded (n, m) matrices of time and data with a validity mask
+# Returns an (n, 3) array of [A, B, C]; windows that cannot be fitted (fewer than 3 points, non-finite data) are NaN
+# Windows that have not converged after `max_iter` steps (typically nearly linear ones drifting towards B = 0,
+# or towards a spike on the last sample) keep their lowest-cost iterate instead of failing
+# B is not always curve_fit's B: on clear exponentials the two agree wherever curve_fit reaches the same minimum
+# (from its default start of (1, 1, 1) it often stops in a worse one), but on noisy, nearly linear windows B is
+# poorly determined and can differ widely. About 4% of noisy synthetic windows then end up with a higher residual
+# than curve_fit's, mostly by less than 1% (the worst by 40%, where curve_fit fits a spike on the last sample);
+# see tests/test_fit_exp_batch.py
+def fit_exp_batch(
+    t: np.ndarray,
+    y: np.ndarray,
+    mask: np.ndarray,
+    max_iter: int = 1000,
+    tol: float = 1e-10
+):
+    t = np.where(mask, t, 0.0)
+    y = np.where(mask, y, 0.0)
+    params = np.full((t.shape[0], 3), np.nan)
+
+    # Need at least as many points as parameters
+    usable = (mask.sum(axis=1) >= 3) & np.isfinite(y).all(axis=1) & np.isfinite(t).all(axis=1)
+    if not usable.any():
+        return params
+    t, y, mask = t[usable], y[usable], mask[usable]
+
+    # Residuals and Jacobian of the model
+    def residuals(p: np.ndarray):
+        e = np.exp(p[:, 1:2] * t)
+        return (y - p[:, 0:1] * e - p[:, 2:3]) * mask, e
+
+    def cost_of(r: np.ndarray):
+        return np.einsum('nm,nm->n', r, r)
+
+    p = exp_initial_estimate(t, y, mask)
+    failed = ~np.isfinite(p).all(axis=1)
+    p[failed] = [1.0, 1.0, 1.0]  # Same starting point as curve_fit
+    r, e = residuals(p)
+    cost = cost_of(r)
+    damping = np.full(p.shape[0], 1e-3)
+    active = np.isfinite(cost)
+
+    for _ in range(max_iter):
+        if not active.any():
+            break
+        idx = np.where(active)[0]
+
+        # Levenberg-Marquardt step on the active windows (steps that overflow are rejected below)
+        with np.errstate(over='ignore', invalid='ignore'):
+            jac = np.stack((e[idx], p[idx, 0:1] * t[idx] * e[idx], np.ones_like(e[idx])), axis=-1) * mask[idx, :, None]
+            jtj = np.einsum('nmi,nmj->nij', jac, jac)
+            jtr = np.einsum('nmi,nm->ni', jac, r[idx])
+            diag = np.einsum('nii->ni', jtj)
+            lhs = jtj + (damping[idx, None] * np.maximum(diag, 1e-12))[..., None] * np.eye(3)
+            step = batch_solve(lhs, jtr)
+            p_new = p[idx] + step
+            r_new = (y[idx] - p_new[:, 0:1] * np.exp(p_new[:, 1:2] * t[idx]) - p_new[:, 2:3]) * mask[idx]
+            cost_new = cost_of(r_new)
+
+        # Accept steps that reduce the cost, otherwise increase damping
+        accept = np.isfinite(cost_new) & (cost_new <= cost[idx])
+        improvement = cost[idx] - cost_new
+        small = accept & ((improvement <= tol * (cost[idx] + tol))
+                          | (np.abs(step) <= tol * (np.abs(p[idx]) + tol)).all(axis=1))
+
+        good = idx[accept]
+        p[good] = p_new[accept]
+        r[good] = r_new[accept]
+        e[good] = np.exp(p[good, 1:2] * t[good])
+        cost[good] = cost_new[accept]
+        damping[good] = np.maximum(damping[good] * 0.3, 1e-12)
+        damping[idx[~accept]] *= 10
+
+        # Stop windows that converged or whose damping blew up
+        active[idx[small]] = False
+        active[idx[~accept & (damping[idx] > 1e12)]] = False
+
+    p[~np.isfinite(p).all(axis=1)] = np.nan
+    params[usable] = p
+    return params
+
+# Calcium trace of a full session stored as contiguous arrays
+class SessionTrace:
+    def __init__(self, time: np.ndarray, channels: dict[str, np.ndarray]):
+        self.time = time
+        self.channels = channels
+
+    def __len__(self):
+        return self.time.shape[0]
+
+# Copy a calcium recording (CSV) to memory-mapped arrays in `folder`, reading `chunk_rows` rows at a time
+# The arrays are float64 and stay on disk, so the session can be longer than memory
+def spool_session(calcium: Path, folder: Path, chunk_rows: int):
+    files = {}
+    for chunk in pd.read_csv(calcium, index_col='Time', chunksize=chunk_rows):
+        chunk = chunk.rename(columns=channel_aliases)
+        if len(files) == 0:
+            files = {x: open(folder / f'{i}.bin', 'wb') for i, x in enumerate(['Time'] + list(chunk.columns))}
+        files['Time'].write(chunk.index.to_numpy(dtype=float).tobytes())
+        for x in chunk.columns:
+            files[x].write(chunk[x].to_numpy(dtype=float).tobytes())
+    for file in files.values():
+        file.close()
+    arrays = {x: np.memmap(file.name, dtype=float, mode='r') for x, file in files.items()}
+    time = arrays.pop('Time')
+    return SessionTrace(time, arrays)
+
+# Stitch the trial sheets of a parsed calcium workbook back into one session trace
+# Only the trial sheets are parsed (through the shared sheet cache, see excel_utils.WorkbookReader)
+def load_session(calcium: Path, time_column: str = 'Original_Time'):
+    with WorkbookReader(calcium) as workbook:
+        frames = [workbook.parse(name) for name in workbook.sheet_names if name == 'Pre-Trial' or name.startswith('Trial ')]
+    if len(frames) == 0:
+        return SessionTrace(np.empty(0), {})
+
+    # Neighbouring trial sheets share their boundary sample
+    session = pd.concat(frames, ignore_index=True)
+    session = session.drop_duplicates(subset=time_column).sort_values(time_column)
+    time = session[time_column].to_numpy(dtype=float)
+    channels = {x: session[x].to_numpy(dtype=float) for x in session.columns if x != time_column}
+    return SessionTrace(time, channels)
+
+# Locate each bout (±padding seconds) in the session trace
+# Returns (Mouse, Bout, Start Sample, End Sample) rows, with End Sample exclusive
+def bout_index(mouse: str, bouts: pd.DataFrame, time: np.ndarray, padding: float = 0.5):
+    start = np.searchsorted(time, bouts['Start'].to_numpy(dtype=float) - padding, side='left')
+    end = np.searchsorted(time, bouts['End'].to_numpy(dtype=float) + padding, side='right')
+    return pd.DataFrame({
+        'Mouse': mouse,
+        'Bout': np.arange(1, bouts.shape[0] + 1),
+        'Start Sample': start,
+        'End Sample': end
+    })
+
+# Lazy access to bout windows, returned as views into the session arrays
+class BoutViews:
+    def __init__(self, index: pd.DataFrame, session: SessionTrace):
+        self.index = index.set_index('Bout')
+        self.session = session
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    def __iter__(self):
+        return iter(self.index.index)
+
+    def window(self, bout: int):
+        row = self.index.loc[bout]
+        return slice(int(row['Start Sample']), int(row['End Sample']))
+
+    def time(self, bout: int):
+        return self.session.time[self.window(bout)]
+
+    def data(self, bout: int, column: str = channel):
+        return self.session.channels[column][self.window(bout)]
+
+    def has(self, column: str):
+        return column in self.session.channels
+
+    # Materialize a bout as a DataFrame (only needed for human-readable exports)
+    def frame(self, bout: int, time_column: str = 'Original_Time'):
+        window = self.window(bout)
+        frame = {time_column: self.session.time[window]}
+        frame.update({x: y[window] for x, y in self.session.channels.items()})
+        return pd.DataFrame(frame)
+
+# Time grid from 0 to `span` seconds at `sr` Hz (a longer span gives the same points followed by new ones)
+def time_grid(span: float, sr: float):
+    return np.arange(0, span + 0.5 / sr, 1 / sr)
+
+# Streaming mean/SEM of traces resampled onto a fixed time grid (Welford updates)
+# Memory is O(samples) regardless of the number of traces
+class TraceAccumulator:
+    def __init__(self, grid: np.ndarray):
+        self.grid = grid
+        self.count = np.zeros(grid.shape[0], dtype=int)
+        self.mean = np.zeros(grid.shape[0])
+        self.m2 = np.zeros(grid.shape[0])
+        self.num_traces = 0
+
+    # Extend the grid with the points of a longer grid that starts with the same points (no trace covers them yet)
+    def extend(self, grid: np.ndarray):
+        added = grid.shape[0] - self.grid.shape[0]
+        if added <= 0:
+            return
+        self.grid = grid
+        self.count = np.append(self.count, np.zeros(added, dtype=int))
+        self.mean = np.append(self.mean, np.zeros(added))
+        self.m2 = np.append(self.m2, np.zeros(added))
+
+    # Add one trace (grid points outside the trace's time span are not counted)
+    def add(self, time: np.ndarray, trace: np.ndarray):
+        values = np.interp(self.grid, time, trace, left=np.nan, right=np.nan)
+        valid = np.isfinite(values)
+        self.count[valid] += 1
+        delta = values[valid] - self.mean[valid]
+        self.mean[valid] += delta / self.count[valid]
+        self.m2[valid] += delta * (values[valid] - self.mean[valid])
+        self.num_traces += 1
+
+    # Return grid, mean and SEM (ddof = 1, like scipy.stats.sem)
+    # If complete, only keep the grid points covered by every trace (like truncating to the shortest trace)
+    def result(self, complete: bool = True):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            sem = np.sqrt(self.m2 / (self.count - 1)) / np.sqrt(self.count)
+        mean = np.where(self.count > 0, self.mean, np.nan)
+        keep = self.count == self.num_traces if complete else self.count > 0
+        return self.grid[keep], mean[keep], sem[keep]
+
+# Streaming accumulators keyed by group, e.g. (phase, day, mouse, 'rewarding')
+# With a `grid`, every group uses it; otherwise each group has its own grid at the sampling rate of its first trace,
+# extended whenever a longer trace is added, so the order in which groups and traces arrive does not matter
+class GroupedAccumulator:
+    def __init__(self, grid: np.ndarray | None = None):
+        self.grid = grid
+        self.groups = {}
+        self.rates = {}
+
+    def add(self, key: tuple, time: np.ndarray, trace: np.ndarray):
+        if key not in self.groups:
+            if self.grid is None:
+                self.rates[key] = sampling_rate(time)
+            grid = self.grid if self.grid is not None else time_grid(time[-1] - time[0], self.rates[key])
+            self.groups[key] = TraceAccumulator(grid)
+        elif self.grid is None:
+            self.groups[key].extend(time_grid(time[-1] - time[0], self.rates[key]))
+        self.groups[key].add(time - time[0], trace)
+
+    def results(self, complete: bool = True):
+        return {x: y.result(complete) for x, y in self.groups.items()}
+
+# Number of matrix elements converted to float64 at a time by peth_summary
+summary_block_size = 2 ** 20
+
+# Peri-event windows of a session trace: the samples from `pre` seconds before to `post` seconds after
+# the sample nearest to each event, gathered in one indexing operation from a strided view of the NaN-padded trace
+# Returns the window offsets (s) and an (events, samples) float32 matrix, NaN where a window leaves the recording
+def event_windows(time: np.ndarray, trace: np.ndarray, events: np.ndarray, pre: float = 2, post: float = 5):
+    events = np.asarray(events, dtype=float)
+    num_samples = time.shape[0]
+    if num_samples < 2:
+        return np.zeros(0), np.full((events.shape[0], 0), np.nan, dtype=np.float32)
+    sr = sampling_rate(time)
+    offsets = np.arange(-int(round(pre * sr)), int(round(post * sr)) + 1)
+    matrix = np.full((events.shape[0], offsets.shape[0]), np.nan, dtype=np.float32)
+
+    # Nearest sample of each event (events outside the recording keep an empty window)
+    right = np.clip(np.searchsorted(time, events, side='left'), 1, num_samples - 1)
+    nearest = right - (events - time[right - 1] < time[right] - events)
+    recorded = (events >= time[0]) & (events <= time[-1])
+
+    # Window i of the padded trace starts `pre` seconds before sample i
+    padded = np.full(num_samples + offsets.shape[0] - 1, np.nan, dtype=np.float32)
+    padded[-offsets[0]:-offsets[0] + num_samples] = trace
+    matrix[recorded] = np.lib.stride_tricks.sliding_window_view(padded, offsets.shape[0])[nearest[recorded]]
+    return offsets / sr, matrix
+
+# Mean, SEM (ddof = 1, like scipy.stats.sem) and number of events of a peri-event matrix at each offset
+# With a `baseline` (start, end) range of offsets, each window is first shifted by its mean over that range
+# Missing samples (NaN) are left out; the matrix is summed in float64 blocks of rows
+def peth_summary(offsets: np.ndarray, matrix: np.ndarray, baseline: tuple[float, float] | None = None):
+    shift = np.zeros(matrix.shape[0])
+    if baseline is not None:
+        in_baseline = (offsets >= baseline[0]) & (offsets <= baseline[1])
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            shift = np.nanmean(matrix[:, in_baseline].astype(float), axis=1)
+
+    # Sums of values and squares in one pass (the windows are baseline-shifted or close to their mean, so there is no cancellation)
+    rows = max(summary_block_size // max(matrix.shape[1], 1), 1)
+    total = np.zeros(matrix.shape[1])
+    squares = np.zeros(matrix.shape[1])
+    count = np.zeros(matrix.shape[1], dtype=int)
+    for start in range(0, matrix.shape[0], rows):
+        block = matrix[start:start + rows].astype(float) - shift[start:start + rows, None]
+        valid = np.isfinite(block)
+        block[~valid] = 0
+        total += block.sum(axis=0)
+        squares += np.einsum('ij,ij->j', block, block)
+        count += valid.sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+        sem = np.sqrt(np.maximum(squares - total * mean, 0) / (count - 1)) / np.sqrt(count)
+    return mean, np.where(count > 1, sem, np.nan), count
+
+# Summary statistics of one trace
+# With `chunk_rows`, a long trace is summarized in blocks (mean and std then agree with NumPy to rounding)
+def trace_summary(time: np.ndarray, trace: np.ndarray, chunk_rows: int | None = None):
+    if chunk_rows is not None and trace.shape[0] > chunk_rows:
+        return trace_summary_chunks(time, trace, chunk_rows)
+    return {
+        'Min': np.nanmin(trace),
+        'Max': np.nanmax(trace),
+        'Mean': np.nanmean(trace),
+        'Std': np.nanstd(trace, ddof=1) if trace.shape[0] > 1 else np.nan,
+        'Samples': trace.shape[0],
+        'Sampling Rate': sampling_rate(time) if time.shape[0] > 1 and time[-1] > time[0] else np.nan
+    }
+
+# Summary statistics of a trace too long to load, computed in two passes over blocks of `chunk_rows` samples
+def trace_summary_chunks(time: np.ndarray, trace: np.ndarray, chunk_rows: int):
+    def blocks():
+        for start in range(0, trace.shape[0], chunk_rows):
+            block = np.asarray(trace[start:start + chunk_rows])
+            yield block[~np.isnan(block)]
+
+    count, total, low, high = 0, 0.0, np.nan, np.nan
+    for block in blocks():
+        if block.shape[0] > 0:
+            count += block.shape[0]
+            total += block.sum()
+            low = np.fmin(low, block.min())
+            high = np.fmax(high, block.max())
+    mean = total / count if count > 0 else np.nan
+    squares = sum(((x - mean) ** 2).sum() for x in blocks())
+    return {
+        'Min': low,
+        'Max': high,
+        'Mean': mean,
+        'Std': np.sqrt(squares / (count - 1)) if count > 1 else np.nan,
+        'Samples': trace.shape[0],
+        'Sampling Rate': sampling_rate(time) if time.shape[0] > 1 and time[-1] > time[0] else np.nan
+    }
+
+# Per-trial and per-session summary index of a calcium trace
+# `trials` maps sheet names ('Pre-Trial', 'Trial n') to (time, trace) arrays
+def summary_index(session_time: np.ndarray, session_trace: np.ndarray, trials: dict[str, tuple[np.ndarray, np.ndarray]], chunk_rows: int | None = None):
+    records = {'Session': trace_summary(session_time, session_trace, chunk_rows)}
+    for name, (time, trace) in trials.items():
+        records[name] = trace_summary(time, trace)
+    summary = pd.DataFrame.from_dict(records, orient='index')
+    summary.index.name = 'Sheet'
+    return summary
+
+# Summary index of every channel of a session, one block of rows per channel
+# `trials` are the (start, end) sample ranges of the trial sheets, end exclusive
+def channel_summary(session_time: np.ndarray, channels: dict[str, np.ndarray], trials: dict[str, tuple[int, int]], chunk_rows: int | None = None):
+    frames = []
+    for name, trace in channels.items():
+        trial_traces = {x: (np.asarray(session_time[start:end]), np.asarray(trace[start:end])) for x, (start, end) in trials.items()}
+        summary = summary_index(session_time, trace, trial_traces, chunk_rows)
+        summary.insert(0, 'Channel', name)
+        frames.append(summary)
+    return pd.concat(frames)
+
+# Read the summary index of one channel of a parsed calcium workbook
+# It describes whole trial sheets and the whole session; statistics of other spans (the windows exported to trials/
+# for the heatmaps and trial metrics, bout and PETH windows, per-sample averages) are still computed from the traces
+# (None for files synchronized before it existed, or without a summary of that channel)
+def load_summary(calcium: Path | WorkbookReader, name: str = channel):
+    if isinstance(calcium, WorkbookReader):
+        if 'Summary' not in calcium:
+            return None
+        summary = calcium.parse('Summary', index_col='Sheet')
+
+        # Files synchronized before multi-channel support only summarize AIN01
+        if 'Channel' not in summary.columns:
+            return summary if name == 'AIN01' else None
+        summary = summary[summary['Channel'] == name].drop(columns='Channel')
+        return summary if not summary.empty else None
+    with WorkbookReader(calcium) as workbook:
+        return load_summary(workbook, name)
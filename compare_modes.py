@@ -1,25 +1,25 @@
 from pathlib import Path
-import pandas as pd
+
+from workbook_diff import diff_workbooks
+
+# Write the difference between the reward and time mode stats of one test
+# Sheets are aligned by row and column labels, blank stats count as 0 and booleans (e.g. Rewarding bouts) as 0/1
+def compare_file(folder: Path, name: str):
+    summary, _ = diff_workbooks(folder / f'{name}-reward.xlsx', folder / f'{name}-time.xlsx', folder / f'{name}-diff.xlsx',
+                                labels = ('reward', 'time'), fill_value = 0)
+    return summary
 
 def main(folder: Path):
     files = folder.glob('*reward.xlsx')
     for file in files:
         name = file.stem.split('-')[0]
-        writer = pd.ExcelWriter(folder / f'{name}-diff.xlsx', engine = 'xlsxwriter')
-        sheets = pd.read_excel(folder / f'{name}-reward.xlsx', sheet_name = None).keys()
-        for key in sheets:
-            if 'Test' in key:
-                header = None
-                export = False
-            else:
-                header = 0
-                export = True
-            reward_frame = pd.read_excel(folder / f'{name}-reward.xlsx', sheet_name = key, index_col = 0, header = header)
-            time_frame = pd.read_excel(folder / f'{name}-time.xlsx', sheet_name = key, index_col = 0, header = header)
-            diff = reward_frame.fillna(0).subtract(time_frame, fill_value = 0)
-            diff.to_excel(writer, sheet_name = key, header = export)
-        writer.close()
+        compare_file(folder, name)
+
+# Compare the reward and time mode stats of every phase
+def process_all():
+    for i in range(3):
+        phase = Path(f'stats/phase {i + 1}')
+        main(phase)
 
-for i in range(3):
-    phase = Path(f'stats/phase {i + 1}')
-    main(phase)
+if __name__ == "__main__":
+    process_all()
@@ -0,0 +1,291 @@
+from collections import OrderedDict
+from pathlib import Path
+import os
+import numpy as np
+import pandas as pd
+import xlsxwriter
+
+# Number of rows converted and written at a time
+chunk_rows = 10000
+
+# Memory budget (bytes) of the parsed sheets kept by WorkbookReader in one process
+# The cache is per process: every pool worker of pipeline.py and work_queue.py has its own, emptied after each task
+cache_bytes = 2 ** 28
+
+# Header/index cell style (same as pandas.DataFrame.to_excel)
+header_style = {'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'}
+
+# Open a new workbook that streams each row to disk as soon as the next row is started
+# Rows of each worksheet must be written in order; existing files are overwritten, never appended to
+class StreamingWorkbook:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.workbook = xlsxwriter.Workbook(str(self.path), {'constant_memory': True})
+        self.header_format = self.workbook.add_format(header_style)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    # Add a worksheet whose rows are written later (e.g. one chunk at a time)
+    def open_sheet(self, sheet_name: str, names: list, index_label: str | None = None, index: bool = False, header: bool = True):
+        return SheetWriter(self, self.workbook.add_worksheet(sheet_name), names, index_label, index, header)
+
+    # Write columnar data (e.g. a dict of lists or arrays) to a new worksheet in row chunks
+    # `index` is an optional first column written with the header style
+    def write_columns(
+        self,
+        sheet_name: str,
+        columns: dict,
+        index: pd.Index | list | None = None,
+        index_label: str | None = None,
+        header: bool = True,
+        chunk_size: int = chunk_rows
+    ):
+        sheet = self.open_sheet(sheet_name, list(columns.keys()), index_label, index is not None, header)
+        sheet.write_columns(columns, index, chunk_size)
+        return sheet.worksheet
+
+    # Write a DataFrame with the same layout as DataFrame.to_excel
+    def write_frame(self, sheet_name: str, frame: pd.DataFrame, index: bool = True, header: bool = True, chunk_size: int = chunk_rows):
+        columns = {x: frame[x] for x in frame.columns}
+        return self.write_columns(
+            sheet_name,
+            columns,
+            frame.index if index else None,
+            frame.index.name if index else None,
+            header,
+            chunk_size
+        )
+
+    # Write raw rows (e.g. copied from another workbook) to a new worksheet
+    def write_rows(self, sheet_name: str, rows):
+        worksheet = self.workbook.add_worksheet(sheet_name)
+        for i, values in enumerate(rows):
+            worksheet.write_row(i, 0, cell_values(values))
+        return worksheet
+
+    def close(self):
+        self.workbook.close()
+
+# Worksheet of a StreamingWorkbook that is filled in order, one block of rows at a time
+class SheetWriter:
+    def __init__(self, workbook: StreamingWorkbook, worksheet, names: list, index_label: str | None = None, index: bool = False, header: bool = True):
+        self.worksheet = worksheet
+        self.names = names
+        self.header_format = workbook.header_format
+        self.offset = 1 if index else 0
+        self.row = 0
+        if header:
+            if index and index_label is not None:
+                worksheet.write(0, 0, index_label, self.header_format)
+            for i, name in enumerate(names):
+                worksheet.write(0, i + self.offset, name, self.header_format)
+            self.row = 1
+
+    # Append columnar data below the rows written so far
+    def write_columns(self, columns: dict, index: pd.Index | list | None = None, chunk_size: int = chunk_rows):
+        num_rows = len(index) if index is not None else (len(columns[self.names[0]]) if len(self.names) > 0 else 0)
+        for start in range(0, num_rows, chunk_size):
+            end = min(start + chunk_size, num_rows)
+            chunk = [cell_values(rows(columns[x], start, end)) for x in self.names]
+            labels = cell_values(rows(index, start, end)) if index is not None else None
+            for i, values in enumerate(zip(*chunk) if len(chunk) > 0 else [()] * (end - start)):
+                if labels is not None and labels[i] is not None:
+                    self.worksheet.write(self.row, 0, labels[i], self.header_format)
+                self.worksheet.write_row(self.row, self.offset, values)
+                self.row += 1
+
+    # Append raw rows below the rows written so far
+    def write_rows(self, values):
+        for x in values:
+            self.worksheet.write_row(self.row, 0, cell_values(x))
+            self.row += 1
+
+# Positional slice of a column (Series are sliced by position, not by index label)
+def rows(values, start: int, end: int):
+    if isinstance(values, pd.Series):
+        return values.iloc[start:end]
+    return values[start:end]
+
+# Convert a column chunk to Python values, with missing values as None (blank cells)
+def cell_values(values):
+    if isinstance(values, (pd.Series, pd.Index)):
+        missing = np.asarray(values.isna())
+        values = values.tolist()
+    else:
+        if isinstance(values, np.ndarray):
+            values = values.tolist()
+        else:
+            values = list(values)
+        missing = [x is None or x is pd.NA or (isinstance(x, float) and np.isnan(x)) for x in values]
+    return [None if m else x for x, m in zip(values, missing)]
+
+# Boolean strings recognized by pandas.read_excel
+bool_values = {'True': True, 'TRUE': True, 'true': True, 'False': False, 'FALSE': False, 'false': False}
+
+# Convert a cell read by openpyxl to the value pandas.read_excel gives it
+def cell_value(x):
+    if isinstance(x, float) and x.is_integer():
+        return int(x)
+    if isinstance(x, str):
+        return None if x == '' else bool_values.get(x, x)
+    return x
+
+# Read a worksheet in blocks of rows without loading it, as (header, rows) pairs
+# Cells are converted like pandas.read_excel (integral numbers as int, 'TRUE'/'FALSE' as booleans, blank cells as None)
+# and trailing blank rows are dropped; a sheet without data rows yields its header once
+# `source` is a path or an open pandas.ExcelFile (openpyxl engine), which avoids loading the shared strings twice
+def sheet_chunks(source: Path | pd.ExcelFile, sheet_name: str, chunk_size: int = chunk_rows):
+    from openpyxl import load_workbook
+
+    opened = not isinstance(source, pd.ExcelFile)
+    source = load_workbook(source, read_only=True, data_only=True) if opened else source.book
+    try:
+        worksheet = source[sheet_name]
+        worksheet.reset_dimensions()
+        header = None
+        chunk = []
+        blank_rows = 0
+        for values in worksheet.iter_rows(values_only=True):
+            values = [cell_value(x) for x in values]
+            if header is None:
+                header = values
+                continue
+            values = (values + [None] * len(header))[:len(header)]
+            if all(x is None for x in values):
+                blank_rows += 1
+                continue
+            chunk += [[None] * len(header) for _ in range(blank_rows)] + [values]
+            blank_rows = 0
+            if len(chunk) >= chunk_size:
+                yield header, chunk
+                chunk = []
+        if len(chunk) > 0 or header is not None:
+            yield header or [], chunk
+    finally:
+        if opened:
+            source.close()
+
+# Rewrite a workbook with some of its sheets replaced (or added at the end)
+# Other sheets are streamed from the old file row by row; the new file replaces the old one only once complete
+# A replacement is either a DataFrame or a function that writes the sheet, called as func(workbook, sheet_name)
+def replace_sheets(path: Path, frames: dict, index: bool = True):
+    from openpyxl import load_workbook
+
+    def write_sheet(workbook: StreamingWorkbook, name: str):
+        if callable(frames[name]):
+            frames[name](workbook, name)
+        else:
+            workbook.write_frame(name, frames[name], index)
+
+    path = Path(path)
+    temp_path = path.with_name(f'.{path.name}.tmp')
+    try:
+        with StreamingWorkbook(temp_path) as workbook:
+            written = set()
+            if path.exists():
+                source = load_workbook(path, read_only=True, data_only=True)
+                try:
+                    for name in source.sheetnames:
+                        if name in frames:
+                            write_sheet(workbook, name)
+                            written.add(name)
+                        else:
+                            workbook.write_rows(name, source[name].iter_rows(values_only=True))
+                finally:
+                    source.close()
+            for name in frames:
+                if name not in written:
+                    write_sheet(workbook, name)
+        os.replace(temp_path, path)
+    finally:
+        if temp_path.exists():
+            temp_path.unlink()
+
+# Parsed sheets and workbook metadata, least recently used first, as {(path, mtime, size, item): (value, bytes)}
+sheet_cache = OrderedDict()
+
+# Drop the least recently used entries until the cache fits in `cache_bytes` (the latest entry is always kept)
+def evict_sheets():
+    total = sum(x[1] for x in sheet_cache.values())
+    while total > cache_bytes and len(sheet_cache) > 1:
+        _, (_, size) = sheet_cache.popitem(last=False)
+        total -= size
+
+# Empty the sheet cache (e.g. when a pipeline task finishes, so an idle pool worker does not hold on to its sheets)
+def clear_sheets():
+    sheet_cache.clear()
+
+# Read access to an existing workbook that parses each sheet only when it is first needed
+# Sheet names, dimensions and parsed sheets are kept in the shared LRU cache, keyed by the file's modification time and size,
+# so a workbook rewritten by another stage is read again; the file itself is only opened on a cache miss
+class WorkbookReader:
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        stat = self.path.stat()
+        self.key = (str(self.path.resolve()), stat.st_mtime_ns, stat.st_size)
+        self.xls = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __contains__(self, sheet_name: str):
+        return sheet_name in self.sheet_names
+
+    # Open pandas.ExcelFile (opened on first use)
+    def excel(self):
+        if self.xls is None:
+            self.xls = pd.ExcelFile(self.path)
+        return self.xls
+
+    # Value of an item of this workbook from the cache, computed and added on a miss
+    def cached(self, item: tuple, compute: callable):
+        key = self.key + item
+        if key in sheet_cache:
+            sheet_cache.move_to_end(key)
+            return sheet_cache[key][0]
+        value = compute()
+        size = int(value.memory_usage(index=True, deep=True).sum()) if isinstance(value, pd.DataFrame) else 0
+        sheet_cache[key] = (value, size)
+        evict_sheets()
+        return value
+
+    @property
+    def sheet_names(self):
+        return list(self.cached(('sheet names',), lambda: tuple(self.excel().sheet_names)))
+
+    # Number of rows (including the header) and columns of a sheet, from the dimensions stored in the file
+    def dimensions(self, sheet_name: str):
+        def compute():
+            worksheet = self.excel().book[sheet_name]
+            return worksheet.max_row, worksheet.max_column
+        return self.cached(('dimensions', sheet_name), compute)
+
+    # Parse one sheet like pandas.read_excel, with `index_col` naming the index column
+    # Returns a copy, so callers can modify it without changing the cached sheet
+    def parse(self, sheet_name: str, index_col: str | None = None):
+        if sheet_name not in self:
+            raise ValueError(f"Worksheet named '{sheet_name}' not found")
+        frame = self.cached(('sheet', sheet_name), lambda: self.excel().parse(sheet_name))
+        return frame.set_index(index_col) if index_col is not None else frame.copy()
+
+    def close(self):
+        if self.xls is not None:
+            self.xls.close()
+            self.xls = None
+
+# Parse one sheet of a workbook through the shared cache
+def read_sheet(path: Path, sheet_name: str, index_col: str | None = None):
+    with WorkbookReader(path) as workbook:
+        return workbook.parse(sheet_name, index_col)
+
+# Sheet names of a workbook through the shared cache
+def sheet_names(path: Path):
+    with WorkbookReader(path) as workbook:
+        return workbook.sheet_names
@@ -0,0 +1,170 @@
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+from excel_utils import StreamingWorkbook
+
+# Lever press thresholds (g) swept offline; the sketches use forceThresh = 2 without hysteresis
+thresholds = np.arange(1, 10.5, 0.5)
+
+# Force drop (g) below the threshold needed before the next press can start
+hysteresis = 0.5
+
+# Maximum number of (threshold, sample) pairs processed at once by detect_presses
+block_size = 2 ** 24
+
+# Press threshold (g) of the sketches (forceThresh), marked on the force plots
+sketch_threshold = 2
+
+# Number of time bins of a plotted force trace (see decimate_minmax) and resolution of the plots
+plot_bins = 2000
+plot_dpi = 150
+
+# Force trace of a parsed log as int32 times (ms from the first row, like the Time column) and float32 force (g)
+def force_samples(columns: dict):
+    force = np.asarray(columns['Force'], dtype=object)
+    has_force = force != ''
+    time = np.asarray(columns['Time'], dtype=float)[has_force]
+    return np.rint(time * 1000).astype(np.int32), force[has_force].astype(np.float32)
+
+# File holding the force traces of a parsed log, e.g. parsed_data/phase 3/phase 3 day5-force.npz
+def force_file(parsed_file: Path):
+    return parsed_file.with_name(f'{parsed_file.stem}-force.npz')
+
+# Save the force traces of all mice of a parsed log ({mouse: (ms, force)}) in one file
+def save_force(parsed_file: Path, traces: dict):
+    arrays = {}
+    for mouse, (ms, force) in traces.items():
+        arrays[f'{mouse}/ms'] = ms
+        arrays[f'{mouse}/force'] = force
+    np.savez(force_file(parsed_file), **arrays)
+
+# Load the force traces of a parsed log as {mouse: (ms, force)}
+def load_force(parsed_file: Path):
+    traces = {}
+    with np.load(force_file(parsed_file)) as data:
+        for key in data.files:
+            mouse = key.rsplit('/', 1)[0]
+            if mouse not in traces:
+                traces[mouse] = (data[f'{mouse}/ms'], data[f'{mouse}/force'])
+    return traces
+
+# Reduce a trace to the minimum and maximum of each of `num_bins` equal time bins, in time order
+# Unlike plain subsampling, brief presses and drops stay visible when a long session is plotted
+def decimate_minmax(time: np.ndarray, values: np.ndarray, num_bins: int = 2000):
+    if time.shape[0] <= 2 * num_bins:
+        return time, values
+    width = (time[-1] - time[0]) / num_bins
+    bins = np.minimum(((time - time[0]) / width).astype(int), num_bins - 1) if width > 0 else np.zeros(time.shape[0], dtype=int)
+
+    # Within each bin, samples sorted by value: the first is the minimum and the last the maximum
+    order = np.lexsort((values, bins))
+    starts = np.flatnonzero(np.diff(bins[order], prepend=-1))
+    ends = np.append(starts[1:], order.shape[0]) - 1
+    keep = np.unique(np.concatenate([order[starts], order[ends]]))
+    return time[keep], values[keep]
+
+# Lever presses re-derived from a force trace for many thresholds in one pass
+# A press starts when the force rises above the threshold and ends when it falls to the threshold minus `hysteresis`
+# (with no hysteresis, as soon as it is no longer above the threshold)
+# Returns one row per press with its threshold, onset and release times (ms), duration and peak force
+def detect_presses(ms: np.ndarray, force: np.ndarray, levels: np.ndarray = thresholds, hysteresis: float = hysteresis):
+    levels = np.atleast_1d(np.asarray(levels, dtype=np.float32))
+    num_samples = force.shape[0]
+    rows = max(block_size // max(num_samples, 1), 1)
+    presses = []
+    for start in range(0, levels.shape[0], rows):
+        high = levels[start:start + rows, None]
+        above = force > high
+        below = force <= high - np.float32(hysteresis)
+
+        # State of each sample: pressed after the latest sample above the threshold, released after the latest one below the release level
+        latest = np.where(above | below, np.arange(num_samples, dtype=np.int32), -1)
+        np.maximum.accumulate(latest, axis=1, out=latest)
+        pressed = np.take_along_axis(above, np.maximum(latest, 0), axis=1) & (latest >= 0)
+        change = np.diff(pressed, axis=1, prepend=False, append=False)
+
+        # Changes alternate between onsets and releases in each row (a press held at the end is released after the last sample)
+        level, index = np.nonzero(change)
+        onsets, releases = index[::2], index[1::2]
+        peak = np.maximum.reduceat(np.append(force, -np.inf), index)[::2] if index.shape[0] > 0 else np.zeros(0)
+        release_ms = np.where(releases < num_samples, ms[np.minimum(releases, num_samples - 1)], np.nan)
+        presses.append(pd.DataFrame({
+            'Threshold': levels[start + level[::2]],
+            'Onset (ms)': ms[onsets],
+            'Release (ms)': release_ms,
+            'Duration (ms)': release_ms - ms[onsets],
+            'Peak Force': peak,
+        }))
+    return pd.concat(presses, ignore_index=True)
+
+# Number of presses of one force trace at each threshold
+def press_counts(ms: np.ndarray, force: np.ndarray, levels: np.ndarray = thresholds, hysteresis: float = hysteresis):
+    presses = detect_presses(ms, force, levels, hysteresis)
+    return presses['Threshold'].value_counts().reindex(np.asarray(levels, dtype=np.float32), fill_value=0)
+
+# Press counts of every mouse and day of one phase at each threshold, from the saved force traces
+def threshold_sweep(folder: Path, levels: np.ndarray = thresholds, hysteresis: float = hysteresis):
+    rows = []
+    for parsed_file in sorted(folder.glob('phase*.xlsx')):
+        if not force_file(parsed_file).exists():
+            continue
+        for mouse, (ms, force) in load_force(parsed_file).items():
+            counts = press_counts(ms, force, levels, hysteresis)
+            rows.append([parsed_file.stem, mouse] + counts.tolist())
+    return pd.DataFrame(rows, columns=['Day', 'Mouse'] + [f'{x:g} g' for x in levels])
+
+# Plot a whole-session force trace with the sketch threshold and the presses it detects (no hysteresis, like the sketches)
+# The trace is decimated to the minimum and maximum of each time bin, so brief presses stay visible in long sessions
+def force_plot(ms: np.ndarray, force: np.ndarray, output: Path, threshold: float = sketch_threshold, num_bins: int = plot_bins):
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    time, values = decimate_minmax(ms / 1000, force, num_bins)
+    onsets = detect_presses(ms, force, [threshold], 0)['Onset (ms)'].to_numpy() / 1000
+
+    figure = Figure(figsize=(10, 3))
+    FigureCanvasAgg(figure)
+    ax = figure.add_subplot()
+    ax.plot(time, values, color='#218BFF', linewidth=0.5)
+    ax.axhline(threshold, color='#000000', linestyle='--', label='Press Threshold')
+    ax.scatter(onsets, np.full(onsets.shape[0], threshold), marker='|', color='#4B0092', label='Lever Presses')
+    ax.set_xlabel('Time (s)')
+    ax.set_ylabel('Force (g)')
+    ax.legend(loc='upper right')
+    figure.tight_layout()
+    figure.savefig(output, dpi=plot_dpi)
+
+# Plot the force trace of every mouse and day of one phase to plots/phase N/<mouse>/force-<day>.png
+def force_plots(folder: Path, plot_folder: Path):
+    for parsed_file in sorted(folder.glob('phase*.xlsx')):
+        if not force_file(parsed_file).exists():
+            continue
+        for mouse, (ms, force) in load_force(parsed_file).items():
+            if ms.shape[0] == 0:
+                continue
+            output_dir = plot_folder / mouse
+            output_dir.mkdir(parents=True, exist_ok=True)
+            force_plot(ms, force, output_dir / f'force-{parsed_file.stem}.png')
+
+# Write the threshold sweep of one phase to stats/phase N/force_sweep.xlsx and, with a `plot_folder`, plot the force traces
+def main(folder: Path, output_folder: Path, plot_folder: Path | None = None):
+    sweep = threshold_sweep(folder)
+    if sweep.empty:
+        return
+    output_folder.mkdir(parents=True, exist_ok=True)
+    with StreamingWorkbook(output_folder / 'force_sweep.xlsx') as workbook:
+        workbook.write_frame('Press Counts', sweep, index=False)
+    if plot_folder is not None:
+        force_plots(folder, plot_folder)
+    print(f"Completed force threshold sweep for {folder.name}")
+
+# Sweep the press thresholds and plot the force traces for the phases with a lever
+def process_all():
+    for phase in ['phase 2', 'phase 3']:
+        folder = Path('parsed_data') / phase
+        if folder.exists():
+            main(folder, Path('stats') / phase, Path('plots') / phase)
+
+if __name__ == "__main__":
+    process_all()
@@ -23,6 +23,7 @@ int isEthoTrig = 0; // =1 if being triggered by doric (cable must be plugged in
 int itiNullPos = 0; // =1 to send servo to null position during ITI
 int useCues = 1; // to deliver cues during trial (both light and tone)
 int useTone = 1; // to use tone cue (and not only light)
+int binaryLog = 0; // =1 to log events as fixed-size binary records instead of text lines (see logEvent and binary_log.py)
 
 unsigned int iti = 10000; // iti in ms
 unsigned long trialDur = 10000; // trial duration
@@ -168,6 +169,39 @@ float force = 0;
 int prevLevPress = 0;
 unsigned long levPressTime = 0;
 
+// binary event log (binaryLog = 1): one 14-byte record per event, decoded by binary_log.py
+// record: 0xA5, event code, trial (uint16), ms (uint32), value (float32), port (uint8), checksum (sum of previous bytes, uint8)
+// multi-byte fields are little-endian (native byte order of the AVR)
+const byte logSession = 1;
+const byte logEnd = 2;
+const byte logTrial = 3;
+const byte logIti = 4;
+const byte logCueOn = 5;
+const byte logCueOff = 6;
+const byte logServo = 7;
+const byte logLevPress = 8;
+const byte logForce = 9;
+const byte logLick = 10;
+const byte logBout = 11;
+const byte logReward = 12;
+const byte logSync = 13;
+
+void logEvent(byte code, unsigned long ms, unsigned int trial, byte port, float value) {
+  byte record[14];
+  record[0] = 0xA5;
+  record[1] = code;
+  memcpy(&record[2], &trial, 2);
+  memcpy(&record[4], &ms, 4);
+  memcpy(&record[8], &value, 4);
+  record[12] = port;
+  byte checksum = 0;
+  for (int i = 0; i < 13; i++) {
+    checksum += record[i];
+  }
+  record[13] = checksum;
+  Serial.write(record, 14);
+}
+
 /////SETUP///////////////////////////////
 void setup() {
 
@@ -229,8 +263,13 @@ void loop() {
     toStart = 1;
     startTime = millis();
     digitalWrite(doricPin, HIGH);
-    Serial.print("START SESSION, ms=");
-    Serial.println(startTime);
+    if (binaryLog == 1) {
+      logEvent(logSession, startTime, 0, 0, 0);
+    }
+    else {
+      Serial.print("START SESSION, ms=");
+      Serial.println(startTime);
+    }
     delay(100);
     digitalWrite(doricPin, LOW);
  }
@@ -276,11 +315,16 @@ void checkServo() { // to move spout servo (moves back to null at ITI)
     // move servo to correct position for this trialType
     spoutServo.write(servoPosArr[trialType - 1]);
 
-    Serial.print("moveServo, ");//
-    Serial.print("trialNum="); Serial.print(trialNum);
-    Serial.print(", port="); Serial.print(trialType);
-    Serial.print(", ms=");   //Print  this to the serial port
-    Serial.println(millis());
+    if (binaryLog == 1) {
+      logEvent(logServo, millis(), trialNum, trialType, 0);
+    }
+    else {
+      Serial.print("moveServo, ");//
+      Serial.print("trialNum="); Serial.print(trialNum);
+      Serial.print(", port="); Serial.print(trialType);
+      Serial.print(", ms=");   //Print  this to the serial port
+      Serial.println(millis());
+    }
 
     //delay(500); // give time for servo to move
   }
@@ -308,10 +352,15 @@ void checkCues() {
 
     digitalWrite(syncPin, HIGH);
     
-    Serial.print("cueOn");
-    Serial.print(", port="); Serial.print(trialType);
-    Serial.print(", ms=");   //Print  this to the serial port
-    Serial.println(cueStartTime);
+    if (binaryLog == 1) {
+      logEvent(logCueOn, cueStartTime, 0, trialType, 0);
+    }
+    else {
+      Serial.print("cueOn");
+      Serial.print(", port="); Serial.print(trialType);
+      Serial.print(", ms=");   //Print  this to the serial port
+      Serial.println(cueStartTime);
+    }
   }
 
   else if (cueOn == 1 && millis() - cueStartTime >= cueDur) {
@@ -324,10 +373,15 @@ void checkCues() {
 
     digitalWrite(syncPin, LOW);
 
-    Serial.print("cueOff");//"trialNum="); Serial.print(trialNum);
-    Serial.print(", port="); Serial.print(trialType);
-    Serial.print(", ms=");   //Print  this to the serial port
-    Serial.println(millis());
+    if (binaryLog == 1) {
+      logEvent(logCueOff, millis(), 0, trialType, 0);
+    }
+    else {
+      Serial.print("cueOff");//"trialNum="); Serial.print(trialNum);
+      Serial.print(", port="); Serial.print(trialType);
+      Serial.print(", ms=");   //Print  this to the serial port
+      Serial.println(millis());
+    }
   }
 }
 
@@ -363,10 +417,15 @@ void checkTrial() {
       giveCue = 1;
     }
 
-    Serial.print("trialNum="); Serial.print(trialNum);
-    Serial.print(", port="); Serial.print(trialType);
-    Serial.print(", ms=");   //Print  this to the serial port
-    Serial.println(trialStartTime);
+    if (binaryLog == 1) {
+      logEvent(logTrial, trialStartTime, trialNum, trialType, 0);
+    }
+    else {
+      Serial.print("trialNum="); Serial.print(trialNum);
+      Serial.print(", port="); Serial.print(trialType);
+      Serial.print(", ms=");   //Print  this to the serial port
+      Serial.println(trialStartTime);
+    }
 
 //    hasLicked = 0;
     numLicksInBout = 0;
@@ -380,11 +439,16 @@ void checkTrial() {
     itiStartTime = millis();
     isTrial = 0;
     isIti = 1;
-    Serial.print("iti="); Serial.print(iti);
-    Serial.print(", trialNum="); Serial.print(trialNum);
-    Serial.print(", port="); Serial.print(trialType);
-    Serial.print(", ms=");   //Print  this to the serial port
-    Serial.println(itiStartTime); //trialEndTime);
+    if (binaryLog == 1) {
+      logEvent(logIti, itiStartTime, trialNum, trialType, iti);
+    }
+    else {
+      Serial.print("iti="); Serial.print(iti);
+      Serial.print(", trialNum="); Serial.print(trialNum);
+      Serial.print(", port="); Serial.print(trialType);
+      Serial.print(", ms=");   //Print  this to the serial port
+      Serial.println(itiStartTime); //trialEndTime);
+    }
 
     if (itiNullPos == 1) { // to move servo to null position during ITI
       spoutServo.write(nullPos);
@@ -406,10 +470,15 @@ void checkTrial() {
   if (isTrial == 0 && isIti == 0 && (trialNum >= maxNumTrials || millis() - startTime >= sessDur)) {
     // end session
     toStart = 0;
-    Serial.print("END SESSION, numTrials=");
-    Serial.print(trialNum);
-    Serial.print(", ms=");
-    Serial.println(millis());
+    if (binaryLog == 1) {
+      logEvent(logEnd, millis(), trialNum, 0, 0);
+    }
+    else {
+      Serial.print("END SESSION, numTrials=");
+      Serial.print(trialNum);
+      Serial.print(", ms=");
+      Serial.println(millis());
+    }
   }
 }
 
@@ -438,10 +507,15 @@ void giveRew() {
   numLicksInBout = 0;
   rewReset = 0; // rewReset is set to 0 when reward started, then reset to 1 when lick =0 (thus another reward shouldn't be triggered if port still touched)
 
-  Serial.print("REWARD"); //Print text output
-  Serial.print(", trialNum="); Serial.print(trialNum);
-  Serial.print(", port="); Serial.print(trialType);
-  Serial.print(", ms="); Serial.println(millis());
+  if (binaryLog == 1) {
+    logEvent(logReward, millis(), trialNum, trialType, 0);
+  }
+  else {
+    Serial.print("REWARD"); //Print text output
+    Serial.print(", trialNum="); Serial.print(trialNum);
+    Serial.print(", port="); Serial.print(trialType);
+    Serial.print(", ms="); Serial.println(millis());
+  }
 
 }
 
@@ -512,18 +586,28 @@ void checkLicks() {
 
           lickTime = millis();
 
-          Serial.print("lick, ");
-          Serial.print("trialNum="); Serial.print(trialNum);
-          Serial.print(", port="); Serial.print(trialType + 1);
-          Serial.print(", ms=");   //Print  this to the serial port
-          Serial.println(lickTime);
+          if (binaryLog == 1) {
+            logEvent(logLick, lickTime, trialNum, trialType + 1, 0);
+          }
+          else {
+            Serial.print("lick, ");
+            Serial.print("trialNum="); Serial.print(trialNum);
+            Serial.print(", port="); Serial.print(trialType + 1);
+            Serial.print(", ms=");   //Print  this to the serial port
+            Serial.println(lickTime);
+          }
 
           // check lick bout (if in trial and no prev rew)
           if (isTrial == 1) { // && rewReset == 1) {
             if (lickTime - prevLickTime <= maxInterLick) {
               numLicksInBout = numLicksInBout + 1;
-              Serial.print(numLicksInBout);
-              Serial.println(" licks in bout");
+              if (binaryLog == 1) {
+                logEvent(logBout, lickTime, numLicksInBout, 0, 0);
+              }
+              else {
+                Serial.print(numLicksInBout);
+                Serial.println(" licks in bout");
+              }
             }
             else {
               numLicksInBout = 1;
@@ -0,0 +1,310 @@
+import numpy as np
+import pandas as pd
+
+# Task specs describe an operant phase declaratively:
+#   'anchor':       what starts a trial, 'cue' or 'press'. Session latencies are measured from the
+#                   first trial start for cue-anchored tasks and from the start of the log for press-anchored tasks
+#   'presses':      None (no lever), 'count' (count presses) or 'cue' (split presses into within/outside cue)
+#   'reward':       rule used to split licks into rewarded/non-rewarded for each mode:
+#                   'reward' (REWARD column), 'reward_without_press' (REWARD column, ignoring rewards printed with a press),
+#                   'cue' (licks during the cue) or 'press' (licks within `press_window` seconds after a press within cue)
+#   'lick_latency': reference for the per-trial latency to first lick, 'trial' (trial start) or 'press' (first press within cue)
+#   'aggregate':    output rows of the Test Stats sheet
+#   'trial':        output columns of the Trial Stats sheet
+# Output names must be keys of `aggregate_stats` and `trial_stats`
+
+# Statistics available in the Test Stats sheet
+aggregate_stats = {
+    '# of Trials': 'num_presses',
+    'Latency to First Press (ms)': 'press_latency',
+    '# of Presses within Cue': 'presses_in_cue',
+    '# of Presses outside Cue': 'presses_out_cue',
+    'Total # of Presses': 'presses_total',
+    'Latency to First Lick (ms)': 'lick_latency',
+    '# of Rewarded Licks': 'licks_rewarded',
+    '# of Non-Rewarded Licks': 'licks_not_rewarded',
+    'Total # of Licks': 'licks_total',
+}
+
+# Statistics available in the Trial Stats sheet
+trial_stats = {
+    'Latency to First Press (ms)': 'press_latency',
+    '# of Presses within Cue': 'presses_in_cue',
+    '# of Presses outside Cue': 'presses_out_cue',
+    'Total # of Presses': 'presses_total',
+    'Latency to First Lick (ms)': 'lick_latency',
+    '# of Rewarded Licks': 'licks_rewarded',
+    '# of Non-Rewarded Licks': 'licks_not_rewarded',
+    'Total # of Licks': 'licks_total',
+}
+
+# Columns of the parsed log read by the engine (Time is the index)
+event_columns = ['# of Licks', 'Trial Number', 'Cue', 'Lever Press', 'Reward']
+
+# Event times are int64 milliseconds inside the engine, so events logged at the same time match exactly
+# and joins and range lookups run on integer keys; outputs are converted back to seconds
+no_time = np.iinfo(np.int64).max
+
+# Convert times in seconds (the Time column of a parsed log) to int64 milliseconds
+def time_ms(times):
+    return np.rint(np.asarray(times, dtype=float) * 1000).astype(np.int64)
+
+# Convert int64 milliseconds (or float milliseconds with NaN for missing times) to seconds
+def seconds(ms):
+    return np.asarray(ms) / 1000
+
+# Extract the (time in ms, value) arrays of one event column
+def events(data: pd.DataFrame, column: str):
+    if column not in data.columns:
+        return np.empty(0, dtype=np.int64), np.empty(0)
+    series = data[column].dropna()
+    return time_ms(series.index), series.to_numpy()
+
+# For each time in `b`, index of the latest time in sorted `a` at or before it (first of equal times)
+# Times before the first element of `a` map to index 0, like phase_utils.find_closest
+def latest_before(a: np.ndarray, b: np.ndarray):
+    index = np.searchsorted(a, b, side='right') - 1
+    index = np.searchsorted(a, a[np.clip(index, 0, None)], side='left')
+    return np.where(np.searchsorted(a, b, side='right') > 0, index, 0)
+
+# Mask of events that fall within a cue (vectorized phase_utils.cue_split)
+def cue_mask(cue_times: np.ndarray, cue_values: np.ndarray, times: np.ndarray):
+    cue_on = cue_times[cue_values == 'On']
+    cue_off = cue_times[cue_values == 'Off']
+    if cue_on.shape[0] == 0 or cue_off.shape[0] == 0:
+        print("WARNING: No cues found in data.")
+        return np.zeros(times.shape[0], dtype=bool)
+    if times.shape[0] == 0:
+        print("WARNING: No valid cue indices found.")
+        return np.zeros(0, dtype=bool)
+    index = latest_before(cue_on, times)
+    on_diff = times - cue_on[index]
+    off_diff = np.full(times.shape[0], np.inf)
+    valid = index < cue_off.shape[0]
+    off_diff[valid] = times[valid] - cue_off[index[valid]]
+    return (on_diff >= 0) & (off_diff <= 0)
+
+# Rewarded lick rows (with repetition, like phase_utils.lick_reward_split) and non-rewarded lick mask
+def reward_split(reward_times: np.ndarray, lick_times: np.ndarray):
+    if lick_times.shape[0] == 0 or reward_times.shape[0] == 0:
+        return np.empty(0, dtype=int), np.ones(lick_times.shape[0], dtype=bool)
+
+    # Each reward selects every lick row at the time of the latest lick before it
+    reward_lick_times = lick_times[latest_before(lick_times, reward_times)]
+    start = np.searchsorted(lick_times, reward_lick_times, side='left')
+    end = np.searchsorted(lick_times, reward_lick_times, side='right')
+    counts = end - start
+    rows = np.repeat(start - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    not_rewarded = ~np.isin(lick_times, reward_lick_times)
+    return rows, not_rewarded
+
+# Lick mask for licks within `window` seconds after the latest press (vectorized phase_utils.lick_press_split)
+def press_window_mask(press_times: np.ndarray, lick_times: np.ndarray, window: float):
+    if press_times.shape[0] == 0:
+        return np.zeros(lick_times.shape[0], dtype=bool)
+    diff = lick_times - press_times[latest_before(press_times, lick_times)]
+    return (diff >= 0) & (diff <= time_ms(window))
+
+# Mask of rewards printed together with a press (less than `tolerance` ms apart)
+def press_reward_mask(press_times: np.ndarray, reward_times: np.ndarray, tolerance: int = 5):
+    if press_times.shape[0] == 0:
+        return np.zeros(reward_times.shape[0], dtype=bool)
+    right = np.clip(np.searchsorted(press_times, reward_times), 0, press_times.shape[0] - 1)
+    left = np.clip(right - 1, 0, None)
+    nearest = np.minimum(np.abs(press_times[left] - reward_times), np.abs(press_times[right] - reward_times))
+    return nearest < tolerance
+
+# Sum of event values and first event time (float ms, NaN if none) within each [start, end] range (both ends inclusive)
+def range_stats(times: np.ndarray, values: np.ndarray, starts: np.ndarray, ends: np.ndarray):
+    order = np.argsort(times, kind='stable')
+    times = times[order]
+    cumulative = np.concatenate(([0.0], np.cumsum(values[order].astype(float))))
+    low = np.searchsorted(times, starts, side='left')
+    high = np.searchsorted(times, ends, side='right')
+    sums = cumulative[high] - cumulative[low]
+    first = np.full(starts.shape[0], np.nan)
+    found = high > low
+    first[found] = times[low[found]]
+    return sums, first
+
+# Latency in seconds between two times in ms, or 'N/A' when either event is missing
+def latency(event: float, reference: float):
+    if np.isnan(event) or np.isnan(reference):
+        return 'N/A'
+    return float(seconds(event - reference))
+
+# Split licks into bouts within each trial using a simple threshold in seconds (vectorized lick bouts)
+# Times are in ms; bout start and end times are returned in seconds
+def bout_table(
+    lick_times: np.ndarray,
+    lick_values: np.ndarray,
+    rewarded_times: np.ndarray,
+    trial_times: np.ndarray,
+    trial_numbers: np.ndarray,
+    threshold: float = 0.5
+):
+    columns = ['Trial Number', 'Start', 'End', '# of Licks', 'Rewarding', 'Highly Rewarding', 'Lick Efficiency']
+
+    # Lick rows belonging to each trial (licks at a trial boundary belong to both trials)
+    ends = np.append(trial_times[1:], no_time)
+    low = np.searchsorted(lick_times, trial_times, side='left')
+    high = np.searchsorted(lick_times, ends, side='right')
+    counts = high - low
+    if counts.sum() == 0:
+        bout_frame = pd.DataFrame(columns=columns)
+    else:
+        trial = np.repeat(np.arange(trial_times.shape[0]), counts)
+        rows = np.repeat(low - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+        times = lick_times[rows]
+
+        # New bout at every trial change or gap above threshold
+        new_bout = np.ones(rows.shape[0], dtype=bool)
+        new_bout[1:] = (trial[1:] != trial[:-1]) | (np.diff(times) > time_ms(threshold))
+        bout_start = np.where(new_bout)[0]
+        bout_end = np.append(bout_start[1:], rows.shape[0]) - 1
+
+        # Licks in bout are all licks between the first and last bout lick times
+        start_time = times[bout_start]
+        end_time = times[bout_end]
+        first = np.searchsorted(lick_times, start_time, side='left')
+        last = np.searchsorted(lick_times, end_time, side='right')
+        cumulative = np.concatenate(([0.0], np.cumsum(lick_values.astype(float))))
+        total = cumulative[last] - cumulative[first]
+        is_rewarded = np.isin(lick_times, rewarded_times).astype(int)
+        rewarded_cumulative = np.concatenate(([0], np.cumsum(is_rewarded)))
+        num_rewarded = rewarded_cumulative[last] - rewarded_cumulative[first]
+
+        # Lick efficiency is the fraction of inter-lick intervals of at most 150 ms (an interval of exactly 150 ms counts)
+        short_gaps = np.concatenate(([0], np.cumsum(np.diff(lick_times) <= 150)))
+        num_gaps = last - first - 1
+        with np.errstate(invalid='ignore', divide='ignore'):
+            efficiency = (short_gaps[last - 1] - short_gaps[first]) / num_gaps
+        efficiency = np.where(end_time - start_time > 0, efficiency, 0)
+
+        bout_frame = pd.DataFrame({
+            'Trial Number': trial_numbers[trial[bout_start]].astype(int),
+            'Start': seconds(start_time),
+            'End': seconds(end_time),
+            '# of Licks': total,
+            'Rewarding': num_rewarded > 0,
+            'Highly Rewarding': num_rewarded > 5,
+            'Lick Efficiency': efficiency,
+        }, columns=columns)
+
+    # Print warning if there are only non-rewarding or only rewarding bouts
+    if bout_frame['Rewarding'].sum() == 0:
+        print('WARNING: all bouts were identified as NON-REWARDING. Please double-check the original Arduino log to make sure this is valid.')
+    elif bout_frame['Rewarding'].sum() == bout_frame.shape[0]:
+        print('WARNING: all bouts were identified as REWARDING. Please double-check the original Arduino log to make sure this is valid.')
+
+    return bout_frame
+
+# Compute all statistics of a task spec in a single pass over the event table
+def run_spec(spec: dict, data: pd.DataFrame, mode: str):
+    # Extract event columns
+    lick_times, lick_values = events(data, '# of Licks')
+    trial_times, trial_values = events(data, 'Trial Number')
+    cue_times, cue_values = events(data, 'Cue')
+    press_times, press_values = events(data, 'Lever Press')
+    reward_times, _ = events(data, 'Reward')
+
+    # Trial starts (first row of each trial number)
+    _, first_rows = np.unique(trial_values, return_index=True)
+    first_rows = np.sort(first_rows)
+    starts = trial_times[first_rows]
+    trial_numbers = trial_values[first_rows]
+    ends = np.append(starts[1:], no_time)
+
+    # Split presses into within/outside cue
+    stats = {}
+    if spec['presses'] == 'cue':
+        press_in_cue = cue_mask(cue_times, cue_values, press_times)
+        stats['presses_in_cue'] = press_values[press_in_cue].astype(float).sum()
+        stats['presses_out_cue'] = press_values[~press_in_cue].astype(float).sum()
+        stats['presses_total'] = stats['presses_in_cue'] + stats['presses_out_cue']
+        if stats['presses_total'] != press_values.astype(float).sum():
+            print(f"WARNING: Presses sum mismatch. Expected {press_values.sum()}, but got {stats['presses_total']}.")
+    else:
+        press_in_cue = np.ones(press_times.shape[0], dtype=bool)
+
+    # Split licks into rewarded and not rewarded
+    rule = spec['reward'][mode]
+    if rule in ['reward', 'reward_without_press']:
+        if rule == 'reward_without_press':
+            reward_times = reward_times[~press_reward_mask(press_times, reward_times)]
+        rewarded_rows, not_rewarded = reward_split(reward_times, lick_times)
+    else:
+        if rule == 'cue':
+            rewarded = cue_mask(cue_times, cue_values, lick_times)
+        else:
+            rewarded = press_window_mask(press_times[press_in_cue], lick_times, spec.get('press_window', 5))
+        rewarded_rows, not_rewarded = np.where(rewarded)[0], ~rewarded
+    rewarded_times = lick_times[rewarded_rows]
+    rewarded_values = lick_values[rewarded_rows]
+    stats['licks_rewarded'] = rewarded_values.astype(float).sum()
+    stats['licks_not_rewarded'] = lick_values[not_rewarded].astype(float).sum()
+    stats['licks_total'] = stats['licks_rewarded'] + stats['licks_not_rewarded']
+    if stats['licks_total'] != lick_values.astype(float).sum():
+        print(f"WARNING: Lick sum mismatch. Expected {lick_values.sum()}, but got {stats['licks_total']}.")
+
+    # Session latencies
+    reference = starts[0] if spec['anchor'] == 'cue' else time_ms(data.index[:1])[0]
+    stats['num_presses'] = press_times.shape[0]
+    stats['press_latency'] = latency(press_times[0] if press_times.shape[0] > 0 else np.nan, reference)
+    stats['lick_latency'] = latency(rewarded_times[0] if rewarded_times.shape[0] > 0 else np.nan, reference)
+
+    aggregate_data = [stats[aggregate_stats[x]] for x in spec['aggregate']]
+    aggregate_frame = pd.DataFrame(aggregate_data, index=spec['aggregate'])
+
+    # Per-trial counts
+    per_trial = {}
+    per_trial['licks_rewarded'], first_rewarded = range_stats(rewarded_times, rewarded_values, starts, ends)
+    per_trial['licks_not_rewarded'], _ = range_stats(lick_times[not_rewarded], lick_values[not_rewarded], starts, ends)
+    per_trial['licks_total'] = per_trial['licks_rewarded'] + per_trial['licks_not_rewarded']
+    if spec['presses'] == 'cue':
+        per_trial['presses_in_cue'], first_press = range_stats(press_times[press_in_cue], press_values[press_in_cue], starts, ends)
+        per_trial['presses_out_cue'], _ = range_stats(press_times[~press_in_cue], press_values[~press_in_cue], starts, ends)
+        per_trial['presses_total'] = per_trial['presses_in_cue'] + per_trial['presses_out_cue']
+
+        # Latency to first press within cue from the first cue start in the trial
+        cue_on = cue_times[cue_values == 'On']
+        _, first_cue = range_stats(cue_on, np.zeros(cue_on.shape[0]), starts, ends)
+        per_trial['press_latency'] = [latency(x, y) for x, y in zip(first_press, first_cue)]
+
+    # Per-trial latency to first lick
+    if spec['lick_latency'] == 'press':
+        per_trial['lick_latency'] = [latency(x, y) for x, y in zip(first_rewarded, first_press)]
+    else:
+        # Measured from the start of the trial the first lick was logged in
+        trial_start = dict(zip(trial_numbers, starts))
+        index = np.clip(np.searchsorted(trial_times, first_rewarded), 0, max(trial_times.shape[0] - 1, 0))
+        lick_trial_start = np.array([
+            trial_start[trial_values[i]] if not np.isnan(x) and trial_times[i] == x else s
+            for i, x, s in zip(index, first_rewarded, starts)
+        ], dtype=float)
+        per_trial['lick_latency'] = [latency(x, y) for x, y in zip(first_rewarded, lick_trial_start)]
+
+    trial_indexes = [f'Trial {int(x)}' for x in trial_numbers]
+    trial_records = list(zip(*[per_trial[trial_stats[x]] for x in spec['trial']]))
+    trial_frame = pd.DataFrame(trial_records, index=trial_indexes, columns=spec['trial'])
+
+    # Export bout information
+    bout_frame = bout_table(lick_times, lick_values, rewarded_times, starts, trial_numbers)
+
+    return aggregate_frame, trial_frame, bout_frame
+
+# Compile a task spec into a stats function with the same interface as phase_stats.phase1/2/3
+def compile_spec(spec: dict):
+    unknown = [x for x in spec['aggregate'] if x not in aggregate_stats] + [x for x in spec['trial'] if x not in trial_stats]
+    if len(unknown) > 0:
+        raise ValueError(f"Unknown output columns in task spec: {unknown}")
+    if spec['presses'] != 'cue' and any(trial_stats[x].startswith('press') for x in spec['trial']):
+        raise ValueError("Per-trial press statistics require 'presses': 'cue'.")
+    if spec['lick_latency'] == 'press' and spec['presses'] != 'cue':
+        raise ValueError("'lick_latency': 'press' requires 'presses': 'cue'.")
+
+    def stats_function(data: pd.DataFrame, mode: str):
+        return run_spec(spec, data, mode)
+
+    stats_function.spec = spec
+    return stats_function
@@ -3,311 +3,143 @@ import numpy as np
 import pandas as pd
 
 from phase_utils import *
-
-# Compute stats on mice operant training task for phase 1
-def phase1(data: pd.DataFrame, mode: str):
-    # Extract required columns
-    licks = data['# of Licks'].dropna()
-    trials = data['Trial Number'].dropna()
-
-    # Split licks into rewarded and not rewarded and compute stats
-    if mode == 'reward':
-        rewards = data['Reward'].dropna()
-        licks_rewarded, licks_not_rewarded = lick_reward_split(rewards, licks)
-    elif mode == 'time':
-        cues = data['Cue'].dropna()
-        licks_rewarded, licks_not_rewarded, _ = cue_split(cues, licks)
-    lick_stats = ratio_stats(licks_rewarded, licks_not_rewarded)
-
-    if lick_stats[-1] != licks.sum():
-        print(f"WARNING: Lick sum mismatch. Expected {licks.sum()}, but got {lick_stats[-1]}.")
-
-    # Compute latency to first lick
-    trials_start = trials.drop_duplicates()
-    initial_lick_latency = latency_to_first_lick(licks_rewarded, time = trials_start.index[0])
-
-    # Parse lick stats across all trials
-    stat_names = ['Latency to First Lick (ms)', 
-                    '# of Rewarded Licks', 
-                    '# of Non-Rewarded Licks', 
-                    'Total # of Licks']
-
-    # Export aggregate stats to sheet
-    aggregate_data = (initial_lick_latency,) + lick_stats
-    aggregate_frame = pd.DataFrame(aggregate_data, index = stat_names)
-
-    # Parse each trial
-    trial_records = []
-    for i in range(trials_start.shape[0]):
-        start = trials_start.index[i]
-        if i < trials_start.shape[0] - 1:
-            end = trials_start.index[i + 1]
-        else:
-            end = None
-        time_range = [start, end]
-
-        # Compute stats
-        trial_latency = latency_to_first_lick(licks_rewarded, trials = trials, time_range = time_range)
-        trial_stats = ratio_stats(licks_rewarded, licks_not_rewarded, time_range = time_range)
-        trial_records.append((trial_latency,) + trial_stats)
-    
-    # Create DataFrame
-    indexes = [f'Trial {int(x)}' for x in trials_start]
-    trial_frame = pd.DataFrame(trial_records, index = indexes, columns = stat_names)
-
-    # Export bout information
-    bout_frame = lick_bouts(licks, licks_rewarded, trials_start)
-
-    return aggregate_frame, trial_frame, bout_frame
-
-# Compute stats on mice operant training task for phase 2
-def phase2(data: pd.DataFrame, mode: str):
-    # Extract required columns
-    licks = data['# of Licks'].dropna()
-    trials = data['Trial Number'].dropna()
-    presses = data['Lever Press'].dropna()
-
-    # Create aggregate stats
-    stat_names = ['# of Trials', 
+from phase_engine import compile_spec, bout_table, event_columns, time_ms
+from excel_utils import StreamingWorkbook, sheet_chunks
+from session_db import store_stats
+
+# Phase 1: cue-started trials, licks during the cue are rewarded
+phase1_spec = {
+    'anchor': 'cue',
+    'presses': None,
+    'reward': {'reward': 'reward', 'time': 'cue'},
+    'lick_latency': 'trial',
+    'aggregate': ['Latency to First Lick (ms)', 
+                  '# of Rewarded Licks', 
+                  '# of Non-Rewarded Licks', 
+                  'Total # of Licks'],
+    'trial': ['Latency to First Lick (ms)', 
+              '# of Rewarded Licks', 
+              '# of Non-Rewarded Licks', 
+              'Total # of Licks'],
+}
+
+# Phase 2: press-started trials, licks during the cue after a press are rewarded
+phase2_spec = {
+    'anchor': 'press',
+    'presses': 'count',
+    'reward': {'reward': 'reward', 'time': 'cue'},
+    'lick_latency': 'trial',
+    'aggregate': ['# of Trials', 
                   'Latency to First Press (ms)', 
                   'Latency to First Lick (ms)', 
                   '# of Rewarded Licks', 
                   '# of Non-Rewarded Licks', 
-                  'Total # of Licks']
-    
-    # Split licks into rewarded and not rewarded and compute stats
-    if mode == 'reward':
-        rewards = data['Reward'].dropna()
-        licks_rewarded, licks_not_rewarded = lick_reward_split(rewards, licks)
-    elif mode == 'time':
-        cues = data['Cue'].dropna()
-        licks_rewarded, licks_not_rewarded, _ = cue_split(cues, licks)
-    lick_stats = ratio_stats(licks_rewarded, licks_not_rewarded)
-    if lick_stats[-1] != licks.sum():
-        print(f"WARNING: Lick sum mismatch. Expected {licks.sum()}, but got {lick_stats[-1]}.")
-
-    # Number of lever presses (i.e. trials)
-    num_lever_presses = presses.shape[0]
-
-    # Latency to first press (i.e. trial) from test start
-    start_time = data.index[0]
-    first_press = presses.index[0]
-    press_latency = first_press - start_time
-    
-    # Latency to first lick
-    initial_lick_latency = latency_to_first_lick(licks_rewarded, time = data.index[0])
-
-    # Export stats
-    aggregate_data = (num_lever_presses, press_latency, initial_lick_latency) + lick_stats
-    aggregate_frame = pd.DataFrame(aggregate_data, index = stat_names)
-
-    # Parse each trial
-    trial_records = []
-    trials_start = trials.drop_duplicates()
-    for i in range(trials_start.shape[0]):
-        start = trials_start.index[i]
-        if i < trials_start.shape[0] - 1:
-            end = trials_start.index[i + 1]
-        else:
-            end = None
-        time_range = [start, end]
-
-        # Compute stats
-        trial_lick_latency = latency_to_first_lick(licks_rewarded, trials = trials, time_range = time_range)
-        trial_stats = ratio_stats(licks_rewarded, licks_not_rewarded, time_range = time_range)
-        trial_records.append((trial_lick_latency,) + trial_stats)
-    
-    # Export trial data
-    trial_indexes = [f'Trial {int(x)}' for x in trials_start]
-    trial_frame = pd.DataFrame(trial_records, index = trial_indexes, columns = stat_names[2:])
-
-    # Export bout information
-    bout_frame = lick_bouts(licks, licks_rewarded, trials_start)
-
-    return aggregate_frame, trial_frame, bout_frame
-
-# Compute stats on mice operant training task for phase 3
-def phase3(data: pd.DataFrame, mode: str):
-    # Extract required columns
-    licks = data['# of Licks'].dropna()
-    trials = data['Trial Number'].dropna()
-    cues = data['Cue'].dropna()
-    presses = data['Lever Press'].dropna()
-
-    # Create aggregate stats
-    stat_names = ['Latency to First Press (ms)',
-                    '# of Presses within Cue',
-                    '# of Presses outside Cue',
-                    'Total # of Presses', 
-                    'Latency to First Lick (ms)', 
-                    '# of Rewarded Licks', 
-                    '# of Non-Rewarded Licks', 
-                    'Total # of Licks']
-    
-    # Split presses into in/out of cue and compute stats
-    press_in_cue, press_out_cue, cue_on = cue_split(cues, presses)
-    press_stats = ratio_stats(press_in_cue, press_out_cue)
-    if press_stats[-1] != presses.sum():
-        print(f"WARNING: Presses sum mismatch. Expected {presses.sum()}, but got {press_stats[-1]}.")
-
-    # Split licks into rewarded and not rewarded and compute stats
-    if mode == 'reward':
-        rewards = data['Reward'].dropna()
-        # Remove rewards that are printed with presses
-        press_reward = [x for x in rewards.index if np.min(np.abs(presses.index - x)) < 0.005]
-        rewards = rewards.loc[rewards.index.difference(press_reward)]
-        licks_rewarded, licks_not_rewarded = lick_reward_split(rewards, licks)
-    elif mode == 'time':
-        licks_rewarded, licks_not_rewarded = lick_press_split(press_in_cue, licks)
-    lick_stats = ratio_stats(licks_rewarded, licks_not_rewarded)
-    if lick_stats[-1] != licks.sum():
-        print(f"WARNING: Lick sum mismatch. Expected {licks.sum()}, but got {lick_stats[-1]}.")
-
-    # Latency to first press from start of test
-    trials_start = trials.drop_duplicates()
-    initial_press_latency = latency_to_first_press(presses, time = trials_start.index[0])
-
-    # Latency to first lick from start of test
-    initial_lick_latency = latency_to_first_lick(licks_rewarded, time = trials_start.index[0])
-
-    # Export stats to sheet
-    aggregate_data = (initial_press_latency,) + press_stats + (initial_lick_latency,) + lick_stats
-    aggregate_frame = pd.DataFrame(aggregate_data, index = stat_names)
-
-    # Parse each trial
-    trial_records = []
-    for i in range(trials_start.shape[0]):
-        # Get start/end times of trial
-        start = trials_start.index[i]
-        if i < trials_start.shape[0] - 1:
-            end = trials_start.index[i + 1]
-        else:
-            end = None
-        time_range = [start, end]
-
-        # Compute press stats
-        trial_press_latency = latency_to_first_press(press_in_cue, cues = cue_on, time_range = time_range)
-        trial_press_stats = ratio_stats(press_in_cue, press_out_cue, time_range = time_range)
-
-        # Compute lick stats
-        trial_lick_latency = latency_to_first_lick(licks_rewarded, presses = press_in_cue, time_range = time_range)
-        trial_lick_stats = ratio_stats(licks_rewarded, licks_not_rewarded, time_range = time_range)
-
-        trial_records.append((trial_press_latency,) + trial_press_stats + (trial_lick_latency,) + trial_lick_stats)
-    
-    # Export trial data
-    trial_indexes = [f'Trial {int(x)}' for x in trials_start]
-    trial_frame = pd.DataFrame(trial_records, index = trial_indexes, columns = stat_names)
-
-    # Export bout information
-    bout_frame = lick_bouts(licks, licks_rewarded, trials_start)
-
-    return aggregate_frame, trial_frame, bout_frame
+                  'Total # of Licks'],
+    'trial': ['Latency to First Lick (ms)', 
+              '# of Rewarded Licks', 
+              '# of Non-Rewarded Licks', 
+              'Total # of Licks'],
+}
+
+# Phase 3: cue-started trials, licks within 5 seconds of a press during the cue are rewarded
+phase3_spec = {
+    'anchor': 'cue',
+    'presses': 'cue',
+    'reward': {'reward': 'reward_without_press', 'time': 'press'},
+    'press_window': 5,
+    'lick_latency': 'press',
+    'aggregate': ['Latency to First Press (ms)',
+                  '# of Presses within Cue',
+                  '# of Presses outside Cue',
+                  'Total # of Presses', 
+                  'Latency to First Lick (ms)', 
+                  '# of Rewarded Licks', 
+                  '# of Non-Rewarded Licks', 
+                  'Total # of Licks'],
+    'trial': ['Latency to First Press (ms)',
+              '# of Presses within Cue',
+              '# of Presses outside Cue',
+              'Total # of Presses', 
+              'Latency to First Lick (ms)', 
+              '# of Rewarded Licks', 
+              '# of Non-Rewarded Licks', 
+              'Total # of Licks'],
+}
+
+# Compute stats on mice operant training task for each phase
+phase1 = compile_spec(phase1_spec)
+phase2 = compile_spec(phase2_spec)
+phase3 = compile_spec(phase3_spec)
 
 # Split licks into lick bouts based on simple threshold
 def lick_bouts(licks: pd.Series, licks_rewarded: pd.Series, trials_start: pd.Series, threshold: float = 0.5):
-    # For each trial
-    bout_records = []
-    for i in range(trials_start.shape[0]):        
-        # Filter licks within trial
-        start = trials_start.index[i]
-        if i == trials_start.shape[0] - 1:
-            end = None
-        else:
-            end = trials_start.index[i + 1]
-        trial_licks = filter_range(licks, [start, end])
-
-        # Compute difference between each lick time
-        # Use threshold to split into lick bouts
-        if trial_licks.shape[0] > 0:
-            time_diff = np.diff(trial_licks.index)
-            trial_lick_bouts = np.split(trial_licks.index, np.where(time_diff > threshold)[0] + 1)
-            
-            # Add record for lick bouts
-            for bout in trial_lick_bouts:
-                # Determine number of licks in bout
-                bout_licks = filter_range(licks, [bout[0], bout[-1]])
-                bout_lick_total = bout_licks.sum()
-
-                # Determine whether bout is rewarding
-                bout_lick_times = bout_licks.index.to_series()
-                bout_licks_reward = bout_lick_times.apply(lambda x: x in licks_rewarded.index)
-                bout_rewarding = bout_licks_reward.any()
-
-                # Determine whether bout is highly rewarding
-                bout_highly_rewarding = bout_licks_reward.sum() > 5
-
-                # Determine lick efficiency
-                bout_duration = bout[-1] - bout[0]
-                if bout_duration > 0:
-                    bout_lick_times = bout_licks.index.to_series()
-                    bout_time_diff = np.diff(bout_lick_times)
-                    bout_lick_efficiency = (bout_time_diff <= 0.15).sum() / bout_time_diff.shape[0]
-                else:
-                    bout_lick_efficiency = 0
-
-                bout_records.append((int(trials_start.values[i]), bout[0], bout[-1], bout_lick_total, bout_rewarding, bout_highly_rewarding, bout_lick_efficiency))
-    
-    # Create DataFrame from bout records
-    bout_frame_columns = ['Trial Number', 'Start', 'End', '# of Licks', 'Rewarding', "Highly Rewarding", 'Lick Efficiency']
-    bout_frame = pd.DataFrame.from_records(bout_records, columns = bout_frame_columns)
-
-    # Print warning if there are only non-rewarding or only rewarding bouts
-    if bout_frame['Rewarding'].sum() == 0:
-        print('WARNING: all bouts were identified as NON-REWARDING. Please double-check the original Arduino log to make sure this is valid.')
-    elif bout_frame['Rewarding'].sum() == bout_frame.shape[0]:
-        print('WARNING: all bouts were identified as REWARDING. Please double-check the original Arduino log to make sure this is valid.')
-    
-    return bout_frame
+    return bout_table(
+        time_ms(licks.index),
+        licks.to_numpy(),
+        time_ms(licks_rewarded.index),
+        time_ms(trials_start.index),
+        trials_start.to_numpy(),
+        threshold
+    )
+
+# Read the event table of a parsed sheet in blocks of `chunk_rows` rows, keeping only the event columns
+# Rows without events (e.g. force or calcium samples) are dropped, except the first one that starts the session,
+# so memory grows with the number of events instead of the length of the log
+def read_events(xls: pd.ExcelFile, sheet_name: str, chunk_rows: int):
+    header = []
+    kept = []
+    for header, rows in sheet_chunks(xls, sheet_name, chunk_rows):
+        if 'Time' not in header:
+            return pd.DataFrame(columns = header)
+        time_column = header.index('Time')
+        columns = [header.index(x) for x in event_columns if x in header]
+        for row in rows:
+            if len(kept) == 0 or any(row[i] is not None for i in columns):
+                kept.append([row[time_column]] + [row[i] for i in columns])
+    names = ['Time'] + [x for x in event_columns if x in header]
+    data = pd.DataFrame([[np.nan if x is None else x for x in row] for row in kept], columns = names)
+    return data
 
 # Export stats on mice operant training task
-def phase_stats(path: Path, mode: str, func: callable):
-    # Import parsed data
-    data = pd.read_excel(path, sheet_name = None)
-
-    # Create ExcelWriter for output file
+# With `chunk_rows`, each parsed sheet is read in blocks of rows and only its events are kept in memory
+def phase_stats(path: Path, mode: str, func: callable, chunk_rows: int | None = None):
+    # Create streaming workbook for output file
     file_name = path.stem.split('-')[0]
     dir_tree = list(path.parts[:-1])
     dir_tree[0] = 'stats'
     output_folder = Path(*dir_tree)
     output_folder.mkdir(parents = True, exist_ok = True)
-    writer = pd.ExcelWriter(output_folder / f'{file_name}-{mode}.xlsx', engine = 'xlsxwriter')
 
-    # For each data frame
-    for frame_name in data:
-        # Skip first sheet with mouse ID
-        if 'Animal ID' in data[frame_name].columns:
-            continue
-        else:
-            print(f"Mouse ID: {frame_name}")
-            raw_data = data[frame_name].set_index('Time')
-            aggregate_frame, trial_frame, bout_frame = func(raw_data, mode)
-            aggregate_frame.to_excel(writer, sheet_name = f'{frame_name} Test Stats', header = False)
-            trial_frame.to_excel(writer, sheet_name = f'{frame_name} Trial Stats')
-            bout_frame.to_excel(writer, sheet_name = f'{frame_name} Bouts', index = False)   
-    # Close excel writer
-    writer.close()
+    # Import parsed data one sheet at a time
+    with pd.ExcelFile(path) as xls, StreamingWorkbook(output_folder / f'{file_name}-{mode}.xlsx') as workbook:
+        for frame_name in xls.sheet_names:
+            data = xls.parse(frame_name) if chunk_rows is None else read_events(xls, frame_name, chunk_rows)
+
+            # Skip first sheet with mouse ID
+            if 'Animal ID' in data.columns:
+                continue
+            else:
+                print(f"Mouse ID: {frame_name}")
+                raw_data = data.set_index('Time')
+                aggregate_frame, trial_frame, bout_frame = func(raw_data, mode)
+                workbook.write_frame(f'{frame_name} Test Stats', aggregate_frame, header = False)
+                workbook.write_frame(f'{frame_name} Trial Stats', trial_frame)
+                workbook.write_frame(f'{frame_name} Bouts', bout_frame, index = False)
+                store_stats(path, frame_name, mode, aggregate_frame, trial_frame, bout_frame)
 
 modes = ['reward', 'time']
 
-# Run phase 1
-data_folder = Path('parsed_data')
-phase1_files = (data_folder / 'phase 1').glob('phase*.xlsx')
-for file in phase1_files:
-    for mode in modes:
-        print(f"Processing Arduino file: {file}, Mode: {mode}")
-        phase_stats(file, mode, phase1)
+# Stats function of each phase folder
+phase_funcs = {'phase 1': phase1, 'phase 2': phase2, 'phase 3': phase3}
 
-# Run phase 2
-phase2_files = (data_folder / 'phase 2').glob('phase*.xlsx')
-for file in phase2_files:
-    for mode in modes:
-        print(f"Processing Arduino file: {file}, Mode: {mode}")
-        phase_stats(file, mode, phase2)
+# Export stats for all parsed Arduino logs
+def process_all():
+    data_folder = Path('parsed_data')
+    for phase, func in phase_funcs.items():
+        for file in (data_folder / phase).glob('phase*.xlsx'):
+            for mode in modes:
+                print(f"Processing Arduino file: {file}, Mode: {mode}")
+                phase_stats(file, mode, func)
 
-# Run phase 3
-phase3_files = (data_folder / 'phase 3').glob('phase*.xlsx')
-for file in phase3_files:
-    for mode in modes:
-        print(f"Processing Arduino file: {file}, Mode: {mode}")
-        phase_stats(file, mode, phase3)
\ No newline at end of file
+if __name__ == "__main__":
+    process_all()
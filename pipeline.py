@@ -0,0 +1,308 @@
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from pathlib import Path
+import argparse
+import os
+
+# Pipeline stages in the order of the README
+stages = ['parse', 'stats', 'compare', 'force', 'sync', 'trial-export', 'trial-plots', 'bout-export', 'bout-analysis', 'peth']
+
+# Input and output folders (relative to the working directory, like the individual scripts)
+original_dir = Path('original_data')
+arduino_dir = Path('parsed_data')
+stats_dir = Path('stats')
+calcium_csv_dir = Path('original_calcium_data')
+
+# A unit of work in the pipeline graph
+# `deps` are names of tasks that must succeed first, `after` are names of tasks that must only finish first
+# (e.g. readers of a file the task rewrites), `locks` serialize tasks that write the same files
+# and `inputs` are names of tasks whose return values are passed as the last argument
+class Task:
+    def __init__(self, name: str, stage: str, func: callable, args: tuple = (), deps: list[str] = (), after: list[str] = (), locks: list[str] = (), inputs: list[str] = ()):
+        self.name = name
+        self.stage = stage
+        self.func = func
+        self.args = args
+        self.deps = list(deps)
+        self.after = list(after)
+        self.locks = [str(x) for x in locks]
+        self.inputs = list(inputs)
+
+# Stage functions run in the worker processes (modules are imported there, not in the scheduler)
+def run_parse(original_file: Path, chunk_rows: int | None = None):
+    from arduino_log_parse import parse_data
+    parse_data(original_file, chunk_rows)
+
+def run_stats(arduino_file: Path, phase: str, chunk_rows: int | None = None):
+    from phase_stats import phase_stats, phase_funcs, modes
+    for mode in modes:
+        phase_stats(arduino_file, mode, phase_funcs[f'phase {phase}'], chunk_rows)
+
+def run_compare(stats_folder: Path, name: str):
+    from compare_modes import compare_file
+    compare_file(stats_folder, name)
+
+def run_force(phase: str):
+    from force_analysis import main
+    main(arduino_dir / f'phase {phase}', stats_dir / f'phase {phase}', Path('plots') / f'phase {phase}')
+
+def run_sync(arduino_file: Path, sheet: str, calcium_csv: Path, chunk_rows: int | None = None):
+    from calcium_data_synchronize import main
+
+    # Mice with only an already synchronized calcium workbook keep it; any other error fails the task
+    if not calcium_csv.exists():
+        print(f"Calcium data file '{calcium_csv}' not found. Keeping the synchronized data of {sheet}.")
+        return
+    main(arduino_file, sheet, calcium_csv, chunk_rows, raise_errors=True)
+
+def run_trial_export(phase: str, calcium_files: list[Path]):
+    from calcium_trial_export import export_trials
+
+    # The export appends to an existing output, so start from scratch to keep reruns identical
+    output_file = arduino_dir / f'all_trials_phase_{phase}.xlsx'
+    output_file.unlink(missing_ok=True)
+    export_trials(arduino_dir / f'phase {phase}', output_file, calcium_files)
+
+def run_trial_plots(arduino_file: Path, sheet: str, calcium_file: Path, arduino_stats_file: Path):
+    from calcium_trial_plots import trial_plot, trial_average_plot
+    trial_plot(arduino_file, sheet, calcium_file, workers=1)
+    trial_average_plot(arduino_stats_file, sheet, calcium_file)
+
+def run_cohort(units: list[tuple]):
+    from calcium_trial_plots import trial_average_traces, cohort_average_plot, cohort_groups
+    from calcium_utils import GroupedAccumulator
+    cohort = GroupedAccumulator()
+    for phase, day, sheet, arduino_stats_file, calcium_file in units:
+        labels = {'phase': f'phase {phase}', 'day': day, 'mouse': sheet}
+        try:
+            trial_average_traces(arduino_stats_file, sheet, calcium_file, cohort, tuple(labels[x] for x in cohort_groups))
+        except Exception as e:
+            print(f"Error processing sheet {sheet} averages: {e}")
+    if len(cohort.groups) > 0:
+        cohort_average_plot(cohort, Path('plots'))
+
+def run_bout_export(arduino_stats_file: Path, sheet: str, calcium_file: Path, output_file: Path):
+    from calcium_bout_export import main
+    main(arduino_stats_file, sheet, calcium_file, output_file)
+
+def run_peth(arduino_file: Path, sheet: str, calcium_file: Path, output_file: Path):
+    from calcium_peth import main
+    main(arduino_file, sheet, calcium_file, output_file)
+
+def run_bout_metrics(arduino_stats_file: Path, sheet: str, calcium_file: Path):
+    from calcium_bout_analysis import analyze_mouse
+    from excel_utils import read_sheet
+    try:
+        mouse_stats = read_sheet(arduino_stats_file, f'{sheet} Bouts')
+    except Exception as e:
+        print(f"Error occurred while processing {sheet}: {e}")
+        return None
+    return sheet, analyze_mouse(mouse_stats, sheet, calcium_file)
+
+def run_bout_write(arduino_stats_file: Path, results: list):
+    from calcium_bout_analysis import update_stats
+    bout_frames = {x[0]: x[1] for x in results if x is not None and x[1] is not None}
+    update_stats(arduino_stats_file, bout_frames)
+    print(f"Updated {len(bout_frames)} Bouts sheets in {arduino_stats_file}")
+
+def run_bout_comparison(phase: str):
+    from calcium_bout_analysis import cohort_comparison
+    cohort_comparison(stats_dir / f'phase {phase}')
+
+# Find the (phase, day file) pairs and the mice with calcium data of each test day
+# Test days come from the original logs when they will be parsed, otherwise from the parsed logs
+def find_units(parse: bool = True):
+    from excel_utils import sheet_names
+
+    days = []
+    if parse and original_dir.exists():
+        # Excel logs and folders of binary logs (one <mouse>.bin file per animal)
+        sources = sorted(original_dir.glob('phase */*.xlsx')) + sorted({x.parent for x in original_dir.glob('phase */*/*.bin')})
+    else:
+        sources = sorted(arduino_dir.glob('phase */phase*.xlsx'))
+    for source in sources:
+        phase = source.parent.name.split()[-1]
+        if source.is_dir():
+            sheets = sorted(x.stem for x in source.glob('*.bin'))
+        else:
+            sheets = sheet_names(source)
+
+        # Mice with either a raw calcium recording or an already synchronized calcium workbook
+        mice = [
+            x for x in sheets
+            if (calcium_csv_dir / f'phase {phase}' / f'{x}.csv').exists() or (arduino_dir / f'phase {phase}' / f'{x}.xlsx').exists()
+        ]
+        days.append((phase, source, mice))
+    return days
+
+# Build the task graph over (mouse, day, phase) units
+# With `chunk_rows`, parsing, stats and synchronization process each session in blocks of rows
+def build_tasks(selected: list[str], chunk_rows: int | None = None):
+    tasks = []
+    cohort_units = []
+    parsed = {}
+    synced = {}
+    readers = {}
+    bout_writes = {}
+    for phase, source, mice in find_units('parse' in selected):
+        day = source.stem
+        day_key = f'{phase}/{day}'
+        arduino_file = arduino_dir / f'phase {phase}' / f'{day}.xlsx'
+        stats_folder = stats_dir / f'phase {phase}'
+        arduino_stats_file = stats_folder / f'{day}-reward.xlsx'
+
+        # Per test day: parse, stats (both modes) and mode comparison
+        tasks.append(Task(f'parse:{day_key}', 'parse', run_parse, (source, chunk_rows)))
+        tasks.append(Task(f'stats:{day_key}', 'stats', run_stats, (arduino_file, phase, chunk_rows), [f'parse:{day_key}']))
+        tasks.append(Task(f'compare:{day_key}', 'compare', run_compare, (stats_folder, day), [f'stats:{day_key}']))
+        readers[day_key] = [f'compare:{day_key}']
+        parsed.setdefault(phase, []).append(f'parse:{day_key}')
+
+        # Per mouse: synchronization and everything downstream of it
+        # Trial plots read the parsed log, so they wait for the synchronization of every mouse of the day
+        day_syncs = [f'sync:{day_key}/{x}' for x in mice]
+        for sheet in mice:
+            unit = f'{day_key}/{sheet}'
+            calcium_csv = calcium_csv_dir / f'phase {phase}' / f'{sheet}.csv'
+            calcium_file = arduino_dir / f'phase {phase}' / f'{sheet}.xlsx'
+            upstream = [f'sync:{unit}', f'stats:{day_key}']
+
+            # Synchronization adds the calcium column to the parsed log, so it waits for the stats that read it
+            tasks.append(Task(f'sync:{unit}', 'sync', run_sync, (arduino_file, sheet, calcium_csv, chunk_rows), [f'parse:{day_key}', f'stats:{day_key}'], locks=[arduino_file, calcium_file]))
+            synced.setdefault(phase, {}).setdefault(calcium_file, []).append(f'sync:{unit}')
+            tasks.append(Task(f'trial-plots:{unit}', 'trial-plots', run_trial_plots, (arduino_file, sheet, calcium_file, arduino_stats_file), day_syncs + [f'stats:{day_key}']))
+            tasks.append(Task(f'bout-export:{unit}', 'bout-export', run_bout_export, (arduino_stats_file, sheet, calcium_file, stats_folder / f'{sheet}_bouts.xlsx'), upstream))
+            tasks.append(Task(f'bout-metrics:{unit}', 'bout-analysis', run_bout_metrics, (arduino_stats_file, sheet, calcium_file), upstream))
+            tasks.append(Task(f'peth:{unit}', 'peth', run_peth, (arduino_file, sheet, calcium_file, stats_folder / f'{sheet}_peth.xlsx'), day_syncs))
+            readers[day_key] += [f'trial-plots:{unit}', f'bout-export:{unit}']
+            cohort_units.append((phase, day, sheet, arduino_stats_file, calcium_file))
+
+        # Bout metrics of all mice are written to the stats workbook at once, after the other readers of that day's workbook
+        # (the cohort averages only read its Trial Stats, and the workbook is replaced atomically, so they do not wait for each other)
+        metrics = [f'bout-metrics:{day_key}/{x}' for x in mice]
+        tasks.append(Task(f'bout-analysis:{day_key}', 'bout-analysis', run_bout_write, (arduino_stats_file,), metrics, readers[day_key], locks=[arduino_stats_file], inputs=metrics))
+        bout_writes.setdefault(phase, []).append(f'bout-analysis:{day_key}')
+
+    # Per phase: force threshold sweep over the force traces saved by the parser (phases with a lever)
+    for phase, parse_tasks in parsed.items():
+        if phase != '1':
+            tasks.append(Task(f'force:{phase}', 'force', run_force, (phase,), parse_tasks))
+
+    # Per phase: trial export of all synchronized calcium files
+    for phase, calcium_files in synced.items():
+        tasks.append(Task(f'trial-export:{phase}', 'trial-export', run_trial_export, (phase, list(calcium_files)), sum(calcium_files.values(), [])))
+
+    # Per phase: rewarding vs non-rewarding bout metrics over the cohort, once all stats workbooks of the phase are updated
+    for phase, writes in bout_writes.items():
+        tasks.append(Task(f'bout-comparison:{phase}', 'bout-analysis', run_bout_comparison, (phase,), writes))
+
+    # Cohort averages over all mice
+    tasks.append(Task('trial-plots:cohort', 'trial-plots', run_cohort, (cohort_units,), [f'trial-plots:{x[0]}/{x[1]}/{x[2]}' for x in cohort_units]))
+
+    return [x for x in tasks if x.stage in selected]
+
+# Run one task in a worker process, then empty the worker's sheet cache
+# (each worker has its own cache, so it would otherwise keep up to excel_utils.cache_bytes between tasks)
+def run_task(func: callable, *args):
+    try:
+        return func(*args)
+    finally:
+        from excel_utils import clear_sheets
+        clear_sheets()
+
+# Run tasks as soon as their dependencies are done, in a process pool
+# Dependencies on tasks outside the graph (deselected stages) are assumed to be satisfied
+def run_tasks(tasks: list[Task], workers: int | None = None):
+    names = {x.name for x in tasks}
+    pending = {x.name: x for x in tasks}
+    done = set()
+    failed = set()
+    results = {}
+    locks = set()
+    running = {}
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while len(pending) > 0 or len(running) > 0:
+            # Skip tasks downstream of a failure
+            for name, task in list(pending.items()):
+                if any(x in failed for x in task.deps):
+                    print(f"Skipping {name}: an upstream task failed")
+                    failed.add(name)
+                    del pending[name]
+
+            # Submit every ready task whose lock is free
+            for name, task in list(pending.items()):
+                ready = all(x in done or x not in names for x in task.deps)
+                ready = ready and all(x in done or x in failed or x not in names for x in task.after)
+                if ready and locks.isdisjoint(task.locks):
+                    args = task.args + ((
+                        [results.get(x) for x in task.inputs],
+                    ) if len(task.inputs) > 0 else ())
+                    running[executor.submit(run_task, task.func, *args)] = task
+                    locks.update(task.locks)
+                    del pending[name]
+            if len(running) == 0:
+                break
+
+            # Wait for any task to finish
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                task = running.pop(future)
+                locks.difference_update(task.locks)
+                try:
+                    results[task.name] = future.result()
+                    done.add(task.name)
+                    print(f"Finished {task.name}")
+                except Exception as e:
+                    print(f"Error in {task.name}: {e}")
+                    failed.add(task.name)
+
+    return done, failed
+
+# Stages selected by --only/--from
+def select_stages(only: list[str] | None = None, start: str | None = None):
+    if only:
+        return [x for x in stages if x in only]
+    if start:
+        return stages[stages.index(start):]
+    return stages
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description='Run the operant training analysis pipeline.')
+    parser.add_argument('--only', nargs='+', choices=stages, help='run only these stages')
+    parser.add_argument('--from', dest='start', choices=stages, help='run this stage and all later stages')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes')
+    parser.add_argument('--dry-run', action='store_true', help='list the tasks without running them')
+    parser.add_argument('--chunk-rows', type=int, help='parse, compute stats and synchronize in blocks of this many rows to cap memory on long sessions')
+    parser.add_argument('--db', type=Path, help='also store results in this SQLite session database (see session_db.py)')
+    parser.add_argument('--channel', help="calcium channel analysed after synchronization, e.g. 'dFF' (see calcium_utils.channel)")
+    parser.add_argument('--export-bouts', action='store_true', help='also write the calcium data of each bout to the bout exports (see calcium_bout_export.py)')
+    args = parser.parse_args(argv)
+    if args.only and args.start:
+        parser.error('--only and --from cannot be combined')
+
+    # Enable the session database in this process and in the workers
+    if args.db is not None:
+        import session_db
+        os.environ['OPERANT_SESSION_DB'] = str(args.db)
+        session_db.database_file = str(args.db)
+
+    # Select the calcium channel in the workers (they import the calcium scripts after this point)
+    if args.channel is not None:
+        os.environ['OPERANT_CALCIUM_CHANNEL'] = args.channel
+
+    # Write the per-bout sheets in the workers
+    if args.export_bouts:
+        os.environ['OPERANT_EXPORT_BOUTS'] = '1'
+
+    tasks = build_tasks(select_stages(args.only, args.start), args.chunk_rows)
+    if args.dry_run:
+        for task in tasks:
+            print(f"{task.name} <- {', '.join(task.deps + task.after) if task.deps or task.after else '-'}")
+        return
+
+    done, failed = run_tasks(tasks, args.workers)
+    print(f"{len(done)} tasks finished, {len(failed)} failed or skipped")
+    if len(failed) > 0:
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,373 @@
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import hashlib
+import json
+import os
+import numpy as np
+from matplotlib.figure import Figure
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.patches import Rectangle
+from matplotlib.backends.backend_pdf import PdfPages
+from matplotlib.image import imsave
+
+# Output presets for rendered figures ('draft' is meant for fast iteration)
+render_presets = {
+    'publication': {'dpi': 600, 'format': 'png'},
+    'screen': {'dpi': 150, 'format': 'png'},
+    'draft': {'dpi': 72, 'format': 'png'},
+    'vector': {'dpi': 300, 'format': 'pdf'},
+}
+
+# Largest width of a contact-sheet tile in pixels (tiles are drawn at the preset dpi or lower,
+# so a 4 x 4 sheet stays around 3200 x 2400 pixels even with the 'publication' preset)
+contact_tile_width = 800
+
+# Look up a render preset by name (or pass a preset dictionary through)
+def get_preset(preset: str | dict):
+    if isinstance(preset, dict):
+        return preset
+    if preset not in render_presets:
+        raise ValueError(f"Unknown render preset '{preset}'. Choose from {list(render_presets)}.")
+    return render_presets[preset]
+
+# Reusable trial figure built on the Agg object-oriented API
+# Artists are created once and only their data is updated for each trial
+class TrialFigure:
+    def __init__(self):
+        self.figure = Figure()
+        FigureCanvasAgg(self.figure)
+        self.ax = self.figure.add_subplot()
+        ax = self.ax
+        span_transform = ax.get_xaxis_transform()
+
+        self.trace, = ax.plot([], [], color='#218BFF')
+        self.cue_line = ax.axvline(0, color='#000000', linestyle='--', label='Cue Start')
+        self.cue_span = ax.add_patch(Rectangle((0, 0), 0, 1, transform=span_transform, alpha=0.2, color='#218BFF', label='Cue On'))
+        self.press_lines = ax.vlines([], 0, 1, transform=span_transform, colors='#FF0000', linestyles='--', label='Lever Press')
+        self.press_span = ax.add_patch(Rectangle((0, 0), 0, 1, transform=span_transform, alpha=0.2, color='#4B0092', label='Lever Press Time'))
+        self.licks_rewarded = ax.scatter([], [], marker='|', color='#DD7815', label='Rewarding Licks')
+        self.licks_not_rewarded = ax.scatter([], [], marker='|', color='#000000', label='Non-Rewarding Licks')
+
+        ax.set_xlabel('Time (s)')
+        ax.set_ylabel(r"$\Delta F/F$")
+        self.legend_handles = None
+
+    # Update the artists with the data of one trial
+    def update(self, trial: dict):
+        ax = self.ax
+        time = np.asarray(trial['time'], dtype=float)
+        calcium = np.asarray(trial['calcium'], dtype=float)
+        lick_height = trial['max_calcium'] + 0.5
+
+        # Calcium trace and cue period
+        self.trace.set_data(time, calcium)
+        self.cue_span.set_width(trial['cue_off'])
+
+        # Lever presses (phase 3 only)
+        presses = trial.get('presses')
+        has_presses = presses is not None and len(presses) > 0
+        if has_presses:
+            self.press_lines.set_segments([[(x, 0), (x, 1)] for x in presses])
+            self.press_span.set_x(presses[0])
+            self.press_span.set_width(presses[-1] - presses[0] + 5)
+        self.press_lines.set_visible(has_presses)
+        self.press_span.set_visible(has_presses)
+
+        # Licks are marked above the calcium trace
+        for scatter, licks in ((self.licks_rewarded, trial['licks_rewarded']), (self.licks_not_rewarded, trial['licks_not_rewarded'])):
+            licks = np.asarray(licks, dtype=float)
+            scatter.set_offsets(np.column_stack((licks, np.full(licks.shape[0], lick_height))))
+
+        # Axis limits (lower limit follows the data like pyplot autoscaling)
+        low = calcium.min() if calcium.shape[0] > 0 else 0
+        high = max(calcium.max() if calcium.shape[0] > 0 else 0, lick_height)
+        ax.set_xlim(trial['axis_start'], trial['axis_end'])
+        ax.set_xticks(np.arange(trial['tick_start'], trial['axis_end'], 2))
+        ax.set_ylim(low - 0.05 * (high - low), trial['max_calcium'] + 1)
+
+        # Only rebuild the legend (and layout) when its entries change
+        handles = [self.cue_line, self.cue_span]
+        if has_presses:
+            handles += [self.press_lines, self.press_span]
+        handles += [self.licks_rewarded, self.licks_not_rewarded]
+        if handles != self.legend_handles:
+            ax.legend(handles=handles, loc='lower center', bbox_to_anchor=(0.5, 1.0), ncol=3)
+            self.figure.tight_layout()
+            self.legend_handles = handles
+
+    # Render one trial to its output file
+    def render(self, trial: dict, preset: str | dict = 'publication'):
+        preset = get_preset(preset)
+        self.update(trial)
+        output = Path(trial['output']).with_suffix(f".{preset['format']}")
+        self.figure.savefig(output, dpi=preset['dpi'], format=preset['format'])
+        return output
+
+# One persistent figure per worker process
+worker_figure = None
+
+# Render a single trial with the figure of the current process
+def render_trial(trial: dict, preset: str | dict = 'publication'):
+    global worker_figure
+    if worker_figure is None:
+        worker_figure = TrialFigure()
+    try:
+        return worker_figure.render(trial, preset)
+    except Exception as e:
+        print(f"Error processing trial {trial.get('trial')}: {e}")
+        return None
+
+# Render many trials, distributed across a process pool
+# Each trial is a dictionary of plain arrays so it can be sent to the workers
+def render_trials(trials: list[dict], preset: str | dict = 'publication', workers: int | None = None):
+    preset = get_preset(preset)
+    if workers == 1 or len(trials) < 2:
+        return [render_trial(x, preset) for x in trials]
+
+    workers = workers or os.cpu_count() or 1
+    chunksize = max(1, len(trials) // (4 * workers))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(render_trial, trials, [preset] * len(trials), chunksize=chunksize))
+
+# Hash the exact inputs of a plot (arrays, scalars and style parameters)
+def input_hash(*inputs, **style):
+    digest = hashlib.sha1()
+    for value in list(inputs) + [style[x] for x in sorted(style)]:
+        if isinstance(value, dict):
+            digest.update(input_hash(**{str(x): y for x, y in value.items()}).encode())
+        elif isinstance(value, (np.ndarray, list, tuple)) or hasattr(value, 'to_numpy'):
+            array = np.ascontiguousarray(value.to_numpy() if hasattr(value, 'to_numpy') else value)
+            digest.update(f'{array.dtype}{array.shape}'.encode())
+            digest.update(array.tobytes() if array.dtype != object else repr(array.tolist()).encode())
+        else:
+            digest.update(repr(value).encode())
+        digest.update(b'|')
+    digest.update(repr(sorted(style)).encode())
+    return digest.hexdigest()
+
+# Manifest of rendered plots in a folder and the hash of the inputs each was made from
+# Used to skip plots whose inputs did not change and to prune stale outputs
+class RenderManifest:
+    def __init__(self, folder: Path, name: str = '.render_manifest.json'):
+        self.folder = Path(folder)
+        self.path = self.folder / name
+        self.entries = {}
+        if self.path.exists():
+            try:
+                self.entries = json.loads(self.path.read_text())
+            except ValueError:
+                self.entries = {}  # Corrupt manifest, render everything again
+        self.seen = set()
+
+    # Check whether an output exists and was rendered from the same inputs
+    def is_current(self, output: Path, key: str):
+        output = Path(output)
+        self.seen.add(output.name)
+        return output.exists() and self.entries.get(output.name) == key
+
+    # Record the inputs an output was rendered from
+    def record(self, output: Path, key: str):
+        output = Path(output)
+        self.seen.add(output.name)
+        self.entries[output.name] = key
+
+    # Delete outputs recorded in the manifest that were not produced in this run
+    def prune(self):
+        for name in list(self.entries):
+            if name not in self.seen:
+                (self.folder / name).unlink(missing_ok=True)
+                del self.entries[name]
+
+    def save(self):
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.path.write_text(json.dumps(self.entries, indent=1, sort_keys=True))
+
+# Pack trials into one multi-page PDF, written one page at a time
+# Returns the output and the positions of the trials that failed (their pages are left out)
+def render_pdf(trials: list[dict], output: Path, preset: str | dict = 'publication'):
+    global worker_figure
+    preset = get_preset(preset)
+    if worker_figure is None:
+        worker_figure = TrialFigure()
+    failed = []
+    with PdfPages(output) as pdf:
+        for index, trial in enumerate(trials):
+            try:
+                worker_figure.update(trial)
+                pdf.savefig(worker_figure.figure, dpi=preset['dpi'])
+            except Exception as e:
+                print(f"Error processing trial {trial.get('trial')}: {e}")
+                failed.append(index)
+    return output, failed
+
+# Tile trials into a contact-sheet PNG (row by row, `columns` trials per row)
+# Tiles are at most `contact_tile_width` pixels wide; the figure dpi is restored afterwards
+# Returns the output (None if no trial could be drawn) and the positions of the trials that failed (left blank)
+def render_contact_sheet(trials: list[dict], output: Path, preset: str | dict = 'draft', columns: int = 4):
+    global worker_figure
+    preset = get_preset(preset)
+    if worker_figure is None:
+        worker_figure = TrialFigure()
+    figure = worker_figure.figure
+    figure_dpi = figure.get_dpi()
+    figure.set_dpi(min(preset['dpi'], contact_tile_width / figure.get_figwidth()))
+
+    sheet = None
+    failed = []
+    rows = int(np.ceil(len(trials) / columns))
+    try:
+        for index, trial in enumerate(trials):
+            try:
+                worker_figure.update(trial)
+                figure.canvas.draw()
+                tile = np.asarray(figure.canvas.buffer_rgba())
+            except Exception as e:
+                print(f"Error processing trial {trial.get('trial')}: {e}")
+                failed.append(index)
+                continue
+
+            # Allocate the sheet once the tile size is known (white background)
+            if sheet is None:
+                height, width = tile.shape[:2]
+                sheet = np.full((rows * height, columns * width, 4), 255, dtype=np.uint8)
+            row, column = divmod(index, columns)
+            sheet[row * height:(row + 1) * height, column * width:(column + 1) * width] = tile
+    finally:
+        figure.set_dpi(figure_dpi)
+
+    if sheet is None:
+        return None, failed
+    imsave(output, sheet)
+    return output, failed
+
+# Render a pack of trials into a single output file ('pdf' or 'contact' mode)
+# Returns the output and the positions of the trials that failed; the output is None if the whole pack failed
+def render_pack(trials: list[dict], output: Path, preset: str | dict, mode: str, columns: int = 4):
+    try:
+        if mode == 'pdf':
+            return render_pdf(trials, output, preset)
+        return render_contact_sheet(trials, output, preset, columns)
+    except Exception as e:
+        print(f"Error rendering {output}: {e}")
+        return None, list(range(len(trials)))
+
+# Split trials into packs written to one file each
+# 'pdf' packs all trials of a mouse into one multi-page PDF, 'contact' tiles rows x columns trials per PNG
+def pack_trials(trials: list[dict], output_dir: Path, mode: str, columns: int = 4, rows: int = 4):
+    if mode == 'pdf':
+        return [(trials, output_dir / 'trials.pdf')]
+    size = columns * rows
+    return [(trials[i:i + size], output_dir / f'contact_sheet{i // size + 1}.png') for i in range(0, len(trials), size)]
+
+# Render only the trials whose inputs changed since the last run and prune stale plots
+# mode is 'files' (one file per trial), 'pdf' (one multi-page PDF) or 'contact' (tiled contact sheets with an index)
+def render_changed_trials(
+    trials: list[dict], 
+    output_dir: Path, 
+    preset: str | dict = 'publication', 
+    workers: int | None = None, 
+    mode: str = 'files', 
+    columns: int = 4, 
+    rows: int = 4
+):
+    preset = get_preset(preset)
+    manifest = RenderManifest(output_dir)
+
+    # Find trials (or packs of trials) whose input slice or style changed
+    if mode == 'files':
+        jobs = [([x], Path(x['output']).with_suffix(f".{preset['format']}")) for x in trials]
+    elif mode in ['pdf', 'contact']:
+        jobs = pack_trials(trials, Path(output_dir), mode, columns, rows)
+    else:
+        raise ValueError(f"Unknown output mode '{mode}'. Choose from ['files', 'pdf', 'contact'].")
+    pending = []
+    keys = []
+    for job_trials, output in jobs:
+        inputs = [{x: y for x, y in trial.items() if x not in ('output', 'trial')} for trial in job_trials]
+        key = input_hash(*inputs, preset=preset, mode=mode, columns=columns, rows=rows)
+        if not manifest.is_current(output, key):
+            pending.append((job_trials, output))
+            keys.append(key)
+
+    # Render changed trials (or packs) and record the successful ones
+    # A pack with a failed trial is not recorded (so it is rendered again next run) and is returned as None
+    failed = {}
+    if mode == 'files':
+        outputs = render_trials([x[0][0] for x in pending], preset, workers)
+    else:
+        if workers == 1 or len(pending) < 2:
+            results = [render_pack(x, y, preset, mode, columns) for x, y in pending]
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = [executor.submit(render_pack, x, y, preset, mode, columns) for x, y in pending]
+                results = [x.result() for x in futures]
+        failed = {output.name: set(positions) for (_, output), (_, positions) in zip(pending, results) if len(positions) > 0}
+        outputs = [None if len(positions) > 0 else output for output, positions in results]
+    for output, key in zip(outputs, keys):
+        if output is not None:
+            manifest.record(output, key)
+
+    # Index of which contact sheet and tile each trial is on (trials that failed to render are left out)
+    if mode == 'contact':
+        index_file = Path(output_dir) / 'contact_index.csv'
+        with open(index_file, 'w') as index:
+            index.write('Trial,Sheet,Row,Column\n')
+            for job_trials, output in jobs:
+                for i, trial in enumerate(job_trials):
+                    if i in failed.get(output.name, ()):
+                        continue
+                    row, column = divmod(i, columns)
+                    index.write(f"{trial.get('trial')},{output.name},{row + 1},{column + 1}\n")
+        manifest.record(index_file, input_hash([str(x[1]) for x in jobs], [len(x[0]) for x in jobs]))
+
+    manifest.prune()
+    manifest.save()
+    num_failed = sum(len(x) for x in failed.values()) if mode != 'files' else sum(x is None for x in outputs)
+    print(f"Rendered {sum(len(x[0]) for x in pending) - num_failed} of {len(trials)} trial plots in {output_dir}"
+          + (f" ({num_failed} failed)" if num_failed > 0 else ""))
+    return outputs
+
+# Compute per-trace maximum and per-sample mean/std of a (traces x samples) matrix in one pass
+# NaNs (e.g. the blank pre-trial samples of the first trial) are ignored
+def heatmap_stats(matrix: np.ndarray):
+    valid = np.isfinite(matrix)
+    values = np.where(valid, matrix, 0).astype(np.float64)
+    count = valid.sum(axis=0)
+    total = values.sum(axis=0)
+    squares = (values * values).sum(axis=0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = total / count
+        std = np.sqrt(np.maximum(squares - count * mean * mean, 0) / (count - 1))
+        trace_max = np.where(valid, matrix, -np.inf).max(axis=1)
+    trace_max[~np.isfinite(trace_max)] = np.nan
+    return trace_max.astype(np.float32), mean, std
+
+# Average groups of neighbouring samples, keeping at least `width` columns (e.g. the pixel width of the axes)
+# The matrix is returned unchanged unless at least two samples fall on each of the `width` columns
+def decimate_columns(matrix: np.ndarray, width: int | None):
+    if width is None or matrix.shape[1] < 2 * width:
+        return matrix
+    factor = matrix.shape[1] // width
+    padding = (-matrix.shape[1]) % factor
+    padded = np.pad(matrix, ((0, 0), (0, padding)), constant_values=np.nan)
+    with np.errstate(invalid='ignore'):
+        binned = padded.reshape(matrix.shape[0], -1, factor)
+        count = np.isfinite(binned).sum(axis=2)
+        return (np.nansum(binned, axis=2) / count).astype(matrix.dtype)
+
+# Draw a (traces x samples) matrix as a raster heatmap with imshow
+# Keeps sample-based x coordinates so ticks and markers match a cell-based heatmap
+def raster_heatmap(figure: Figure, ax, matrix: np.ndarray, label: str, cmap: str = 'cividis', width: int | None = None):
+    num_samples = matrix.shape[1]
+    image = ax.imshow(
+        decimate_columns(matrix, width), 
+        cmap=cmap, 
+        aspect='auto', 
+        interpolation='nearest', 
+        extent=(0, num_samples, matrix.shape[0], 0)
+    )
+    figure.colorbar(image, ax=ax, label=label)
+    ax.set_yticks([])
+    for spine in ax.spines.values():
+        spine.set_visible(False)
+    return image
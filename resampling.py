@@ -0,0 +1,92 @@
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+
+# Number of bootstrap and permutation replicates per comparison
+num_replicates = 10000
+
+# Seed of the replicate streams; results only depend on the seed and the data (not on the number of workers)
+seed = 12345
+
+# Confidence level of the bootstrap intervals
+confidence = 0.95
+
+# Maximum number of resampled values held at once (replicates x samples) by one block
+block_size = 2 ** 22
+
+# Split the replicates into fixed blocks, each drawn from its own child seed
+# The split only depends on the number of samples, so every worker count gives the same replicates
+def replicate_blocks(num_samples: int, num_replicates: int = num_replicates, seed: int = seed):
+    rows = max(block_size // max(num_samples, 1), 1)
+    counts = [min(rows, num_replicates - x) for x in range(0, num_replicates, rows)]
+    return list(zip(np.random.SeedSequence(seed).spawn(len(counts)), counts))
+
+# Bootstrap index matrices (replicates x samples) drawn with replacement
+def bootstrap_indices(rng: np.random.Generator, num_samples: int, count: int):
+    return rng.integers(0, num_samples, size=(count, num_samples))
+
+# Permutation index matrices (replicates x samples), one shuffle of all samples per row
+def permutation_indices(rng: np.random.Generator, num_samples: int, count: int):
+    return rng.permuted(np.broadcast_to(np.arange(num_samples), (count, num_samples)), axis=1)
+
+# Mean differences (a - b) of one block of bootstrap replicates, each group resampled on its own
+def bootstrap_block(a: np.ndarray, b: np.ndarray, seed_sequence: np.random.SeedSequence, count: int):
+    rng = np.random.default_rng(seed_sequence)
+    mean_a = a[bootstrap_indices(rng, a.shape[0], count)].mean(axis=1)
+    mean_b = b[bootstrap_indices(rng, b.shape[0], count)].mean(axis=1)
+    return mean_a - mean_b
+
+# Mean differences (a - b) of one block of permutation replicates (group labels shuffled over the pooled samples)
+def permutation_block(a: np.ndarray, b: np.ndarray, seed_sequence: np.random.SeedSequence, count: int):
+    rng = np.random.default_rng(seed_sequence)
+    pooled = np.concatenate([a, b])
+    sum_a = pooled[permutation_indices(rng, pooled.shape[0], count)[:, :a.shape[0]]].sum(axis=1)
+    return sum_a / a.shape[0] - (pooled.sum() - sum_a) / b.shape[0]
+
+# Run the replicate blocks of one comparison, in the executor if given
+def replicates(block: callable, a: np.ndarray, b: np.ndarray, executor: ProcessPoolExecutor | None = None,
+               num_replicates: int = num_replicates, seed: int = seed):
+    seeds, counts = zip(*replicate_blocks(a.shape[0] + b.shape[0], num_replicates, seed))
+    n = len(counts)
+    results = executor.map(block, [a] * n, [b] * n, seeds, counts) if executor is not None else map(block, [a] * n, [b] * n, seeds, counts)
+    return np.concatenate(list(results))
+
+# Compare the means of two groups of samples (NaNs are dropped)
+# Returns the group sizes and means, the mean difference (a - b) with its bootstrap percentile interval
+# and the two-sided permutation p-value of the difference
+def compare_groups(a: np.ndarray, b: np.ndarray, executor: ProcessPoolExecutor | None = None,
+                   num_replicates: int = num_replicates, seed: int = seed, confidence: float = confidence):
+    a = np.asarray(a, dtype=float)
+    b = np.asarray(b, dtype=float)
+    a = a[~np.isnan(a)]
+    b = b[~np.isnan(b)]
+    result = {'N (A)': a.shape[0], 'N (B)': b.shape[0], 'Mean (A)': np.nan, 'Mean (B)': np.nan,
+              'Difference': np.nan, 'CI Low': np.nan, 'CI High': np.nan, 'p-Value': np.nan}
+    if a.shape[0] == 0 or b.shape[0] == 0:
+        return result
+
+    difference = a.mean() - b.mean()
+    bootstrap = replicates(bootstrap_block, a, b, executor, num_replicates, seed)
+    permutation = replicates(permutation_block, a, b, executor, num_replicates, seed)
+    alpha = (1 - confidence) / 2
+    result.update({
+        'Mean (A)': a.mean(),
+        'Mean (B)': b.mean(),
+        'Difference': difference,
+        'CI Low': np.quantile(bootstrap, alpha),
+        'CI High': np.quantile(bootstrap, 1 - alpha),
+        # Relative tolerance so that replicates equal to the observed difference are not lost to rounding
+        'p-Value': ((np.abs(permutation) >= np.abs(difference) * (1 - 1e-9)).sum() + 1) / (permutation.shape[0] + 1),
+    })
+    return result
+
+# Compare the metric columns of a table between two groups of rows, one result row per metric
+# `labels` names the groups (A, B) in the output columns
+def compare_metrics(a: pd.DataFrame, b: pd.DataFrame, metrics: list[str], labels: tuple[str, str] = ('A', 'B'),
+                    executor: ProcessPoolExecutor | None = None, num_replicates: int = num_replicates, seed: int = seed):
+    rows = []
+    for metric in metrics:
+        result = compare_groups(a[metric].to_numpy(dtype=float), b[metric].to_numpy(dtype=float), executor, num_replicates, seed)
+        rows.append({'Metric': metric, **result})
+    names = {f'{x} ({y})': f'{x} ({label})' for x in ['N', 'Mean'] for y, label in zip('AB', labels)}
+    return pd.DataFrame(rows).rename(columns=names)
@@ -0,0 +1,169 @@
+from pathlib import Path
+import os
+import sqlite3
+import numpy as np
+import pandas as pd
+
+# Optional SQLite session database, filled in by each stage next to the Excel outputs
+# Set the OPERANT_SESSION_DB environment variable (or `pipeline.py --db`) to a file path to enable it
+database_file = os.environ.get('OPERANT_SESSION_DB')
+
+# Seconds to wait for another process to finish writing
+timeout = 60
+
+schema = '''
+CREATE TABLE IF NOT EXISTS sessions (
+    mouse TEXT NOT NULL, phase INTEGER NOT NULL, day TEXT NOT NULL, mode TEXT NOT NULL,
+    stat TEXT NOT NULL, value,
+    PRIMARY KEY (mouse, phase, day, mode, stat)
+);
+CREATE TABLE IF NOT EXISTS trials (
+    mouse TEXT NOT NULL, phase INTEGER NOT NULL, day TEXT NOT NULL, mode TEXT NOT NULL,
+    trial INTEGER NOT NULL, stat TEXT NOT NULL, value,
+    PRIMARY KEY (mouse, phase, day, mode, trial, stat)
+);
+CREATE TABLE IF NOT EXISTS bouts (
+    mouse TEXT NOT NULL, phase INTEGER NOT NULL, day TEXT NOT NULL, mode TEXT NOT NULL,
+    bout INTEGER NOT NULL, trial INTEGER, start REAL, end REAL, licks REAL,
+    rewarding INTEGER, highly_rewarding INTEGER, lick_efficiency REAL,
+    PRIMARY KEY (mouse, phase, day, mode, bout)
+);
+CREATE TABLE IF NOT EXISTS bout_metrics (
+    mouse TEXT NOT NULL, phase INTEGER NOT NULL, day TEXT NOT NULL,
+    bout INTEGER NOT NULL, trial INTEGER, auc REAL, slope REAL, exprate REAL, max_calcium REAL,
+    PRIMARY KEY (mouse, phase, day, bout)
+);
+CREATE TABLE IF NOT EXISTS events (
+    mouse TEXT NOT NULL, phase INTEGER NOT NULL, day TEXT NOT NULL,
+    time REAL NOT NULL, trial INTEGER, event TEXT NOT NULL, value
+);
+CREATE INDEX IF NOT EXISTS sessions_stat ON sessions (stat, phase, day);
+CREATE INDEX IF NOT EXISTS trials_session ON trials (mouse, phase, day, trial);
+CREATE INDEX IF NOT EXISTS trials_stat ON trials (stat, phase, day);
+CREATE INDEX IF NOT EXISTS bouts_session ON bouts (mouse, phase, day, trial);
+CREATE INDEX IF NOT EXISTS bout_metrics_session ON bout_metrics (mouse, phase, day, trial);
+CREATE INDEX IF NOT EXISTS events_session ON events (mouse, phase, day, trial);
+CREATE INDEX IF NOT EXISTS events_event ON events (event, phase, day);
+'''
+
+# Columns of the Bouts sheets stored in the bouts and bout_metrics tables
+bout_columns = {
+    'Trial Number': 'trial',
+    'Start': 'start',
+    'End': 'end',
+    '# of Licks': 'licks',
+    'Rewarding': 'rewarding',
+    'Highly Rewarding': 'highly_rewarding',
+    'Lick Efficiency': 'lick_efficiency',
+}
+metric_columns = {
+    'Trial Number': 'trial',
+    'AUC Metric': 'auc',
+    'Pre-Bout Calcium Slope': 'slope',
+    'Pre-Bout Calcium ExpRate': 'exprate',
+    'Max Calcium': 'max_calcium',
+}
+
+def enabled():
+    return database_file is not None
+
+# Open the database and create the tables if needed
+def connect(path: Path | str | None = None):
+    connection = sqlite3.connect(path or database_file, timeout=timeout)
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.executescript(schema)
+    return connection
+
+# Phase number and test day of a parsed log or stats workbook, e.g. 'stats/phase 3/phase 3 day5-reward.xlsx' -> (3, 'day5')
+def session_key(path: Path):
+    path = Path(path)
+    phase = int(path.parent.name.split()[-1])
+    day = path.stem.split('-')[0].split()[-1]
+    return phase, day
+
+# Convert a value to a type SQLite can store, with missing values as NULL
+def sql_value(x):
+    if x is None or x is pd.NA or (isinstance(x, float) and np.isnan(x)):
+        return None
+    if isinstance(x, np.generic):
+        return x.item()
+    return x
+
+# Replace the rows of one session in a table and insert new ones in a single transaction
+# With `append`, the new rows are added to the ones already stored (e.g. for a session processed in chunks)
+def replace_rows(table: str, key: dict, columns: list[str], rows: list[tuple], append: bool = False):
+    if not enabled():
+        return
+    condition = ' AND '.join(f'{x} = ?' for x in key)
+    names = list(key) + columns
+    with connect() as connection:
+        if not append:
+            connection.execute(f'DELETE FROM {table} WHERE {condition}', tuple(key.values()))
+        connection.executemany(
+            f'INSERT INTO {table} ({", ".join(names)}) VALUES ({", ".join("?" * len(names))})',
+            [tuple(key.values()) + tuple(sql_value(x) for x in row) for row in rows]
+        )
+    connection.close()
+
+# Store the events of a parsed log (one row per non-blank cell)
+def store_events(path: Path, mouse: str, columns: dict, append: bool = False):
+    if not enabled():
+        return
+    phase, day = session_key(path)
+    time = np.asarray(columns['Time'], dtype=float)
+    trial = columns.get('Trial Number')
+    rows = []
+    for event, values in columns.items():
+        if event in ['Time', 'Trial Number']:
+            continue
+        for i, x in enumerate(values):
+            if x is not None and x != '' and not (isinstance(x, float) and np.isnan(x)):
+                rows.append((time[i], trial[i] if trial is not None and trial[i] != '' else None, event, x))
+    replace_rows('events', {'mouse': mouse, 'phase': phase, 'day': day}, ['time', 'trial', 'event', 'value'], rows, append)
+
+# Store the Test Stats, Trial Stats and Bouts of one mouse
+def store_stats(path: Path, mouse: str, mode: str, aggregate_frame: pd.DataFrame, trial_frame: pd.DataFrame, bout_frame: pd.DataFrame):
+    if not enabled():
+        return
+    phase, day = session_key(path)
+    key = {'mouse': mouse, 'phase': phase, 'day': day, 'mode': mode}
+    replace_rows('sessions', key, ['stat', 'value'], list(aggregate_frame.iloc[:, 0].items()))
+    trial_rows = [
+        (int(trial.split()[-1]), stat, value)
+        for trial, row in trial_frame.iterrows()
+        for stat, value in row.items()
+    ]
+    replace_rows('trials', key, ['trial', 'stat', 'value'], trial_rows)
+    bouts = bout_frame[list(bout_columns)].itertuples(index=False)
+    replace_rows('bouts', key, ['bout'] + list(bout_columns.values()), [(i + 1,) + tuple(x) for i, x in enumerate(bouts)])
+
+# Store the calcium metrics of the bouts of one mouse
+def store_bout_metrics(path: Path, mouse: str, bout_frame: pd.DataFrame):
+    if not enabled():
+        return
+    phase, day = session_key(path)
+    key = {'mouse': mouse, 'phase': phase, 'day': day}
+    metrics = bout_frame.reindex(columns=list(metric_columns)).itertuples(index=False)
+    replace_rows('bout_metrics', key, ['bout'] + list(metric_columns.values()), [(i + 1,) + tuple(x) for i, x in enumerate(metrics)])
+
+# Run a query on the session database and return the result as a DataFrame
+def query(sql: str, params: tuple | dict = (), path: Path | str | None = None):
+    with connect(path) as connection:
+        result = pd.read_sql_query(sql, connection, params=params)
+    connection.close()
+    return result
+
+# Table of one session statistic with one row per mouse and one column per day, e.g.
+# stat_table('Latency to First Lick (ms)', phase=3) for the latency of all phase 3 mice on every day
+def stat_table(stat: str, phase: int | None = None, day: str | None = None, mode: str = 'reward', path: Path | str | None = None):
+    sql = 'SELECT mouse, phase, day, value FROM sessions WHERE stat = ? AND mode = ?'
+    params = [stat, mode]
+    if phase is not None:
+        sql += ' AND phase = ?'
+        params.append(phase)
+    if day is not None:
+        sql += ' AND day = ?'
+        params.append(day)
+    result = query(sql, tuple(params), path)
+    result['value'] = pd.to_numeric(result['value'], errors='coerce')
+    return result.pivot_table(index=['phase', 'mouse'], columns='day', values='value', aggfunc='first')
@@ -0,0 +1,97 @@
+import numpy as np
+import pytest
+
+import binary_log
+from arduino_log_parse import LogParser
+from binary_log import event_codes, encode, event_table, read_records, record_size, text_lines
+
+# Synthetic phase 3 session: (event, ms, trial, port, value), in the order the sketch logs them
+# Several events share a time stamp (one output row), and lick bouts are logged both on the row of
+# their last lick and after a later event (then the count goes to the row before)
+session = [
+    ('session', 1000, 0, 0, 0),
+    ('sync', 1000, 0, 0, 0),
+    ('trial', 2000, 1, 1, 0),
+    ('cueOn', 2000, 0, 1, 0),
+    ('force', 2100, 0, 0, 1.25),
+    ('force', 2150, 0, 0, 3.5),
+    ('levPress', 2150, 0, 0, 0),
+    ('cueOff', 2200, 0, 1, 0),
+    ('servo', 2200, 1, 1, 0),
+    ('lick', 2500, 1, 1, 0),
+    ('reward', 2500, 1, 1, 0),
+    ('lick', 2650, 1, 1, 0),
+    ('lick', 2800, 1, 1, 0),
+    ('bout', 2800, 3, 0, 0),
+    ('iti', 3000, 1, 1, 4000),
+    ('sync', 3500, 0, 0, 0),
+    ('trial', 7000, 2, 2, 0),
+    ('cueOn', 7000, 0, 2, 0),
+    ('lick', 7400, 2, 2, 0),
+    ('lick', 7550, 2, 2, 0),
+    ('sync', 7600, 0, 0, 0),
+    ('bout', 7600, 2, 0, 0),
+    ('cueOff', 7700, 0, 2, 0),
+    ('end', 8000, 2, 0, 0),
+]
+
+def session_records():
+    name, ms, trial, port, value = zip(*session)
+    code = np.array([event_codes[x] for x in name])
+    return read_records(encode(code, np.array(ms), np.array(trial), np.array(port), np.array(value)))
+
+# Columns of the text parser on the same events printed as text lines
+def text_table(records: np.ndarray, path):
+    parser = LogParser(path)
+    parser.feed(text_lines(records))
+    return parser.finish()
+
+def assert_same_table(binary: dict, text: dict):
+    assert list(binary) == list(text)
+    np.testing.assert_array_equal(np.asarray(binary['Time'], dtype=float), text['Time'])
+    for key in binary:
+        if key != 'Time':
+            assert list(binary[key]) == list(text[key]), key
+
+@pytest.mark.parametrize('phase', ['phase 1', 'phase 3'])
+def test_round_trip_matches_text_parser(phase: str, tmp_path):
+    records = session_records()
+    assert records.shape[0] == len(session)
+    path = tmp_path / 'original_data' / phase / 'day1.xlsx'
+    table = event_table(records, text_table(records, path).keys())
+    assert_same_table(table, text_table(records, path))
+
+def test_lick_bout_counts():
+    table = event_table(session_records())
+    licks = dict(zip(np.round(table['Time'] * 1000).astype(int) + 1000, table['# of Licks']))
+    # The first bout ends on a lick row; the second is logged after a sync on a new row and updates the lick before it
+    assert licks[2800] == 3
+    assert licks[7550] == 2
+    assert licks[2500] == 1 and licks[2650] == 1 and licks[7400] == 1
+    assert licks[7600] == ''
+
+def test_resync_after_text_and_corrupted_bytes(capsys):
+    data = encode(np.array([event_codes[x[0]] for x in session]), np.array([x[1] for x in session]))
+    records = read_records(data)
+    header = b'phase 3\r\nbinaryLog=1\r\n'
+    garbage = bytes([binary_log.sync_byte, 0xFF, 0x00, binary_log.sync_byte, event_codes['lick']])
+    middle = 10 * record_size
+    stream = header + data[:middle] + garbage + data[middle:] + data[:5]
+    decoded = read_records(stream)
+    np.testing.assert_array_equal(decoded, records)
+    assert f'Skipped {len(header) + len(garbage) + 5} bytes' in capsys.readouterr().out
+
+def test_checksum_rejects_corrupted_record(capsys):
+    data = bytearray(encode(np.array([event_codes['lick']] * 5), np.arange(5) * 100, 1, 2))
+    raw = np.frombuffer(bytes(data), dtype=np.uint8).reshape(-1, record_size)
+    assert (binary_log.checksum(raw) == raw[:, :-1].astype(int).sum(axis=1) % 256).all()
+    assert (raw[:, -1] == binary_log.checksum(raw)).all()
+
+    # Flip one bit in the time stamp of the third record: the record is dropped, its neighbours are kept
+    data[2 * record_size + 4] ^= 0x01
+    decoded = read_records(bytes(data))
+    np.testing.assert_array_equal(decoded['ms'], [0, 100, 300, 400])
+    assert f'Skipped {record_size} bytes' in capsys.readouterr().out
+
+def test_short_buffer():
+    assert read_records(b'\xa5\x01').shape[0] == 0
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from calcium_utils import GroupedAccumulator
+
+# Trace sampled at `sr` Hz for `duration` seconds, starting at `start` (trial times are absolute session times)
+def trace(rng: np.random.Generator, duration: float, start: float = 100.0, sr: float = 100.0):
+    time = start + np.arange(int(round(duration * sr)) + 1) / sr
+    return time, rng.normal(size=time.shape[0])
+
+# Mean and SEM of traces truncated to the shortest one (the behaviour of the original per-split averages)
+def truncated_average(traces: list):
+    length = min(x[1].shape[0] for x in traces)
+    values = np.array([x[1][:length] for x in traces])
+    return values.mean(axis=0), values.std(axis=0, ddof=1) / np.sqrt(values.shape[0])
+
+@pytest.mark.parametrize('reverse', [False, True])
+def test_groups_with_different_lengths(reverse: bool):
+    rng = np.random.default_rng(0)
+    groups = {
+        ('phase 1', 'rewarding'): [trace(rng, 20), trace(rng, 19.5), trace(rng, 20.2)],
+        ('phase 3', 'rewarding'): [trace(rng, 10), trace(rng, 10.3)],
+        ('phase 3', 'nonrewarding'): [trace(rng, 12), trace(rng, 15)],
+    }
+    accumulator = GroupedAccumulator()
+    for key in reversed(list(groups)) if reverse else groups:
+        for time, values in groups[key]:
+            accumulator.add(key, time, values)
+
+    results = accumulator.results()
+    for key, traces in groups.items():
+        grid, mean, sem = results[key]
+        expected_mean, expected_sem = truncated_average(traces)
+        assert grid.shape[0] == expected_mean.shape[0]
+        np.testing.assert_allclose(grid, np.arange(grid.shape[0]) / 100, atol=1e-9)
+        np.testing.assert_allclose(mean, expected_mean, rtol=1e-9, atol=1e-12)
+        np.testing.assert_allclose(sem, expected_sem, rtol=1e-9, atol=1e-12)
+
+def test_grid_extended_by_longer_trace():
+    rng = np.random.default_rng(1)
+    short, long = trace(rng, 5), trace(rng, 8)
+    accumulator = GroupedAccumulator()
+    accumulator.add(('rewarding',), *short)
+    accumulator.add(('rewarding',), *long)
+
+    grid, mean, _ = accumulator.results(complete=False)[('rewarding',)]
+    assert grid.shape[0] == long[0].shape[0]
+    np.testing.assert_allclose(mean[501:], long[1][501:])
+    np.testing.assert_allclose(mean[:501], (short[1] + long[1][:501]) / 2)
+
+    grid, _, _ = accumulator.results()[('rewarding',)]
+    assert grid.shape[0] == short[0].shape[0]
+
+def test_shared_grid():
+    rng = np.random.default_rng(2)
+    grid = np.arange(0, 3.005, 0.01)
+    accumulator = GroupedAccumulator(grid)
+    accumulator.add(('a',), *trace(rng, 10))
+    accumulator.add(('b',), *trace(rng, 2))
+    results = accumulator.results(complete=False)
+    assert results[('a',)][0].shape[0] == grid.shape[0]
+    assert results[('b',)][0].shape[0] == 201
@@ -0,0 +1,76 @@
+import warnings
+
+import numpy as np
+import pytest
+from scipy.optimize import OptimizeWarning, curve_fit
+
+from calcium_utils import exp_curve, fit_exp_batch, pad_windows
+
+# Synthetic pre-bout windows (0.5 s) of A*exp(B*t) + C plus noise; returns the windows and the true rates
+def windows(rng: np.random.Generator, n: int, noise: float, rates: tuple[float, float], amplitudes: tuple[float, float]):
+    times, values, rate = [], [], []
+    for _ in range(n):
+        t = np.sort(rng.uniform(0, 0.5, rng.integers(8, 40)))
+        t -= t[0]
+        A = rng.choice([-1, 1]) * rng.uniform(*amplitudes)
+        B = rng.choice([-1, 1]) * rng.uniform(*rates)
+        times.append(t)
+        values.append(exp_curve(t, A, B, rng.normal()) + rng.normal(scale=noise, size=t.shape[0]))
+        rate.append(B)
+    return times, values, np.array(rate)
+
+# Sum of squared residuals of each window under the given parameters (NaN parameters give NaN)
+def residuals(times: list, values: list, params: np.ndarray):
+    return np.array([((y - exp_curve(t, *p)) ** 2).sum() for t, y, p in zip(times, values, params)])
+
+# Per-window scipy fit from curve_fit's default starting point, as in the original per-bout code (NaN where it fails)
+def curve_fit_params(times: list, values: list):
+    params = []
+    for t, y in zip(times, values):
+        try:
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', (OptimizeWarning, RuntimeWarning))
+                params.append(curve_fit(exp_curve, t, y, maxfev=10000)[0])
+        except RuntimeError:
+            params.append(np.full(3, np.nan))
+    return np.array(params)
+
+def batch_params(times: list, values: list):
+    t, mask = pad_windows(times)
+    y, _ = pad_windows(values)
+    return fit_exp_batch(t, y, mask)
+
+# Clear exponentials with little noise: the batch fit finds the least-squares rate, and matches curve_fit
+# wherever curve_fit reaches the same minimum (from (1, 1, 1) it often stops in a worse one)
+@pytest.mark.parametrize('seed', range(3))
+def test_well_conditioned_windows(seed: int):
+    times, values, rate = windows(np.random.default_rng(seed), 100, 1e-3, (2, 8), (0.5, 2))
+    batch, scipy_fit = batch_params(times, values), curve_fit_params(times, values)
+    assert np.isfinite(batch).all()
+    np.testing.assert_allclose(batch[:, 1], rate, rtol=0.05)
+
+    batch_cost, scipy_cost = residuals(times, values, batch), residuals(times, values, scipy_fit)
+    found = np.isfinite(scipy_cost)
+    assert (batch_cost[found] <= scipy_cost[found] * (1 + 1e-6)).all()
+    same = found & (scipy_cost <= batch_cost * (1 + 1e-6))
+    assert same.sum() >= 20
+    np.testing.assert_allclose(batch[same], scipy_fit[same], rtol=1e-5, atol=1e-8)
+
+# Noisy, nearly linear windows: the rate is poorly determined, so only the residual is compared
+# Every window curve_fit fits is fitted too, with a residual at most 1% above curve_fit's
+@pytest.mark.parametrize('seed', range(3))
+def test_poorly_conditioned_windows(seed: int):
+    times, values, _ = windows(np.random.default_rng(seed), 100, 0.2, (0, 3), (0, 2))
+    batch, scipy_fit = batch_params(times, values), curve_fit_params(times, values)
+    found = np.isfinite(scipy_fit).all(axis=1)
+    assert np.isfinite(batch[found]).all()
+
+    batch_cost, scipy_cost = residuals(times, values, batch), residuals(times, values, scipy_fit)
+    assert (batch_cost[found] <= scipy_cost[found] * 1.01).all()
+
+def test_unusable_windows():
+    times = [np.array([0.0, 0.1]), np.array([0.0, 0.1, 0.2, 0.3]), np.array([0.0, 0.1, 0.2, 0.3])]
+    values = [np.array([1.0, 2.0]), np.array([1.0, np.nan, 2.0, 3.0]), exp_curve(times[2], 1.0, -3.0, 0.5)]
+    params = batch_params(times, values)
+    assert np.isnan(params[:2]).all()
+    np.testing.assert_allclose(params[2], [1.0, -3.0, 0.5], rtol=1e-6)
@@ -0,0 +1,39 @@
+import os
+import time
+
+import work_queue
+from work_queue import claim, holds, release, remove_lock
+
+def lock(queue, id: str = 'unit'):
+    return queue / 'claims' / f'{id}.lock'
+
+def make_stale(path, seconds: float = 2 * work_queue.lease):
+    past = time.time() - seconds
+    os.utime(path, (past, past))
+
+def test_claim_is_exclusive(tmp_path):
+    (tmp_path / 'claims').mkdir()
+    token = claim(tmp_path, 'unit')
+    assert token is not None and holds(lock(tmp_path), token)
+    assert claim(tmp_path, 'unit') is None
+
+def test_slow_owner_keeps_the_new_claim(tmp_path):
+    (tmp_path / 'claims').mkdir()
+    old = claim(tmp_path, 'unit')
+    make_stale(lock(tmp_path))
+    new = claim(tmp_path, 'unit')
+    assert new is not None and new != old
+
+    # The first owner finishes late: its release must not remove the claim that took over
+    release(lock(tmp_path), old)
+    assert holds(lock(tmp_path), new)
+    release(lock(tmp_path), new)
+    assert not lock(tmp_path).exists()
+    assert os.listdir(tmp_path / 'claims') == []
+
+def test_lock_that_changed_is_put_back(tmp_path):
+    (tmp_path / 'claims').mkdir()
+    token = claim(tmp_path, 'unit')
+    assert not remove_lock(lock(tmp_path), lambda text, mtime: False)
+    assert holds(lock(tmp_path), token)
+    assert os.listdir(tmp_path / 'claims') == ['unit.lock']
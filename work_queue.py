@@ -0,0 +1,371 @@
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import argparse
+import hashlib
+import json
+import os
+import re
+import socket
+import threading
+import time
+import uuid
+
+# File-based work queue for running the parse, stats and synchronization units on several hosts that share a folder (e.g. NFS)
+# Every host runs from the same working directory (the one holding original_data/, parsed_data/, ...), so unit paths are shared.
+# Claims are lock files created with O_CREAT | O_EXCL and results are committed by atomic renames, which NFS supports;
+# no server or database is needed (SQLite's WAL mode does not work on network file systems)
+queue_dir = Path('queue')
+
+# Stages that can be queued
+queue_stages = ['parse', 'stats', 'sync']
+
+# Seconds after which a claim that is no longer renewed is considered abandoned (e.g. a crashed host) and can be taken over
+lease = 900
+
+# Seconds between claim renewals while a unit runs
+heartbeat = 60
+
+# Seconds between polls while the remaining units are claimed by other workers or wait for their dependencies
+poll = 10
+
+# Queue subfolders: unit descriptions, claims, committed and failed units, per-unit outputs merged afterwards
+subfolders = ['units', 'claims', 'done', 'failed', 'outputs']
+
+# File-safe unique ID of a unit name, e.g. 'sync:3/phase 3 day5/M1' -> 'sync_3_phase_3_day5_M1-1a2b3c4d'
+def unit_id(name: str):
+    slug = re.sub(r'[^\w.-]+', '_', name).strip('_')
+    return f"{slug}-{hashlib.sha1(name.encode()).hexdigest()[:8]}"
+
+# Write a file atomically: readers on any host see either the old or the complete new file
+def write_atomic(path: Path, text: str):
+    temp = path.with_name(f'.{path.name}.{uuid.uuid4().hex}.tmp')
+    with open(temp, 'w') as file:
+        file.write(text)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temp, path)
+
+# IDs of the units with a marker file in a queue subfolder
+def markers(queue: Path, folder: str):
+    return {x[:-len('.json')] for x in os.listdir(queue / folder) if x.endswith('.json')}
+
+# Stage functions (the same as the pipeline's, except that the synchronization writes its Arduino sheet to a per-unit file)
+def run_parse(source: str, chunk_rows: int | None = None):
+    from pipeline import run_parse
+    run_parse(Path(source), chunk_rows)
+
+def run_stats(arduino_file: str, phase: str, chunk_rows: int | None = None):
+    from pipeline import run_stats
+    run_stats(Path(arduino_file), phase, chunk_rows)
+
+# A unit is only committed once its output exists, so merge never drops the sheet of a failed synchronization
+def run_sync(arduino_file: str, sheet: str, calcium_csv: str, chunk_rows: int | None, output: str):
+    from calcium_data_synchronize import main
+    Path(output).unlink(missing_ok=True)
+    main(Path(arduino_file), sheet, Path(calcium_csv), chunk_rows, Path(output), raise_errors=True)
+    if not Path(output).exists():
+        raise FileNotFoundError(f"Synchronization of {sheet} wrote no output '{output}'")
+
+unit_functions = {'parse': run_parse, 'stats': run_stats, 'sync': run_sync}
+
+# Enumerate the units of the selected stages as {name: unit}, in pipeline order
+# Each unit lists the units it depends on; dependencies on deselected stages are assumed to be satisfied
+def enumerate_units(queue: Path, selected: list[str], chunk_rows: int | None = None):
+    from pipeline import find_units, arduino_dir, calcium_csv_dir
+
+    units = {}
+    def add(name: str, stage: str, args: list, deps: list[str] = (), **extra):
+        if stage in selected:
+            units[name] = {'name': name, 'stage': stage, 'args': args, 'deps': list(deps), **extra}
+
+    last_sync = {}
+    for phase, source, mice in find_units('parse' in selected):
+        day_key = f'{phase}/{source.stem}'
+        arduino_file = arduino_dir / f'phase {phase}' / f'{source.stem}.xlsx'
+        add(f'parse:{day_key}', 'parse', [str(source), chunk_rows])
+        add(f'stats:{day_key}', 'stats', [str(arduino_file), phase, chunk_rows], [f'parse:{day_key}'])
+
+        # The synchronization no longer rewrites the parsed log, so it only waits for the parser;
+        # units writing the same calcium workbook (a mouse recorded on several days) run one after the other
+        for sheet in mice:
+            calcium_csv = calcium_csv_dir / f'phase {phase}' / f'{sheet}.csv'
+            if not calcium_csv.exists():
+                continue
+            name = f'sync:{day_key}/{sheet}'
+            calcium_file = arduino_dir / f'phase {phase}' / f'{sheet}.xlsx'
+            output = queue / 'outputs' / f'{unit_id(name)}.xlsx'
+            deps = [f'parse:{day_key}'] + ([last_sync[calcium_file]] if calcium_file in last_sync else [])
+            add(name, 'sync', [str(arduino_file), sheet, str(calcium_csv), chunk_rows, str(output)], deps)
+            last_sync[calcium_file] = name
+
+    # Dependencies by unit ID
+    for unit in units.values():
+        unit['deps'] = [unit_id(x) for x in unit['deps'] if x in units]
+    return units
+
+# Write the units to the queue
+# Re-initializing is idempotent: committed units stay done unless their description changed or their output is gone,
+# failed units are retried
+def init(queue: Path, selected: list[str], chunk_rows: int | None = None):
+    for folder in subfolders:
+        (queue / folder).mkdir(parents=True, exist_ok=True)
+    units = enumerate_units(queue, selected, chunk_rows)
+    for order, unit in enumerate(units.values()):
+        unit['order'] = order
+        path = queue / 'units' / f'{unit_id(unit["name"])}.json'
+        text = json.dumps(unit, indent=1)
+        changed = path.exists() and path.read_text() != text
+        if changed or (unit['stage'] == 'sync' and not Path(unit['args'][-1]).exists()):
+            (queue / 'done' / path.name).unlink(missing_ok=True)
+        (queue / 'failed' / path.name).unlink(missing_ok=True)
+        write_atomic(path, text)
+    print(f"Queued {len(units)} units in {queue}")
+    return units
+
+# Units of the queue as {unit ID: unit}, in pipeline order
+def load_units(queue: Path):
+    units = {}
+    for path in (queue / 'units').glob('*.json'):
+        units[path.stem] = json.loads(path.read_text())
+    return dict(sorted(units.items(), key=lambda x: x[1]['order']))
+
+# Units that can never run because a unit they depend on (directly or not) failed
+def blocked_units(units: dict, failed: set):
+    blocked = set()
+    changed = True
+    while changed:
+        changed = False
+        for id, unit in units.items():
+            if id not in blocked and any(x in failed or x in blocked for x in unit['deps']):
+                blocked.add(id)
+                changed = True
+    return blocked
+
+# Move a lock file aside and delete it if `check(text, mtime)` still holds for it, otherwise put it back
+# Only one worker can move a given lock file, so a lock created in the meantime by another worker is never lost
+# Returns whether the lock was deleted
+def remove_lock(path: Path, check):
+    aside = path.with_name(f'{path.name}.{uuid.uuid4().hex}.aside')
+    try:
+        os.rename(path, aside)
+    except FileNotFoundError:
+        return False
+    if check(aside.read_text(), aside.stat().st_mtime):
+        aside.unlink()
+        return True
+    try:
+        os.link(aside, path)
+    except FileExistsError:
+        print(f"WARNING: Claim {path.name} was replaced while it was checked")
+    aside.unlink()
+    return False
+
+# Owner token stored in a lock file's text (None for a lock that is not completely written)
+def lock_token(text: str):
+    try:
+        return json.loads(text).get('token')
+    except ValueError:
+        return None
+
+# Whether a lock file still holds the claim with this owner token
+def holds(path: Path, token: str):
+    try:
+        return lock_token(path.read_text()) == token
+    except OSError:
+        return False
+
+# Claim a unit by creating its lock file, which holds a unique owner token; returns the token, or None if the unit is held
+# An abandoned claim (not renewed within `lease` seconds) is taken over, but only if the lock is still the one found stale:
+# of several workers racing for it, only the first removes it and the others find its new claim
+def claim(queue: Path, id: str, lease: float = lease):
+    path = queue / 'claims' / f'{id}.lock'
+    token = uuid.uuid4().hex
+    owner = json.dumps({'host': socket.gethostname(), 'pid': os.getpid(), 'claimed': time.time(), 'token': token})
+    for attempt in range(2):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                text, mtime = path.read_text(), path.stat().st_mtime
+            except FileNotFoundError:
+                continue
+            if attempt > 0 or time.time() - mtime <= lease:
+                return None
+            if remove_lock(path, lambda x, y: x == text and y == mtime):
+                print(f"Taking over abandoned claim of {id}")
+            continue
+        with os.fdopen(fd, 'w') as file:
+            file.write(owner)
+        return token
+    return None
+
+# Release a claim, unless it was taken over by another worker
+def release(path: Path, token: str):
+    remove_lock(path, lambda text, mtime: lock_token(text) == token)
+
+# Renew a claim every `heartbeat` seconds until `stop` is set, as long as it still holds this owner's token
+def renew(path: Path, token: str, stop: threading.Event, heartbeat: float = heartbeat):
+    while not stop.wait(heartbeat):
+        if not holds(path, token):
+            print(f"WARNING: Claim {path.name} was taken over by another worker")
+            return
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+
+# Run a claimed unit and commit its result (done or failed marker), then release the claim
+def run_unit(queue: Path, id: str, unit: dict, token: str):
+    claim_path = queue / 'claims' / f'{id}.lock'
+    stop = threading.Event()
+    renewer = threading.Thread(target=renew, args=(claim_path, token, stop), daemon=True)
+    renewer.start()
+    started = time.time()
+    record = {'name': unit['name'], 'host': socket.gethostname(), 'pid': os.getpid(), 'started': started}
+    try:
+        print(f"Running {unit['name']}")
+        unit_functions[unit['stage']](*unit['args'])
+        record['seconds'] = time.time() - started
+        write_atomic(queue / 'done' / f'{id}.json', json.dumps(record))
+        print(f"Finished {unit['name']}")
+    except Exception as e:
+        record['error'] = str(e)
+        write_atomic(queue / 'failed' / f'{id}.json', json.dumps(record))
+        print(f"Error in {unit['name']}: {e}")
+    finally:
+        stop.set()
+        renewer.join()
+        release(claim_path, token)
+
+        # Each worker process has its own sheet cache, emptied after every unit (see excel_utils.cache_bytes)
+        from excel_utils import clear_sheets
+        clear_sheets()
+
+# Claim and run units until none is left (done, failed or blocked by a failure)
+# Returns the number of units this worker ran
+def work(queue: Path, poll: float = poll):
+    units = load_units(queue)
+    count = 0
+    while True:
+        done = markers(queue, 'done')
+        failed = markers(queue, 'failed')
+        finished = done | failed | blocked_units(units, failed)
+        remaining = [x for x in units if x not in finished]
+        if len(remaining) == 0:
+            return count
+
+        # First ready unit that no other worker holds (committed units are checked again once claimed)
+        claimed = None
+        for id in remaining:
+            token = claim(queue, id) if all(x in done for x in units[id]['deps']) else None
+            if token is not None:
+                if (queue / 'done' / f'{id}.json').exists():
+                    release(queue / 'claims' / f'{id}.lock', token)
+                    continue
+                claimed = id
+                break
+        if claimed is None:
+            time.sleep(poll)
+            continue
+        run_unit(queue, claimed, units[claimed], token)
+        count += 1
+
+# Run `workers` worker processes on this host
+def work_all(queue: Path, workers: int | None = None, poll: float = poll):
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        counts = list(executor.map(work, [queue] * workers, [poll] * workers))
+    print(f"{sum(counts)} units run on {socket.gethostname()}")
+
+# Counts of the queue's units by state
+def status(queue: Path):
+    units = load_units(queue)
+    done = markers(queue, 'done')
+    failed = markers(queue, 'failed')
+    claimed = {x[:-len('.lock')] for x in os.listdir(queue / 'claims') if x.endswith('.lock')}
+    blocked = blocked_units(units, failed)
+    counts = {
+        'done': len(done & units.keys()),
+        'failed': len(failed & units.keys()),
+        'running': len((claimed & units.keys()) - done - failed),
+        'blocked': len(blocked - done),
+    }
+    counts['pending'] = len(units) - sum(counts.values())
+    for id in sorted(failed & units.keys()):
+        print(f"Failed: {units[id]['name']}: {json.loads((queue / 'failed' / f'{id}.json').read_text()).get('error')}")
+    print(', '.join(f'{y} {x}' for x, y in counts.items()))
+    return counts
+
+# Copy the sheet of a per-unit output into a workbook being rewritten by replace_sheets, one block of rows at a time
+def copy_sheet(source: Path):
+    from excel_utils import StreamingWorkbook, sheet_chunks
+
+    def write(workbook: StreamingWorkbook, name: str):
+        writer = None
+        for header, rows in sheet_chunks(source, name):
+            time_column = header.index('Time')
+            names = [x for x in header if x != 'Time']
+            if writer is None:
+                writer = workbook.open_sheet(name, names, 'Time', index=True)
+            columns = {x: [row[i] for row in rows] for i, x in enumerate(header) if x != 'Time'}
+            writer.write_columns(columns, [row[time_column] for row in rows])
+    return write
+
+# Merge the per-unit outputs: the Arduino sheets with the Calcium column written by the synchronization units
+# replace the sheets of each parsed log at once. Merging again gives the same result
+def merge(queue: Path, force: bool = False):
+    from excel_utils import replace_sheets
+
+    units = load_units(queue)
+    done = markers(queue, 'done')
+
+    # A committed synchronization whose output is gone (e.g. a cleaned queue folder) is not done either
+    lost = [x for x in done & units.keys() if units[x]['stage'] == 'sync' and not Path(units[x]['args'][-1]).exists()]
+    for id in lost:
+        print(f"Output of {units[id]['name']} is missing; run init and the workers again")
+    done -= set(lost)
+
+    pending = [units[x]['name'] for x in units if x not in done]
+    if len(pending) > 0 and not force:
+        print(f"{len(pending)} units are not done yet (e.g. {pending[0]}); run the workers first or merge with --force")
+        return False
+
+    logs = {}
+    for id, unit in units.items():
+        if unit['stage'] == 'sync' and id in done:
+            arduino_file, sheet = unit['args'][:2]
+            logs.setdefault(arduino_file, {})[sheet] = copy_sheet(Path(unit['args'][-1]))
+    for arduino_file, sheets in logs.items():
+        replace_sheets(Path(arduino_file), sheets)
+        print(f"Merged {len(sheets)} synchronized sheets into {arduino_file}")
+    return True
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description='Run the parse, stats and synchronization units from a shared file-based queue.')
+    parser.add_argument('--queue', type=Path, default=queue_dir, help='shared queue folder')
+    commands = parser.add_subparsers(dest='command', required=True)
+    init_parser = commands.add_parser('init', help='enumerate the units into the queue')
+    init_parser.add_argument('--only', nargs='+', choices=queue_stages, default=queue_stages, help='queue only these stages')
+    init_parser.add_argument('--chunk-rows', type=int, help='process each session in blocks of this many rows')
+    work_parser = commands.add_parser('work', help='claim and run units until none is left')
+    work_parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes on this host')
+    work_parser.add_argument('--poll', type=float, default=poll, help='seconds between polls while waiting for other workers')
+    commands.add_parser('status', help='count the units by state')
+    merge_parser = commands.add_parser('merge', help='assemble the per-unit outputs once all units are done')
+    merge_parser.add_argument('--force', action='store_true', help='merge even if some units are not done')
+    args = parser.parse_args(argv)
+
+    if args.command == 'init':
+        init(args.queue, args.only, args.chunk_rows)
+    elif args.command == 'work':
+        work_all(args.queue, args.workers, args.poll)
+    elif args.command == 'status':
+        counts = status(args.queue)
+        if counts['failed'] > 0:
+            raise SystemExit(1)
+    elif args.command == 'merge':
+        if not merge(args.queue, args.force):
+            raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,242 @@
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+import argparse
+import os
+import numpy as np
+import pandas as pd
+
+from excel_utils import StreamingWorkbook
+
+# Two numbers differ when both their absolute and their relative error exceed these tolerances
+# (the relative error is taken against the larger of the two magnitudes)
+abs_tolerance = 1e-9
+rel_tolerance = 1e-6
+
+# Sheets whose first row is data rather than a header (the key/value Test Stats sheets of phase_stats.py)
+headerless_sheets = ['Test']
+
+# Columns of the reports
+summary_columns = ['File', 'Sheet', 'Column', 'Cells', 'Mismatches', 'Max Abs Error', 'Max Rel Error']
+missing_columns = ['File', 'Kind', 'Key', 'Only In']
+
+# Summary without rows (its columns keep the report layout when nothing was compared)
+def empty_summary():
+    return pd.DataFrame(columns=summary_columns)
+
+# Keys that tell repeated labels apart by their occurrence, as (label, occurrence) pairs
+# (e.g. the trial numbers of a Bouts sheet, which has one row per bout)
+def unique_keys(labels: list):
+    labels = pd.Series(list(labels), dtype=object)
+    occurrence = labels.groupby(labels, dropna=False, sort=False).cumcount()
+    return pd.MultiIndex.from_arrays([labels, occurrence])
+
+# Read every sheet of a workbook at once, as {sheet name: (frame, has header, index label)}
+# Rows are keyed by the first column and columns by the header, both as unique_keys
+def load_sheets(path: Path):
+    sheets = {}
+    for name, raw in pd.read_excel(path, sheet_name=None, header=None).items():
+        header = not any(x in name for x in headerless_sheets)
+        if raw.shape[1] == 0:
+            sheets[name] = (pd.DataFrame(index=unique_keys([]), columns=unique_keys([])), header, None)
+            continue
+        body = raw.iloc[1:] if header else raw
+        names = raw.iloc[0, 1:].tolist() if header else list(range(1, raw.shape[1]))
+        frame = pd.DataFrame(body.iloc[:, 1:].to_numpy(), columns=unique_keys(names), index=unique_keys(body.iloc[:, 0])).infer_objects()
+        index_label = raw.iloc[0, 0] if header else None
+        sheets[name] = (frame, header, None if pd.isna(index_label) else index_label)
+    return sheets
+
+# Values of a column as floats (booleans as 0/1), or None if it holds anything else than numbers and blanks
+def numeric(values: pd.Series):
+    if pd.api.types.is_bool_dtype(values) or pd.api.types.is_numeric_dtype(values):
+        return values.to_numpy(dtype=float)
+    converted = pd.to_numeric(values, errors='coerce')
+    if converted.notna().sum() != values.notna().sum():
+        return None
+    return converted.to_numpy(dtype=float)
+
+# Union of two keys in the order of the first, then the keys only found in the second
+def union_keys(a: pd.MultiIndex, b: pd.MultiIndex):
+    return a.append(b.difference(a, sort=False))
+
+# Compare two sheets aligned by row and column keys
+# Returns the difference frame (a - b for numbers, 'a != b' for other values that differ), one summary row per column
+# and the keys only found in one of the sheets as (kind, key, side) rows
+# With `fill_value`, blank or missing numbers count as that value (compare_modes.py treats them as 0)
+def compare_sheets(a: pd.DataFrame, b: pd.DataFrame, labels: tuple[str, str] = ('A', 'B'), fill_value: float | None = None,
+                   abs_tolerance: float = abs_tolerance, rel_tolerance: float = rel_tolerance):
+    missing = []
+    for kind, keys, other in [('Row', a.index, b.index), ('Column', a.columns, b.columns)]:
+        for x, side in [(keys.difference(other, sort=False), labels[0]), (other.difference(keys, sort=False), labels[1])]:
+            missing += [(kind, label if occurrence == 0 else f'{label} ({occurrence + 1})', side) for label, occurrence in x]
+
+    index = union_keys(a.index, b.index)
+    columns = union_keys(a.columns, b.columns)
+    a = a.reindex(index=index, columns=columns)
+    b = b.reindex(index=index, columns=columns)
+
+    # Numeric columns are compared together as 2D arrays
+    values = {x: (numeric(a[x]), numeric(b[x])) for x in columns}
+    numbers = [x for x, (u, v) in values.items() if u is not None and v is not None]
+    x = np.column_stack([values[c][0] for c in numbers]) if len(numbers) > 0 else np.zeros((len(index), 0))
+    y = np.column_stack([values[c][1] for c in numbers]) if len(numbers) > 0 else np.zeros((len(index), 0))
+    if fill_value is not None:
+        x = np.where(np.isnan(x), fill_value, x)
+        y = np.where(np.isnan(y), fill_value, y)
+    present = ~np.isnan(x) | ~np.isnan(y)
+    both = ~np.isnan(x) & ~np.isnan(y)
+    with np.errstate(invalid='ignore'):
+        error = np.abs(x - y)
+        scale = np.maximum(np.abs(x), np.abs(y))
+        relative = np.divide(error, scale, out=np.zeros_like(error), where=scale > 0)
+        mismatch = present & ~((x == y) | (both & ((error <= abs_tolerance) | (relative <= rel_tolerance))))
+    error[~both] = np.nan
+    relative[~both] = np.nan
+
+    diff = {}
+    summary = []
+    for i, column in enumerate(numbers):
+        diff[column] = x[:, i] - y[:, i]
+        summary.append({
+            'Column': column,
+            'Cells': int(present[:, i].sum()),
+            'Mismatches': int(mismatch[:, i].sum()),
+            'Max Abs Error': np.nanmax(error[:, i]) if both[:, i].any() else np.nan,
+            'Max Rel Error': np.nanmax(relative[:, i]) if both[:, i].any() else np.nan,
+        })
+
+    # Other columns are compared as values
+    for column in columns:
+        if column in diff:
+            continue
+        u, v = a[column], b[column]
+        equal = ((u == v) | (u.isna() & v.isna())).to_numpy(dtype=bool)
+        diff[column] = np.where(equal, None, u.astype(str) + ' != ' + v.astype(str))
+        summary.append({
+            'Column': column,
+            'Cells': int((u.notna() | v.notna()).sum()),
+            'Mismatches': int((~equal).sum()),
+            'Max Abs Error': np.nan,
+            'Max Rel Error': np.nan,
+        })
+
+    diff = pd.DataFrame({x: diff[x] for x in columns}, index=index.get_level_values(0))
+    diff.columns = columns.get_level_values(0)
+    summary = pd.DataFrame(summary, columns=['Column', 'Cells', 'Mismatches', 'Max Abs Error', 'Max Rel Error'])
+    summary['Column'] = [x[0] for x in summary['Column']]
+    return diff, summary, missing
+
+# Compare two workbooks sheet by sheet, each read once
+# Writes the difference of each common sheet to `output_file` (if given), with the layout of the compared sheets
+# Returns the summary (one row per sheet column) and the mismatched keys (sheets, rows and columns found on one side only)
+def diff_workbooks(a_file: Path, b_file: Path, output_file: Path | None = None, labels: tuple[str, str] = ('A', 'B'),
+                   fill_value: float | None = None, abs_tolerance: float = abs_tolerance, rel_tolerance: float = rel_tolerance):
+    a_sheets = load_sheets(a_file)
+    b_sheets = load_sheets(b_file)
+
+    summaries = []
+    missing = [('Sheet', x, labels[0]) for x in a_sheets if x not in b_sheets] + [('Sheet', x, labels[1]) for x in b_sheets if x not in a_sheets]
+    diffs = {}
+    for name, (a, header, index_label) in a_sheets.items():
+        if name not in b_sheets:
+            continue
+        diff, summary, sheet_missing = compare_sheets(a, b_sheets[name][0], labels, fill_value, abs_tolerance, rel_tolerance)
+        diff.index.name = index_label
+        diffs[name] = (diff, header)
+        summaries.append(summary.assign(Sheet=name))
+        missing += [(kind, f'{name}: {key}', side) for kind, key, side in sheet_missing]
+
+    # The whole comparison is done before the output is opened, so a failed comparison leaves no empty workbook behind
+    if output_file is not None:
+        with StreamingWorkbook(output_file) as workbook:
+            for name, (diff, header) in diffs.items():
+                workbook.write_frame(name, diff, header=header)
+
+    summary = pd.concat([empty_summary()] + summaries, ignore_index=True)
+    missing = pd.DataFrame(missing, columns=missing_columns[1:])
+    return summary[summary_columns[1:]], missing
+
+# Compare one pair of workbooks of two trees (run in the worker processes); the file name is added to both reports
+def diff_pair(relative: Path, a_dir: Path, b_dir: Path, diff_dir: Path | None, labels: tuple[str, str],
+              fill_value: float | None, abs_tolerance: float, rel_tolerance: float):
+    output_file = None
+    if diff_dir is not None:
+        output_file = diff_dir / relative.with_name(f'{relative.stem}-diff.xlsx')
+        output_file.parent.mkdir(parents=True, exist_ok=True)
+    try:
+        summary, missing = diff_workbooks(a_dir / relative, b_dir / relative, output_file, labels, fill_value, abs_tolerance, rel_tolerance)
+    except Exception as e:
+        # An unreadable workbook (e.g. left empty by a failed run) is reported instead of stopping the comparison
+        summary, missing = empty_summary(), pd.DataFrame([('Error', str(e), '')], columns=missing_columns[1:])
+    return summary.assign(File=str(relative))[summary_columns], missing.assign(File=str(relative))[missing_columns]
+
+# Workbooks of a tree by path relative to its root (temporary and lock files are skipped)
+def tree_files(root: Path):
+    return {x.relative_to(root) for x in root.rglob('*.xlsx') if not x.name.startswith(('.', '~$'))}
+
+# Compare every workbook of two trees (e.g. stats/ folders from before and after a change), in `workers` processes
+# The differences of each pair are written to `diff_dir` (if given), as <name>-diff.xlsx at the same relative path
+# Returns the summary and the mismatched keys (including the files found in one tree only) of all files
+def diff_trees(a_dir: Path, b_dir: Path, diff_dir: Path | None = None, labels: tuple[str, str] = ('A', 'B'), fill_value: float | None = None,
+               abs_tolerance: float = abs_tolerance, rel_tolerance: float = rel_tolerance, workers: int | None = None):
+    a_files = tree_files(a_dir)
+    b_files = tree_files(b_dir)
+    missing = [(str(x), 'File', str(x), labels[0]) for x in sorted(a_files - b_files)]
+    missing += [(str(x), 'File', str(x), labels[1]) for x in sorted(b_files - a_files)]
+    common = sorted(a_files & b_files)
+
+    n = len(common)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(diff_pair, common, [a_dir] * n, [b_dir] * n, [diff_dir] * n, [labels] * n,
+                                    [fill_value] * n, [abs_tolerance] * n, [rel_tolerance] * n))
+
+    summary = pd.concat([empty_summary()] + [x[0] for x in results], ignore_index=True)
+    missing = pd.concat([pd.DataFrame(missing, columns=missing_columns)] + [x[1] for x in results], ignore_index=True)
+    return summary[summary_columns], missing[missing_columns]
+
+# Print the columns and keys that differ and write both reports to `output_file` (if given)
+# Returns whether everything matched within the tolerances
+def report(summary: pd.DataFrame, missing: pd.DataFrame, output_file: Path | None = None):
+    if output_file is not None:
+        with StreamingWorkbook(output_file) as workbook:
+            workbook.write_frame('Summary', summary, index=False)
+            workbook.write_frame('Mismatched Keys', missing, index=False)
+
+    differ = summary[summary['Mismatches'] > 0]
+    with pd.option_context('display.max_rows', None, 'display.width', 200):
+        if len(differ) > 0:
+            print(differ.to_string(index=False))
+        if len(missing) > 0:
+            print(missing.to_string(index=False))
+    print(f"{len(differ)} of {len(summary)} columns differ, {len(missing)} mismatched keys")
+    return len(differ) == 0 and len(missing) == 0
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(description='Compare two workbooks or two trees of workbooks (e.g. stats/ before and after a change).')
+    parser.add_argument('a', type=Path, help='reference workbook or folder')
+    parser.add_argument('b', type=Path, help='workbook or folder to compare with the reference')
+    parser.add_argument('--abs-tol', type=float, default=abs_tolerance, help='absolute tolerance of numbers')
+    parser.add_argument('--rel-tol', type=float, default=rel_tolerance, help='relative tolerance of numbers')
+    parser.add_argument('--fill', type=float, help='count blank numbers as this value (e.g. 0)')
+    parser.add_argument('--output', type=Path, help='write the summary and the mismatched keys to this workbook')
+    parser.add_argument('--diff-dir', type=Path, help='write the full difference of each pair of workbooks to this folder')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help='number of worker processes for trees')
+    args = parser.parse_args(argv)
+
+    if args.a.is_dir():
+        summary, missing = diff_trees(args.a, args.b, args.diff_dir, ('A', 'B'), args.fill, args.abs_tol, args.rel_tol, args.workers)
+    else:
+        output_file = None
+        if args.diff_dir is not None:
+            args.diff_dir.mkdir(parents=True, exist_ok=True)
+            output_file = args.diff_dir / f'{args.a.stem}-diff.xlsx'
+        summary, missing = diff_workbooks(args.a, args.b, output_file, ('A', 'B'), args.fill, args.abs_tol, args.rel_tol)
+        summary = summary.assign(File=args.a.name)[summary_columns]
+        missing = missing.assign(File=args.a.name)[missing_columns]
+
+    # Non-zero exit status when anything differs, so the comparison can gate a change
+    if not report(summary, missing, args.output):
+        raise SystemExit(1)
+
+if __name__ == "__main__":
+    main()